@@ -0,0 +1,166 @@
+import json
+import os
+from abc import ABC, abstractmethod
+
+import httpx
+from pydantic import TypeAdapter
+
+PENDING = "pending"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+TERMINAL_STATES = [SUCCEEDED, FAILED]
+
+
+class BatchBackend(ABC):
+    """
+    Offline batch API of a provider: a JSONL file of requests is submitted as
+    one job, polled until it is done, and a JSONL file of results is
+    downloaded. Every request has a key, returned with its result.
+    """
+
+    @abstractmethod
+    def make_request(self, key, prompt) -> dict:
+        """Line of the requests file for prompt."""
+
+    @abstractmethod
+    def submit(self, requests_path, display_name) -> str:
+        """Upload the requests file and create the job, returns its ID."""
+
+    @abstractmethod
+    def status(self, job_id) -> str:
+        """PENDING, RUNNING, SUCCEEDED or FAILED."""
+
+    @abstractmethod
+    def download(self, job_id, output_path) -> None:
+        """Save the results file of a succeeded job to output_path."""
+
+    @abstractmethod
+    def parse_result(self, line) -> tuple:
+        """(key, response text or None, error or None) of a line of the results file."""
+
+
+def gemini_schema(schema_type):
+    """
+    Response schema of the Gemini API for a pydantic type (e.g.
+    list[MedicalQuestion]): the JSON schema with $refs inlined, restricted to
+    the fields the API supports.
+    """
+    json_schema = TypeAdapter(schema_type).json_schema()
+    definitions = json_schema.get("$defs", {})
+
+    def convert(node):
+        if "$ref" in node:
+            return convert(definitions[node["$ref"].split("/")[-1]])
+        converted = {"type": node["type"].upper()}
+        if "properties" in node:
+            converted["properties"] = {name: convert(value) for name, value in node["properties"].items()}
+        if "required" in node:
+            converted["required"] = node["required"]
+        if "items" in node:
+            converted["items"] = convert(node["items"])
+        if "enum" in node:
+            converted["enum"] = node["enum"]
+        return converted
+
+    return convert(json_schema)
+
+
+class GeminiBatchBackend(BatchBackend):
+    """
+    Gemini Batch API (https://ai.google.dev/gemini-api/docs/batch-mode) over
+    REST, at half the price of generate_content and outside of its rate
+    limits. base_url can point to a local stand-in, see batch_stub_server.py.
+    """
+
+    STATES = {
+        "BATCH_STATE_PENDING": PENDING,
+        "BATCH_STATE_RUNNING": RUNNING,
+        "BATCH_STATE_SUCCEEDED": SUCCEEDED,
+        "BATCH_STATE_FAILED": FAILED,
+        "BATCH_STATE_CANCELLED": FAILED,
+        "BATCH_STATE_EXPIRED": FAILED,
+    }
+
+    def __init__(self, api_key=None, model="gemini-2.0-flash", system_prompt=None, response_schema=None,
+                 base_url="https://generativelanguage.googleapis.com", timeout=300):
+        self.model = model
+        self.system_prompt = system_prompt
+        self.response_schema = gemini_schema(response_schema) if response_schema is not None else None
+        self.base_url = base_url.rstrip("/")
+        self.client = httpx.Client(
+            headers={"x-goog-api-key": api_key or os.getenv("GEMINI_API_KEY", "").split(",")[0]},
+            timeout=timeout,
+        )
+
+    def make_request(self, key, prompt):
+        request = {"contents": [{"role": "user", "parts": [{"text": prompt}]}]}
+        if self.system_prompt:
+            request["system_instruction"] = {"parts": [{"text": self.system_prompt}]}
+        if self.response_schema is not None:
+            request["generation_config"] = {
+                "response_mime_type": "application/json",
+                "response_schema": self.response_schema,
+            }
+        return {"key": key, "request": request}
+
+    def submit(self, requests_path, display_name):
+        with open(requests_path, "rb") as f:
+            content = f.read()
+        # Resumable upload, in a single chunk
+        response = self.client.post(
+            f"{self.base_url}/upload/v1beta/files",
+            headers={
+                "X-Goog-Upload-Protocol": "resumable",
+                "X-Goog-Upload-Command": "start",
+                "X-Goog-Upload-Header-Content-Length": str(len(content)),
+                "X-Goog-Upload-Header-Content-Type": "application/jsonl",
+            },
+            json={"file": {"display_name": display_name}},
+        )
+        response.raise_for_status()
+        response = self.client.post(
+            response.headers["X-Goog-Upload-URL"],
+            headers={"X-Goog-Upload-Command": "upload, finalize", "X-Goog-Upload-Offset": "0"},
+            content=content,
+        )
+        response.raise_for_status()
+        file_name = response.json()["file"]["name"]
+
+        response = self.client.post(
+            f"{self.base_url}/v1beta/models/{self.model}:batchGenerateContent",
+            json={"batch": {"display_name": display_name, "input_config": {"file_name": file_name}}},
+        )
+        response.raise_for_status()
+        return response.json()["name"]
+
+    def _get(self, job_id):
+        response = self.client.get(f"{self.base_url}/v1beta/{job_id}")
+        response.raise_for_status()
+        return response.json()
+
+    def status(self, job_id):
+        state = self._get(job_id).get("metadata", {}).get("state", "BATCH_STATE_PENDING")
+        return self.STATES.get(state, RUNNING)
+
+    def download(self, job_id, output_path):
+        job = self._get(job_id)
+        output = job.get("response") or job.get("metadata", {}).get("output", {})
+        file_name = output["responsesFile"]
+        with self.client.stream("GET", f"{self.base_url}/download/v1beta/{file_name}:download",
+                                params={"alt": "media"}) as response:
+            response.raise_for_status()
+            with open(output_path + ".tmp", "wb") as f:
+                for chunk in response.iter_bytes():
+                    f.write(chunk)
+        os.replace(output_path + ".tmp", output_path)
+
+    def parse_result(self, line):
+        result = json.loads(line)
+        if "error" in result:
+            return result.get("key"), None, result["error"]
+        try:
+            parts = result["response"]["candidates"][0]["content"]["parts"]
+        except (KeyError, IndexError) as e:
+            return result.get("key"), None, f"No content in the response: {e}"
+        return result.get("key"), "".join(part.get("text", "") for part in parts), None
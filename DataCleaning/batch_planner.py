@@ -0,0 +1,102 @@
+def byte_token_counter(bytes_per_token=3.0):
+    """
+    Token estimate from the UTF-8 length, without a tokenizer. 3 bytes per
+    token errs on the high side for Vietnamese text (most accented letters
+    take 2-3 bytes).
+    """
+    def count_tokens(text):
+        return int(len(text.encode("utf-8")) / bytes_per_token) + 1
+    return count_tokens
+
+
+def tiktoken_counter(encoding="cl100k_base"):
+    """Token count with a local tiktoken encoding, or the byte estimate when tiktoken is not installed."""
+    try:
+        import tiktoken
+    except ImportError:
+        print("tiktoken is not installed, estimating tokens from the byte length")
+        return byte_token_counter()
+    tokenizer = tiktoken.get_encoding(encoding)
+    return lambda text: len(tokenizer.encode(text, disallowed_special=()))
+
+
+def pending_ranges(start, end, done):
+    """
+    Ranges of the rows [start, end) that are not in done, a dict of the
+    ranges already done ({str(start): end}, as in progress.json).
+    """
+    done = sorted((int(lo), hi) for lo, hi in done.items())
+    ranges = []
+    position = start
+    for lo, hi in done:
+        if hi <= position:
+            continue
+        if lo > position:
+            ranges.append((position, min(lo, end)))
+        position = max(position, hi)
+        if position >= end:
+            break
+    if position < end:
+        ranges.append((position, end))
+    return [(lo, hi) for lo, hi in ranges if lo < hi]
+
+
+class BatchPlanner:
+    """
+    Packs consecutive rows into requests that stay under a token budget: at
+    most max_input_tokens of row text and max_output_tokens of expected
+    answer, and at most max_rows rows. The answer to a row is estimated as
+    the row itself (the question is rewritten) plus output_overhead tokens
+    for the other fields of MedicalQuestion. A row over budget on its own is
+    sent alone.
+    """
+
+    def __init__(self, max_input_tokens=8000, max_output_tokens=7000, max_rows=25, output_overhead=80,
+                 count_tokens=None):
+        self.max_input_tokens = max_input_tokens
+        self.max_output_tokens = max_output_tokens
+        self.max_rows = max_rows
+        self.output_overhead = output_overhead
+        self.count_tokens = count_tokens or byte_token_counter()
+
+    def plan(self, texts, start=0, end=None):
+        """
+        Batches of the rows [start, end) of texts, as a list of (start, end)
+        ranges that cover them in order.
+        """
+        end = len(texts) if end is None else end
+        batches = []
+        batch_start, input_tokens, output_tokens = start, 0, 0
+        for i in range(start, end):
+            row_tokens = self.count_tokens(texts[i])
+            row_output = row_tokens + self.output_overhead
+            full = (
+                i - batch_start >= self.max_rows
+                or input_tokens + row_tokens > self.max_input_tokens
+                or output_tokens + row_output > self.max_output_tokens
+            )
+            if full and i > batch_start:
+                batches.append((batch_start, i))
+                batch_start, input_tokens, output_tokens = i, 0, 0
+            input_tokens += row_tokens
+            output_tokens += row_output
+        if batch_start < end:
+            batches.append((batch_start, end))
+        return batches
+
+
+def split_rows(rows):
+    """The two halves of a list of rows."""
+    middle = len(rows) // 2
+    return [rows[:middle], rows[middle:]]
+
+
+def contiguous_ranges(rows):
+    """The sorted rows as a list of (start, end) ranges of consecutive rows."""
+    ranges = []
+    for row in sorted(rows):
+        if ranges and ranges[-1][1] == row:
+            ranges[-1][1] = row + 1
+        else:
+            ranges.append([row, row + 1])
+    return [tuple(r) for r in ranges]
@@ -0,0 +1,152 @@
+"""
+Local stand-in for the Gemini Batch API, for trying the batch mode of
+classification.py without an API key or cost, and for its tests
+(tests/test_batch_mode.py):
+
+    python batch_stub_server.py --port 8765
+    Classifier(...).run_batch_mode(GeminiBatchBackend(..., base_url="http://127.0.0.1:8765"))
+
+It implements the file upload, batch creation, polling and download endpoints
+used by GeminiBatchBackend. A job is reported pending, then running, then
+succeeded. Every request is answered with one valid MedicalQuestion per line
+of its prompt, with the ID before the first ";" as questionID, and drop_rate
+of them left out.
+"""
+import argparse
+import itertools
+import json
+import random
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+
+def echo_response(request, drop_rate=0.0, rng=random):
+    """Response text of a batch request, in the format of the classification prompt."""
+    prompt = request["contents"][-1]["parts"][0]["text"]
+    questions = []
+    for line in prompt.splitlines():
+        if ";" not in line or rng.random() < drop_rate:
+            continue
+        question_id, question, *_ = line.split(";")
+        questions.append({
+            "question": question.strip(),
+            "answer": {"optionA": "A", "optionB": "B", "optionC": "C", "optionD": "D"},
+            "correctAnswer": "optionA",
+            "medicalTopic": ["Other(No Category)"],
+            "difficultLevel": "Easy",
+            "regularFormat": True,
+            "questionID": question_id.strip(),
+        })
+    return json.dumps(questions, ensure_ascii=False)
+
+
+class BatchStubState:
+    def __init__(self, respond):
+        self.respond = respond
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.files = {}
+        self.uploads = {}
+        self.jobs = {}
+
+    def run_job(self, file_name):
+        lines = []
+        for line in self.files[file_name].decode("utf-8").splitlines():
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            text = self.respond(item["request"])
+            lines.append(json.dumps({
+                "key": item["key"],
+                "response": {"candidates": [{"content": {"role": "model", "parts": [{"text": text}]}}]},
+            }, ensure_ascii=False))
+        return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+def make_handler(state):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _send(self, status, body=b"", headers=None, content_type="application/json"):
+            if isinstance(body, (dict, list)):
+                body = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _body(self):
+            return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+        def do_POST(self):
+            path = urlparse(self.path).path
+            body = self._body()
+            with state.lock:
+                if path == "/upload/v1beta/files":
+                    upload_id = next(state.ids)
+                    state.uploads[upload_id] = b""
+                    host = self.headers["Host"]
+                    return self._send(200, {}, {"X-Goog-Upload-URL": f"http://{host}/upload/session/{upload_id}"})
+                match = re.fullmatch(r"/upload/session/(\d+)", path)
+                if match:
+                    file_name = f"files/{match.group(1)}"
+                    state.files[file_name] = body
+                    return self._send(200, {"file": {"name": file_name}})
+                match = re.fullmatch(r"/v1beta/models/([^/:]+):batchGenerateContent", path)
+                if match:
+                    file_name = json.loads(body)["batch"]["input_config"]["file_name"]
+                    if file_name not in state.files:
+                        return self._send(404, {"error": {"message": f"{file_name} not found"}})
+                    job_id = f"batches/{next(state.ids)}"
+                    output_name = f"files/{job_id.split('/')[1]}-output"
+                    state.files[output_name] = state.run_job(file_name)
+                    state.jobs[job_id] = {"polls": 0, "output": output_name}
+                    return self._send(200, {"name": job_id, "metadata": {"state": "BATCH_STATE_PENDING"}})
+            self._send(404, {"error": {"message": f"Unknown path {path}"}})
+
+        def do_GET(self):
+            path = urlparse(self.path).path
+            with state.lock:
+                match = re.fullmatch(r"/v1beta/(batches/\d+)", path)
+                if match and match.group(1) in state.jobs:
+                    job = state.jobs[match.group(1)]
+                    job["polls"] += 1
+                    states = ["BATCH_STATE_PENDING", "BATCH_STATE_RUNNING", "BATCH_STATE_SUCCEEDED"]
+                    job_state = states[min(job["polls"] - 1, 2)]
+                    body = {"name": match.group(1), "metadata": {"state": job_state}, "done": job["polls"] >= 3}
+                    if body["done"]:
+                        body["response"] = {"responsesFile": job["output"]}
+                    return self._send(200, body)
+                match = re.fullmatch(r"/download/v1beta/(files/[^:]+):download", path)
+                if match and match.group(1) in state.files:
+                    return self._send(200, state.files[match.group(1)], content_type="application/octet-stream")
+            self._send(404, {"error": {"message": f"Unknown path {path}"}})
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def start_stub_server(port=0, respond=None):
+    """Start the stub in a background thread, returns the server and its base URL."""
+    state = BatchStubState(respond or echo_response)
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(state))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the Gemini Batch API")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--drop_rate", type=float, default=0.0, help="Share of the questions left out of the responses")
+    args = parser.parse_args()
+
+    server, base_url = start_stub_server(args.port, lambda request: echo_response(request, args.drop_rate))
+    print(f"Gemini Batch API stub listening on {base_url}")
+    threading.Event().wait()
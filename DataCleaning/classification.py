@@ -9,6 +9,7 @@ import datetime
 import random
 from google import genai
 import time
+import asyncio
 
 # import google.generativeai as genai
 import json
@@ -27,6 +28,15 @@ from pydantic import BaseModel
 from typing import List, Dict
 from google.genai.types import GenerateContentConfig
 from pydantic import ConfigDict
+from request_engine import AsyncRequestEngine, RateLimitError, SplitJob
+from batch_planner import BatchPlanner, contiguous_ranges, pending_ranges, split_rows, tiktoken_counter
+from json_salvage import is_empty_list, salvage_objects
+from work_queue import DONE
+from batch_backend import SUCCEEDED, TERMINAL_STATES
+import uuid
+from result_store import JsonlResultStore
+from services.client_pool import POOL, get_gemini_client
+from services.response_cache import cache_key, get_response_cache
 
 global category
 
@@ -53,33 +63,81 @@ class MedicalQuestionList(BaseModel):
 
 
 class LLM:
-    def __init__(self, model):
+    def __init__(self, model, use_cache=True, api_key=None):
+        # Gemini responses are cached (Inference/APIServices/services/response_cache.py),
+        # use_cache=False or LLM_CACHE_BYPASS=1 always calls the API
+        self.use_cache = use_cache and not os.getenv("LLM_CACHE_BYPASS")
         if model == "gemini":
-            self.client = genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
+            # Shared, long-lived client of the next key, api_key (or
+            # GEMINI_API_KEY) may hold several comma separated keys that are
+            # used in turn
+            self.api_key = api_key or os.getenv("GEMINI_API_KEY")
+            self.client = get_gemini_client(self.api_key)
             self.sys_prompt = gemini_prompt
 
         self.model = model
 
-    def get_llm_responese(self, prompt):
-        try:
-            
-            
-            if self.model == "gemini":
-                key=os.getenv("GEMINI_API_KEY")
-                client = genai.Client(api_key=key)
-                response = client.models.generate_content(
-                    model='gemini-2.0-flash',
-                    contents=f"""
+    def cache_key(self, prompt):
+        return cache_key('gemini-2.0-flash', self.sys_prompt, list[MedicalQuestion], prompt)
+
+    def get_cached_response(self, prompt):
+        if not (self.use_cache and self.model == "gemini"):
+            return None
+        data = get_response_cache().get(self.cache_key(prompt))
+        if data is None:
+            return None
+        return {"success": True, "data": data, "cached": True}
+
+    def cache_response(self, prompt, data):
+        if self.use_cache:
+            get_response_cache().put(self.cache_key(prompt), data)
+
+    def invalidate_cached_response(self, prompt):
+        """Forget the cached response of prompt, when it was rejected, so that a retry calls the API."""
+        if self.use_cache and self.model == "gemini":
+            get_response_cache().delete(self.cache_key(prompt))
+
+    def gemini_request(self, prompt):
+        """Arguments of the generate_content request for prompt, the same for the sync and async calls."""
+        return {
+            "model": 'gemini-2.0-flash',
+            "contents": f"""
                     INSTRUCTION: {self.sys_prompt}
                     question: {prompt}
                     
                     """,
-                    config={
-                        'response_mime_type': 'application/json',
-                        'response_schema': list[MedicalQuestion],
-                    },
-                )                
-                return {"success": True, "data": response.text}
+            "config": {
+                'response_mime_type': 'application/json',
+                'response_schema': list[MedicalQuestion],
+            },
+        }
+
+    def gemini_result(self, prompt, response):
+        self.cache_response(prompt, response.text)
+        return {"success": True, "data": response.text}
+
+    def failed_result(self, caller, error):
+        """
+        Result of a request that raised error. rate_limited is set when the
+        API answered 429, so that the caller can slow down.
+        """
+        print(f"error in {caller}", error)
+        with open("error.log", "a") as f:
+            f.write(f"{str(error)}\n")
+        return {
+            "success": False,
+            "rate_limited": getattr(error, "code", None) == 429,
+        }
+
+    def get_llm_responese(self, prompt):
+        cached = self.get_cached_response(prompt)
+        if cached is not None:
+            return cached
+        try:
+            if self.model == "gemini":
+                with POOL.request("gemini"):
+                    response = get_gemini_client(self.api_key).models.generate_content(**self.gemini_request(prompt))
+                return self.gemini_result(prompt, response)
             elif self.model == "llama":
                 response = self.client.chat(
                     model="llama3.2",
@@ -89,33 +147,65 @@ class LLM:
             else:
                 raise Exception("Invalid Model")
         except Exception as e:
-            print("error in get_llm_responese", e)
-            with open("error.log", "a") as f:
-                f.write(f"{str(e)}\n")
-            return {
-                "success": False,
-            }
+            return self.failed_result("get_llm_responese", e)
 
-def add_to_json(file, new_item):
-   with open(file, 'r+', encoding='utf-8') as f:
-    data = f.read()
-    
-    if not data.strip():
-        f.seek(0)  
-        f.write('[\n')  
-        f.write(json.dumps(new_item, ensure_ascii=False)) 
-        f.write('\n')  
-        f.write(']')  
-    else:
-        data = data.strip().rstrip(']') 
-        
-        if len(data) > 1:
-            data += ','
+    async def aget_llm_responese(self, prompt):
+        """Async version of get_llm_responese, see failed_result."""
+        cached = self.get_cached_response(prompt)
+        if cached is not None:
+            return cached
+        try:
+            if self.model == "gemini":
+                with POOL.request("gemini"):
+                    response = await get_gemini_client(self.api_key).aio.models.generate_content(
+                        **self.gemini_request(prompt))
+                return self.gemini_result(prompt, response)
+            return await asyncio.to_thread(self.get_llm_responese, prompt)
+        except Exception as e:
+            return self.failed_result("aget_llm_responese", e)
 
-        data += '\n' + json.dumps(new_item, ensure_ascii=False) + '\n]'
-        
-        f.seek(0)  
-        f.write(data)
+def question_id(src_iden, row):
+    """ID of a row, sent with the question and returned by the model as questionID."""
+    return f"{src_iden}_{row}"
+
+def row_texts(src_iden, data, first_row=0):
+    """Prompt text of every row of data: its ID, question and answer."""
+    return [
+        f"{question_id(src_iden, row)};{question};{answer}"
+        for row, (question, answer) in enumerate(zip(data["question"], data["answer"]), start=first_row)
+    ]
+
+def match_rows(raw_data, ids):
+    """
+    Salvage the valid MedicalQuestion objects of a response, even if it is
+    not valid JSON as a whole, and match them to the rows of the request by
+    questionID. ids maps the questionID of every row to the row. Returns the
+    objects by row, the other objects are dropped. A single row is matched
+    to the only valid object whatever its questionID.
+    """
+    objects, n_invalid = salvage_objects(raw_data)
+    valid = []
+    for obj in objects:
+        try:
+            MedicalQuestion.model_validate(obj)
+        except ValueError:
+            n_invalid += 1
+            continue
+        valid.append(obj)
+
+    if len(ids) == 1 and len(valid) == 1:
+        return {next(iter(ids.values())): valid[0]}
+    matched = {}
+    for obj in valid:
+        row = ids.get(str(obj["questionID"]))
+        if row is not None and row not in matched:
+            matched[row] = obj
+    return matched
+
+# Key of progress.json with the batches done ahead of the progress of a file
+COMPLETED_BATCHES = "_completed_batches"
+# Key of progress.json with the committed size in bytes of the result store of a file
+RESULT_OFFSETS = "_result_offsets"
 
 
 class Classifier:
@@ -127,6 +217,15 @@ class Classifier:
         save_dir,
         num_questions_samples=2,
         n_questions_per_request=2,
+        max_concurrency=16,
+        initial_concurrency=4,
+        max_retries=5,
+        checkpoint_interval=5.0,
+        use_cache=True,
+        max_input_tokens=8000,
+        max_output_tokens=7000,
+        tokenizer=None,
+        api_key=None,
     ):
         self.columns = [
             "question",
@@ -142,12 +241,31 @@ class Classifier:
         ]
         self.save_dir = save_dir
         self.csv_files = csv_files
-        self.model = LLM(model)
+        self.model = LLM(model, use_cache=use_cache, api_key=api_key)
         self.n_questions_per_request = n_questions_per_request
+        # Rows are packed up to the token budgets, n_questions_per_request is
+        # the most rows per request. Tokens are estimated from the byte length,
+        # or counted with the tiktoken encoding named by tokenizer
+        self.planner = BatchPlanner(
+            max_input_tokens=max_input_tokens,
+            max_output_tokens=max_output_tokens,
+            max_rows=n_questions_per_request,
+            count_tokens=tiktoken_counter(tokenizer) if tokenizer else None,
+        )
         self.num_questions_samples = num_questions_samples
-        processed_files = [f for f in os.listdir(save_dir) if  f.startswith('PIPELINE') and os.path.isfile(os.path.join(dst_folder, f))]
+        self.checkpoint_interval = checkpoint_interval
+        self.engine = AsyncRequestEngine(
+            max_concurrency=max_concurrency,
+            initial_concurrency=initial_concurrency,
+            max_retries=max_retries,
+            base_delay=2,
+        )
+        processed_files = [f for f in os.listdir(save_dir) if  f.startswith('PIPELINE') and os.path.isfile(os.path.join(save_dir, f))]
         self.target_iden=[f.split(".")[0] for f in processed_files]
-        self.init_files()
+        # Workers of a queue (csv_files=[]) keep their progress in the
+        # WorkQueue, not in progress.json
+        if csv_files:
+            self.init_files()
     
     def check_finish_proccess(self,src_file, dst_file):
         src_data=pd.read_csv(src_file)
@@ -159,11 +277,10 @@ class Classifier:
     
     def init_files(self):
         progress_file = os.path.join(self.save_dir, "progress.json")
-        if not os.path.exists(progress_file):
-            with open(progress_file, "w") as f:
-                json.dump({}, f)
-        with open(progress_file, "r") as f:
-            progress = json.load(f)
+        progress = {}
+        if os.path.exists(progress_file):
+            with open(progress_file, "r") as f:
+                progress = json.load(f)
         for file_path in self.csv_files:
             src_iden=file_path.split("/")[-1].split(".")[0]
             if src_iden not in progress:
@@ -172,18 +289,92 @@ class Classifier:
             if not os.path.exists(dst_file):
                 with open(dst_file, "w") as f:
                     f.write("")
-        with open(progress_file, "w") as f:
-            json.dump(progress, f)
+            store_file = self.store_path(src_iden)
+            if not os.path.exists(store_file):
+                # Rows saved in the JSON array by a previous version
+                JsonlResultStore.import_json(dst_file, store_file)
+                # Committed as it is, so that rows appended before the first
+                # checkpoint are truncated by a restarted run. Only stores
+                # from before the offsets have none
+                progress.setdefault(RESULT_OFFSETS, {})[src_iden] = os.path.getsize(store_file)
+        self.save_progress(progress)
         
         
             
+    def save_progress(self, progress):
+        # Written to a temporary file first so that progress.json is never
+        # left half written
+        progress_file = os.path.join(self.save_dir, "progress.json")
+        with open(progress_file + ".tmp", "w") as f:
+            json.dump(progress, f)
+        os.replace(progress_file + ".tmp", progress_file)
+
+    def store_path(self, src_iden):
+        return os.path.join(self.save_dir, f"{src_iden}.jsonl")
+
+    def commit_batch(self, progress, src_iden, start, end):
+        """
+        Mark the rows [start, end) of src_iden as done. progress[src_iden] is
+        the number of leading rows that are done, batches done further ahead
+        are kept in progress[COMPLETED_BATCHES] until the rows before them are.
+        It is saved by the next checkpoint().
+        """
+        pending = progress.setdefault(COMPLETED_BATCHES, {}).setdefault(src_iden, {})
+        pending[str(start)] = end
+        while str(progress[src_iden]) in pending:
+            progress[src_iden] = pending.pop(str(progress[src_iden]))
+
+    def checkpoint(self, progress, stores):
+        """
+        fsync the result stores, then save the progress along with their
+        offsets. Rows appended after the last checkpoint are truncated by the
+        next run, which sends their batches again.
+        """
+        offsets = progress.setdefault(RESULT_OFFSETS, {})
+        for src_iden, store in stores.items():
+            offsets[src_iden] = store.sync()
+        self.save_progress(progress)
+
     def run_classification(self):
+        asyncio.run(self.run_classification_async())
+
+    async def run_classification_async(self):
+        """
+        Send the batches of every CSV file to the LLM concurrently. Each batch
+        is saved and committed to progress.json as soon as it is done, in
+        whatever order they finish.
+        """
+        progress, files, stores = self.load_pending()
+        rows_done = self.progress_committer(progress, stores)
+
+        try:
+            finished = await self.classify_rows(files, stores, rows_done)
+        finally:
+            self.save_results(progress, stores)
+        for provider, stats in POOL.stats.summary().items():
+            print(f"Client pool [{provider}]: {stats}")
+        if self.model.use_cache:
+            print("Response cache:", get_response_cache().stats())
+        if not finished:
+            print("may be rate limited")
+            return
+
+        print(f"Finished processing. Data saved to {self.save_dir}")
+
+    def load_pending(self):
+        """
+        progress.json, the rows of every CSV file that are not done as a list
+        of (src_iden, texts, ranges) and the result store of every file.
+        """
         progress_file = os.path.join(self.save_dir, "progress.json")
         with open(progress_file, "r") as f: 
             progress = json.load(f)
+        completed = progress.setdefault(COMPLETED_BATCHES, {})
+        offsets = progress.setdefault(RESULT_OFFSETS, {})
 
+        files = []
+        stores = {}
         for file_path in self.csv_files:
-            process_idx=0
             print("processing file", file_path)
             src_iden=file_path.split("/")[-1].split(".")[0]
             dst_file=os.path.join(self.save_dir,f"{src_iden}.json")
@@ -196,77 +387,312 @@ class Classifier:
                 sample_idx = [i for i in range(min(self.num_questions_samples, len(df) - 1))]
 
             data = df.iloc[sample_idx][["question", "answer"]]
-            batches = [
-                data[i: i + self.n_questions_per_request]
-                for i in range(process_idx, len(data), self.n_questions_per_request)
-            ]
 
             save_path = dst_file
             if not os.path.exists(save_path):
                 with open(save_path, "w") as f:
                     f.write("")
+            stores[src_iden] = JsonlResultStore(
+                self.store_path(src_iden), committed_offset=offsets.get(src_iden))
 
-            n_successive_fail=0
-            MAX_SUCCESS_FAIL=3
-            MAX_RETRIES = 5
-            RETRY_DELAY = 2  
-            for i, batch in enumerate(batches):
-                
-                questions = "\n".join(
-                    batch.apply(lambda row: f"{row['question']};{row['answer']}", axis=1)
-                )
+            texts = row_texts(src_iden, data)
+            files.append((src_iden, texts, pending_ranges(process_idx, len(texts), completed.get(src_iden, {}))))
+        return progress, files, stores
 
-                for attempt in range(MAX_RETRIES):
-                    response = self.model.get_llm_responese(questions)
-                   
-                    if response.get("success"):
-                        try:
-                            raw_data = response.get("data", "[]")
-
-                            if isinstance(raw_data, str):
-                                try:
-                                    json_list = json.loads(raw_data)
-                                except json.JSONDecodeError as e:
-                                    raise ValueError(f"Error parsing JSON string: {e}")
-                            else:
-                                json_list = raw_data
-
-                            if not isinstance(json_list, list):
-                                raise ValueError(f"Expected a list of JSON objects, got: {type(json_list)}")
-
-                            df = pd.json_normalize(json_list, sep="_")
-
-                            print("Processed batch", i)
-                            for _, row in df.iterrows():
-                                add_to_json(save_path, row.to_dict())
-                            progress[src_iden] +=self.n_questions_per_request
-                            with open(progress_file, "w") as f:
-                                json.dump(progress, f) 
-                            n_successive_fail=0
-                            break
-                          
-
-                        except Exception as e:
-                            n_successive_fail+=1
-                            print("Error processing data:", e)
-                            if n_successive_fail>=MAX_SUCCESS_FAIL:
-                                print("Face continuous failure. Force stop script")
-                                return
-                            break  
-                    else:
-                        print(f"Attempt {attempt + 1} failed. Retrying...")
-                        time.sleep(RETRY_DELAY)
-                else:
-                    print("Failed to get a successful response after maximum retries.")
-                    n_successive_fail+=1
-                    if n_successive_fail>=MAX_SUCCESS_FAIL:
-                        print("may be rate limited")
-                        progress[src_iden] = process_idx
-                        with open(progress_file, "w") as f:
-                            json.dump(progress, f)
-                        return 
+    def progress_committer(self, progress, stores):
+        """rows_done callback of classify_rows that commits to progress, with a checkpoint every checkpoint_interval."""
+        last_checkpoint = time.monotonic()
+
+        def rows_done(src_iden, start, end):
+            nonlocal last_checkpoint
+            self.commit_batch(progress, src_iden, start, end)
+            if time.monotonic() - last_checkpoint >= self.checkpoint_interval:
+                self.checkpoint(progress, stores)
+                last_checkpoint = time.monotonic()
+
+        return rows_done
+
+    def save_results(self, progress, stores):
+        self.checkpoint(progress, stores)
+        # The JSON array files are what the next steps read
+        for src_iden, store in stores.items():
+            store.export_json(os.path.join(self.save_dir, f"{src_iden}.json"))
+            store.close()
+
+    def run_batch_mode(self, backend, poll_interval=60, online_retry=True):
+        """
+        Classify the rows that are not done with an offline batch job of
+        backend (a BatchBackend, e.g. GeminiBatchBackend): the batches are
+        written to a JSONL file of requests in batch/, submitted as one job
+        and polled every poll_interval seconds. The results are merged into
+        the result store of every file like the ones of run_classification,
+        and the rows missing from them are then sent online if online_retry.
+
+        The submitted job is recorded in batch/batch_job.json, a run started
+        again while it is not merged yet waits for that job instead of
+        submitting another one.
+        """
+        progress, files, stores = self.load_pending()
+        rows_done = self.progress_committer(progress, stores)
+        batch_dir = os.path.join(self.save_dir, "batch")
+        os.makedirs(batch_dir, exist_ok=True)
+        job_file = os.path.join(batch_dir, "batch_job.json")
 
+        try:
+            if os.path.exists(job_file):
+                with open(job_file, "r") as f:
+                    job = json.load(f)
+                print(f"Waiting for the batch job {job['job_id']} submitted before")
+            else:
+                job = self.submit_batch_job(backend, files, batch_dir)
+                with open(job_file + ".tmp", "w") as f:
+                    json.dump(job, f)
+                os.replace(job_file + ".tmp", job_file)
+
+            while (state := backend.status(job["job_id"])) not in TERMINAL_STATES:
+                print(f"Batch job {job['job_id']} is {state}")
+                time.sleep(poll_interval)
+            if state != SUCCEEDED:
+                os.remove(job_file)
+                raise RuntimeError(f"Batch job {job['job_id']} {state}")
+
+            results_path = os.path.join(batch_dir, f"batch_output_{job['uuid']}.jsonl")
+            backend.download(job["job_id"], results_path)
+            missing = self.merge_batch_results(backend, results_path, job["keys"], files, stores, rows_done)
+            self.checkpoint(progress, stores)
+            os.remove(job_file)
+
+            n_missing = sum(hi - lo for ranges in missing.values() for lo, hi in ranges)
+            print(f"Merged batch job {job['job_id']}, {n_missing} rows missing from its results")
+            if n_missing and online_retry:
+                texts = {src_iden: texts for src_iden, texts, _ in files}
+                retry = [(src_iden, texts[src_iden], ranges) for src_iden, ranges in missing.items()]
+                asyncio.run(self.classify_rows(retry, stores, rows_done))
+        finally:
+            self.save_results(progress, stores)
         print(f"Finished processing. Data saved to {self.save_dir}")
+
+    def submit_batch_job(self, backend, files, batch_dir):
+        job_uuid = str(uuid.uuid4())
+        requests_path = os.path.join(batch_dir, f"batch_input_{job_uuid}.jsonl")
+        keys = []
+        with open(requests_path, "w", encoding="utf-8") as f:
+            for src_iden, texts, ranges in files:
+                for lo, hi in ranges:
+                    for start, end in self.planner.plan(texts, lo, hi):
+                        key = f"{src_iden}:{start}:{end}"
+                        prompt = "\n".join(texts[start:end])
+                        f.write(json.dumps(backend.make_request(key, prompt), ensure_ascii=False) + "\n")
+                        keys.append(key)
+        job_id = backend.submit(requests_path, display_name=f"classification-{job_uuid}")
+        print(f"Submitted batch job {job_id} with {len(keys)} requests")
+        return {"job_id": job_id, "uuid": job_uuid, "requests_path": requests_path, "keys": keys}
+
+    def merge_batch_results(self, backend, results_path, keys, files, stores, rows_done):
+        """
+        Save the valid questions of the results of a batch job, returns the
+        rows that are still missing as {src_iden: ranges}. Rows already done
+        (results merged by an interrupted run) are skipped.
+        """
+        pending = {
+            src_iden: {row for lo, hi in ranges for row in range(lo, hi)}
+            for src_iden, _, ranges in files
+        }
+        returned = set()
+        missing = {}
+        with open(results_path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                key, raw_data, error = backend.parse_result(line)
+                src_iden, start, end = key.rsplit(":", 2)
+                rows = [row for row in range(int(start), int(end)) if row in pending.get(src_iden, ())]
+                returned.add(key)
+                if not rows:
+                    continue
+                if error is not None:
+                    print(f"Rows {start}-{end} of {src_iden} failed in the batch job: {error}")
+                    missing.setdefault(src_iden, []).extend(rows)
+                    continue
+                ids = {question_id(src_iden, row): row for row in rows}
+                matched = match_rows(raw_data, ids)
+                if len(ids) == 1 and not matched and is_empty_list(raw_data):
+                    matched_rows = rows
+                else:
+                    matched_rows = sorted(matched)
+                if matched:
+                    df = pd.json_normalize([matched[row] for row in matched_rows], sep="_")
+                    stores[src_iden].append(df.to_dict("records"))
+                for lo, hi in contiguous_ranges(matched_rows):
+                    rows_done(src_iden, lo, hi)
+                missing.setdefault(src_iden, []).extend(row for row in rows if row not in matched_rows)
+
+        for key in set(keys) - returned:
+            src_iden, start, end = key.rsplit(":", 2)
+            missing.setdefault(src_iden, []).extend(
+                row for row in range(int(start), int(end)) if row in pending.get(src_iden, ()))
+        return {src_iden: contiguous_ranges(rows) for src_iden, rows in missing.items() if rows}
+
+    async def classify_rows(self, files, stores, rows_done):
+        """
+        Classify rows of several files concurrently. files is a list of
+        (src_iden, texts, ranges): the prompt text of the rows (a list, or a
+        dict by row) and the (start, end) ranges of rows to send. The results
+        are appended to stores[src_iden] and rows_done(src_iden, start, end)
+        is called for every range of rows saved, in whatever order they
+        finish.
+
+        The valid questions of a response are kept even when others are
+        missing or invalid, and only the rows missing from it are sent again.
+        A batch of which no question is valid is split in two, until the rows
+        at fault are sent alone. Returns False if the engine stopped on
+        consecutive failures.
+        """
+        def make_job(src_iden, texts, rows):
+            return {
+                "src_iden": src_iden,
+                "texts": texts,
+                "rows": rows,
+                "questions": "\n".join(texts[row] for row in rows),
+            }
+
+        def describe(job):
+            return f"{len(job['rows'])} rows from {job['rows'][0]} of {job['src_iden']}"
+
+        jobs = [
+            make_job(src_iden, texts, list(range(start, end)))
+            for src_iden, texts, ranges in files
+            for lo, hi in ranges
+            for start, end in self.planner.plan(texts, lo, hi)
+        ]
+
+        async def classify_batch(job):
+            response = await self.model.aget_llm_responese(job["questions"])
+            if response.get("rate_limited"):
+                raise RateLimitError("rate limited")
+            if not response.get("success"):
+                raise RuntimeError("LLM request failed")
+            raw_data = response.get("data", "[]")
+            ids = {question_id(job["src_iden"], row): row for row in job["rows"]}
+            matched = match_rows(raw_data, ids)
+            if len(matched) == len(ids):
+                return [matched[row] for row in job["rows"]]
+            # The prompt lets the model skip a question it can't process
+            if len(ids) == 1 and is_empty_list(raw_data):
+                return []
+
+            self.model.invalidate_cached_response(job["questions"])
+            missing = [row for row in job["rows"] if row not in matched]
+            if matched:
+                # Keep what was salvaged, send the rest again
+                commit(dict(job, rows=sorted(matched)), [matched[row] for row in sorted(matched)], None)
+                print(f"Salvaged {len(matched)} of {describe(job)}, sending {len(missing)} again")
+                raise SplitJob([make_job(job["src_iden"], job["texts"], missing)], "missing rows")
+            if len(missing) > 1:
+                print(f"No valid question in {describe(job)}, splitting it")
+                raise SplitJob(
+                    [make_job(job["src_iden"], job["texts"], rows) for rows in split_rows(missing)],
+                    "no valid question",
+                )
+            raise ValueError(f"No valid question in {describe(job)}")
+
+        def commit(job, json_list, error):
+            if error is not None:
+                print(f"Failed to process {describe(job)}: {error}")
+                return
+            df = pd.json_normalize(json_list, sep="_")
+            stores[job["src_iden"]].append(df.to_dict("records"))
+            for start, end in contiguous_ranges(job["rows"]):
+                rows_done(job["src_iden"], start, end)
+            print(f"Processed {describe(job)}")
+
+        return await self.engine.run(jobs, classify_batch, commit)
+
+    def unit_result_path(self, unit):
+        # One file per attempt, a worker that lost its unit never writes to
+        # the file of the worker that took it over
+        return os.path.join(
+            self.save_dir, "units", unit["src_iden"],
+            f"{unit['start_row']}-{unit['end_row']}.{unit['attempts']}.jsonl",
+        )
+
+    def read_unit(self, unit):
+        """The rows of a unit, read from its byte offset when the queue has it."""
+        start, end = unit["start_row"], unit["end_row"]
+        if unit.get("start_offset") is None:
+            return pd.read_csv(unit["csv_path"], skiprows=range(1, start + 1), nrows=end - start)
+        columns = pd.read_csv(unit["csv_path"], nrows=0).columns
+        with open(unit["csv_path"], "rb") as f:
+            f.seek(unit["start_offset"])
+            return pd.read_csv(f, header=None, names=columns, nrows=end - start)
+
+    def run_worker(self, queue, worker, lease_seconds=600):
+        """
+        Classify the units of queue (a WorkQueue) until there is none left.
+        Each unit is read from its CSV file on its own and its results are
+        saved to a file of its own, the unit is done once all of its rows are
+        saved. Other workers, in other threads, processes or machines, can
+        work on the same queue.
+        """
+        while (unit := queue.claim(worker, lease_seconds)) is not None:
+            src_iden, start, end = unit["src_iden"], unit["start_row"], unit["end_row"]
+            print(f"{worker}: rows {start}-{end} of {src_iden}")
+            data = self.read_unit(unit)
+            texts = dict(zip(range(start, end), row_texts(src_iden, data, first_row=start)))
+
+            result_path = self.unit_result_path(unit)
+            os.makedirs(os.path.dirname(result_path), exist_ok=True)
+            n_done = 0
+            lost = False
+
+            def rows_done(src_iden, lo, hi):
+                nonlocal n_done, lost
+                n_done += hi - lo
+                if not lost and not queue.heartbeat(unit["id"], worker, lease_seconds):
+                    # The lease ran out and the unit was given to another
+                    # worker: don't pay for its rows twice
+                    print(f"{worker}: lost rows {start}-{end} of {src_iden}, stopping")
+                    lost = True
+                    self.engine.stop()
+
+            with JsonlResultStore(result_path, committed_offset=0) as store:
+                try:
+                    asyncio.run(self.classify_rows([(src_iden, texts, [(start, end)])], {src_iden: store}, rows_done))
+                except Exception as e:
+                    queue.fail(unit["id"], worker, e)
+                    raise
+            if lost:
+                continue
+            if n_done == end - start:
+                if not queue.complete(unit["id"], worker, result_path):
+                    print(f"{worker}: rows {start}-{end} of {src_iden} were taken over by another worker")
+            else:
+                queue.fail(unit["id"], worker, f"{end - start - n_done} rows failed")
+
+    def export_units(self, queue):
+        """Write the results of the done units of every file to <save_dir>/<file>.json, unit by unit in row order."""
+        by_file = {}
+        for unit in queue.units():
+            by_file.setdefault(unit["src_iden"], []).append(unit)
+        for src_iden, units in by_file.items():
+            not_done = sum(unit["status"] != DONE for unit in units)
+            if not_done:
+                print(f"{src_iden}: {not_done} of {len(units)} units are not done, exporting the others")
+            export_path = os.path.join(self.save_dir, f"{src_iden}.json")
+            with open(export_path + ".tmp", "w", encoding="utf-8") as f:
+                f.write("[")
+                n_rows = 0
+                for unit in units:
+                    if unit["status"] != DONE:
+                        continue
+                    with open(unit["result_path"], "r", encoding="utf-8") as unit_file:
+                        for line in unit_file:
+                            f.write(",\n" if n_rows else "\n")
+                            f.write(line.rstrip("\n"))
+                            n_rows += 1
+                f.write("\n]")
+            os.replace(export_path + ".tmp", export_path)
+            print(f"Saved {n_rows} rows to {export_path}")
         
 if __name__ == "__main__":
    
@@ -0,0 +1,77 @@
+import json
+
+
+class ObjectStream:
+    """
+    Incremental parser of the top-level JSON objects of an LLM response that
+    may not be valid JSON as a whole: a list cut off by the output limit,
+    wrapped in a ```json fence, or with a broken object in the middle.
+    Every top-level {...} is decoded on its own as soon as it is complete;
+    the ones that don't decode are counted in n_invalid and skipped.
+
+    Example:
+        stream = ObjectStream()
+        for chunk in chunks:
+            for obj in stream.feed(chunk):
+                ...
+    """
+
+    def __init__(self):
+        self.n_invalid = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._current = []
+
+    def feed(self, text):
+        """Objects completed by text."""
+        objects = []
+        start = 0 if self._depth else None
+        for i, char in enumerate(text):
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                if self._depth:
+                    self._in_string = True
+            elif char == "{":
+                if self._depth == 0:
+                    start = i
+                self._depth += 1
+            elif char == "}" and self._depth:
+                self._depth -= 1
+                if self._depth == 0:
+                    self._current.append(text[start:i + 1])
+                    objects.extend(self._decode("".join(self._current)))
+                    self._current = []
+                    start = None
+        if self._depth:
+            self._current.append(text[start:])
+        return objects
+
+    def _decode(self, text):
+        try:
+            obj = json.loads(text)
+        except json.JSONDecodeError:
+            self.n_invalid += 1
+            return []
+        return [obj]
+
+
+def salvage_objects(text):
+    """Every top-level JSON object of text that decodes, and the number of those that don't."""
+    stream = ObjectStream()
+    objects = stream.feed(text)
+    return objects, stream.n_invalid
+
+
+def is_empty_list(text):
+    """Whether text is an empty JSON list, i.e. the model skipped every question."""
+    try:
+        return json.loads(text.strip().removeprefix("```json").removesuffix("```")) == []
+    except json.JSONDecodeError:
+        return False
@@ -9,7 +9,7 @@ gemini_prompt="""
 # - medicalTopic: List of relevant medical topics (categories). If category does not fit in medical domain, fill Other(No Category)
 # - difficultLevel: Difficulty level
 # - regularFormat: default True
-# - questionID: Unique question ID
+# - questionID: The ID written before the first ";" of the question, unchanged
 
 # ### Below are the difficulty levels:
 # Level 1 (Easy): Questions that are factual or definitional. Example: Basic definitions.
@@ -67,7 +67,7 @@ gemini_prompt="""
 #   "medicalTopic": ["Relevant medical categories (e.g., Cardiology, Neurology)."],
 #   "difficultLevel": "The difficulty level (Easy, Medium, Hard).",
 #   "regularFormat": true,
-#   "questionID": "A unique identifier for the question."
+#   "questionID": "The ID written before the first \";\" of the question."
 # }
 
 # Now, process the following list of questions and return the output in JSON format (one JSON object per question):
@@ -0,0 +1,180 @@
+import asyncio
+import random
+import time
+
+
+class RateLimitError(Exception):
+    """Raised by a request when the API answered 429 / resource exhausted."""
+
+
+class SplitJob(Exception):
+    """
+    Raised by a request to replace its job by jobs, e.g. the halves of a
+    batch whose response was invalid. The job is not retried and on_result
+    is not called for it, but for every one of jobs.
+    """
+
+    def __init__(self, jobs, reason=""):
+        super().__init__(reason)
+        self.jobs = jobs
+
+
+def backoff_delay(attempt, base_delay=1.0, max_delay=60.0):
+    """Exponential backoff with full jitter for the given attempt (0-based)."""
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+class AIMDConcurrency:
+    """
+    Limit on the number of requests in flight, adapted with AIMD: every
+    successful request adds increase / limit (so about +increase per round of
+    requests), and a 429 or a request slower than latency_target multiplies
+    the limit by decrease. Only requests started after the last decrease can
+    decrease it again, so one burst of 429s counts as a single event.
+    """
+
+    def __init__(self, initial=4, minimum=1, maximum=32, increase=1.0, decrease=0.5, latency_target=None):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_target = latency_target
+        self.in_flight = 0
+        self._last_decrease = float("-inf")
+        self._condition = asyncio.Condition()
+
+    async def acquire(self):
+        """Wait for a free slot, returns the start time to pass to release()."""
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+        return time.monotonic()
+
+    async def release(self, started_at, success, rate_limited=False):
+        async with self._condition:
+            self.in_flight -= 1
+            latency = time.monotonic() - started_at
+            too_slow = self.latency_target is not None and latency > self.latency_target
+            if rate_limited or too_slow:
+                if started_at >= self._last_decrease:
+                    self.limit = max(self.minimum, self.limit * self.decrease)
+                    self._last_decrease = time.monotonic()
+            elif success:
+                self.limit = min(self.maximum, self.limit + self.increase / self.limit)
+            self._condition.notify_all()
+
+
+class AsyncRequestEngine:
+    """
+    Run request(job) for every job with a bounded, adaptive number of
+    requests in flight.
+
+    A job whose request raises is retried up to max_retries times after an
+    exponential backoff with jitter, RateLimitError also shrinks the
+    concurrency, SplitJob replaces the job by other jobs. on_result(job,
+    result, error) is called as soon as a job is done, in completion order,
+    with error set when every attempt failed. After max_consecutive_failures
+    failed jobs in a row, or once stop() is called, no new request is
+    started: queued jobs are dropped and jobs in flight are not retried.
+    """
+
+    def __init__(
+        self,
+        max_concurrency=32,
+        initial_concurrency=4,
+        max_retries=5,
+        base_delay=1.0,
+        max_delay=60.0,
+        latency_target=None,
+        max_consecutive_failures=3,
+    ):
+        self.max_concurrency = max_concurrency
+        self.initial_concurrency = initial_concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.latency_target = latency_target
+        self.max_consecutive_failures = max_consecutive_failures
+        self._state = None
+
+    def stop(self):
+        """Start no new request in the running run(), e.g. because its work was given to someone else."""
+        if self._state is not None:
+            self._state["stopped"] = True
+
+    async def run(self, jobs, request, on_result):
+        """Returns False if it stopped early on consecutive failures."""
+        self.concurrency = AIMDConcurrency(
+            initial=min(self.initial_concurrency, self.max_concurrency),
+            maximum=self.max_concurrency,
+            latency_target=self.latency_target,
+        )
+        queue = asyncio.Queue()
+        for job in jobs:
+            queue.put_nowait(job)
+        # At most max_concurrency workers, the AIMD limit decides how many of
+        # them have a request in flight
+        n_workers = min(self.max_concurrency, queue.qsize())
+        # Jobs queued or running, the workers stop when it gets to 0
+        state = self._state = {"consecutive_failures": 0, "stopped": False, "pending": queue.qsize()}
+
+        def job_done():
+            state["pending"] -= 1
+            if state["pending"] == 0:
+                for _ in range(n_workers):
+                    queue.put_nowait(None)
+
+        async def worker():
+            while True:
+                job = await queue.get()
+                if job is None:
+                    return
+                if state["stopped"]:
+                    job_done()
+                    continue
+                try:
+                    result, error = await self._run_job(job, request)
+                except SplitJob as split:
+                    state["pending"] += len(split.jobs)
+                    for new_job in split.jobs:
+                        queue.put_nowait(new_job)
+                    job_done()
+                    continue
+                if error is None:
+                    state["consecutive_failures"] = 0
+                else:
+                    state["consecutive_failures"] += 1
+                    if state["consecutive_failures"] >= self.max_consecutive_failures:
+                        print("Face continuous failure, no new request is started")
+                        state["stopped"] = True
+                on_result(job, result, error)
+                job_done()
+
+        await asyncio.gather(*(worker() for _ in range(n_workers)))
+        return not state["stopped"]
+
+    async def _run_job(self, job, request):
+        error = None
+        for attempt in range(self.max_retries):
+            if self._state["stopped"]:
+                return None, error or RuntimeError("stopped")
+            started_at = await self.concurrency.acquire()
+            try:
+                result = await request(job)
+            except SplitJob:
+                await self.concurrency.release(started_at, success=True)
+                raise
+            except RateLimitError as e:
+                await self.concurrency.release(started_at, success=False, rate_limited=True)
+                error = e
+            except Exception as e:
+                await self.concurrency.release(started_at, success=False)
+                error = e
+            else:
+                await self.concurrency.release(started_at, success=True)
+                return result, None
+            if attempt + 1 < self.max_retries:
+                print(f"Attempt {attempt + 1} failed ({error}). Retrying...")
+                await asyncio.sleep(backoff_delay(attempt, self.base_delay, self.max_delay))
+        return None, error
@@ -0,0 +1,138 @@
+import json
+import os
+import time
+
+
+class JsonlResultStore:
+    """
+    Append-only store of the result rows of one source file, one JSON object
+    per line.
+
+    Rows are buffered and written in one go, the file is fsynced at most every
+    fsync_interval seconds (and by sync()). offset is the size in bytes of
+    everything appended so far: a progress commit that saves it only after
+    sync() references rows that are on disk. When the store is opened again
+    with that offset, whatever was written after it (rows of uncommitted
+    batches, or half a line after a crash) is truncated.
+
+    Example:
+        store = JsonlResultStore("out/file.jsonl", committed_offset=progress_offset)
+        store.append(rows)
+        offset = store.sync()  # save offset with the progress
+        store.export_json("out/file.json")
+    """
+
+    def __init__(self, path, committed_offset=None, buffer_size=1 << 16, fsync_interval=5.0):
+        self.path = path
+        self.buffer_size = buffer_size
+        self.fsync_interval = fsync_interval
+        self._buffer = []
+        self._buffered_bytes = 0
+        self._last_fsync = time.monotonic()
+
+        self._file = open(path, "ab")
+        size = self._file.seek(0, os.SEEK_END)
+        if committed_offset is None:
+            # No progress was committed with an offset (e.g. a file written
+            # by a previous version), only drop an unterminated last line
+            committed_offset = self._last_line_end(size)
+        if committed_offset < size:
+            self._file.truncate(committed_offset)
+        self.offset = min(committed_offset, size)
+
+    def _last_line_end(self, size):
+        if size == 0:
+            return 0
+        with open(self.path, "rb") as f:
+            f.seek(max(0, size - 1))
+            if f.read(1) == b"\n":
+                return size
+            # Back to the last newline
+            position = size
+            while position > 0:
+                start = max(0, position - 65536)
+                f.seek(start)
+                block = f.read(position - start)
+                newline = block.rfind(b"\n")
+                if newline != -1:
+                    return start + newline + 1
+                position = start
+            return 0
+
+    def append(self, rows):
+        """Append rows (dicts), returns the offset after them."""
+        for row in rows:
+            line = (json.dumps(row, ensure_ascii=False) + "\n").encode("utf-8")
+            self._buffer.append(line)
+            self._buffered_bytes += len(line)
+            self.offset += len(line)
+        if self._buffered_bytes >= self.buffer_size:
+            self.flush()
+        return self.offset
+
+    def flush(self, fsync=False):
+        """Write the buffered rows, and fsync if asked or fsync_interval is over."""
+        if self._buffer:
+            self._file.write(b"".join(self._buffer))
+            self._buffer.clear()
+            self._buffered_bytes = 0
+        self._file.flush()
+        if fsync or time.monotonic() - self._last_fsync >= self.fsync_interval:
+            os.fsync(self._file.fileno())
+            self._last_fsync = time.monotonic()
+
+    def sync(self):
+        """Write and fsync everything appended, returns the offset to commit."""
+        self.flush(fsync=True)
+        return self.offset
+
+    def close(self):
+        self.sync()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def rows(self, offset=None):
+        """Rows stored up to offset (everything written by default)."""
+        self.flush()
+        end = self.offset if offset is None else offset
+        with open(self.path, "rb") as f:
+            position = 0
+            for line in f:
+                position += len(line)
+                if position > end:
+                    break
+                yield json.loads(line)
+
+    def export_json(self, json_path, offset=None):
+        """
+        Compact the rows up to offset into a JSON array at json_path, the
+        format of the previous add_to_json output. The file is replaced
+        atomically.
+        """
+        with open(json_path + ".tmp", "w", encoding="utf-8") as f:
+            f.write("[")
+            for i, row in enumerate(self.rows(offset)):
+                f.write(",\n" if i else "\n")
+                f.write(json.dumps(row, ensure_ascii=False))
+            f.write("\n]")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(json_path + ".tmp", json_path)
+
+    @staticmethod
+    def import_json(json_path, path):
+        """Create the JSONL file at path from a JSON array file (e.g. a previous add_to_json output)."""
+        with open(json_path, "r", encoding="utf-8") as f:
+            data = f.read()
+        rows = json.loads(data) if data.strip() else []
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            for row in rows:
+                f.write(json.dumps(row, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
@@ -0,0 +1,95 @@
+import argparse
+import multiprocessing
+import os
+import socket
+
+from classification import Classifier
+from work_queue import WorkQueue, scan_csv
+
+
+def init(args):
+    queue = WorkQueue(args.queue_path)
+    for csv_path in args.csv_files:
+        src_iden = csv_path.split("/")[-1].split(".")[0]
+        n_rows, offsets = scan_csv(csv_path, unit_size=args.unit_size)
+        queue.add_file(src_iden, os.path.abspath(csv_path), n_rows, unit_size=args.unit_size, offsets=offsets)
+        print(f"{src_iden}: {n_rows} rows")
+    print(queue.status())
+
+
+def work(worker, api_key, args):
+    classifier = Classifier(
+        model="gemini",
+        csv_files=[],
+        save_dir=args.save_dir,
+        n_questions_per_request=args.n_questions_per_request,
+        max_concurrency=args.max_concurrency,
+        api_key=api_key,
+    )
+    queue = WorkQueue(args.queue_path, max_attempts=args.max_attempts)
+    classifier.run_worker(queue, worker, lease_seconds=args.lease_seconds)
+
+
+def start_workers(args):
+    os.makedirs(args.save_dir, exist_ok=True)
+    # One key per worker, in turn when there are more workers than keys
+    keys = [key.strip() for key in os.getenv("GEMINI_API_KEY", "").split(",") if key.strip()]
+    assert keys, "GEMINI_API_KEY is not set"
+    n_workers = args.workers or len(keys)
+    host = socket.gethostname()
+    processes = [
+        multiprocessing.Process(target=work, args=(f"{host}-{os.getpid()}-{i}", keys[i % len(keys)], args))
+        for i in range(n_workers)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    print(WorkQueue(args.queue_path).status())
+
+
+def status(args):
+    queue = WorkQueue(args.queue_path)
+    if args.retry_failed:
+        queue.retry_failed()
+    for src_iden, counts in queue.status().items():
+        print(src_iden, counts)
+
+
+def export(args):
+    classifier = Classifier(model="gemini", csv_files=[], save_dir=args.save_dir)
+    classifier.export_units(WorkQueue(args.queue_path))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Classify CSV files with several workers sharing a queue of row ranges. Workers on other "
+                    "machines can join by running 'work' with the same queue_path and save_dir.")
+    parser.add_argument("--queue_path", default="progress.db", help="SQLite database of the work units")
+    parser.add_argument("--save_dir", default="output", help="Directory for the results")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    init_parser = commands.add_parser("init", help="Split CSV files into work units")
+    init_parser.add_argument("csv_files", nargs="+")
+    init_parser.add_argument("--unit_size", type=int, default=500, help="Rows per work unit")
+    init_parser.set_defaults(func=init)
+
+    work_parser = commands.add_parser("work", help="Run workers until every unit is done")
+    work_parser.add_argument("--workers", type=int, default=None,
+                             help="Number of worker processes, one per key of GEMINI_API_KEY by default")
+    work_parser.add_argument("--n_questions_per_request", type=int, default=25)
+    work_parser.add_argument("--max_concurrency", type=int, default=16, help="Requests in flight per worker")
+    work_parser.add_argument("--lease_seconds", type=float, default=600,
+                             help="A unit whose worker gave no sign of life for that long is given to another one")
+    work_parser.add_argument("--max_attempts", type=int, default=3, help="Attempts before a unit is marked failed")
+    work_parser.set_defaults(func=start_workers)
+
+    status_parser = commands.add_parser("status", help="Print the number of units by status")
+    status_parser.add_argument("--retry_failed", action="store_true", help="Put the failed units back to pending")
+    status_parser.set_defaults(func=status)
+
+    export_parser = commands.add_parser("export", help="Write the results of every file to <save_dir>/<file>.json")
+    export_parser.set_defaults(func=export)
+
+    args = parser.parse_args()
+    args.func(args)
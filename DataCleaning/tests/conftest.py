@@ -0,0 +1,50 @@
+import asyncio
+import os
+
+import pandas as pd
+import pytest
+
+from batch_stub_server import echo_response
+
+
+class Killed(BaseException):
+    """Ends a run like a kill: not an Exception, so the request engine doesn't retry it."""
+
+
+@pytest.fixture
+def write_csv(tmp_path):
+    """Write a CSV file of n_rows questions to tmp_path/in/<name>.csv, returns its path."""
+
+    def write(name, n_rows):
+        os.makedirs(tmp_path / "in", exist_ok=True)
+        path = str(tmp_path / "in" / f"{name}.csv")
+        pd.DataFrame({
+            "question": [f"question {i} of {name}" for i in range(n_rows)],
+            "answer": [f"answer {i}" for i in range(n_rows)],
+        }).to_csv(path, index=False)
+        return path
+
+    return write
+
+
+@pytest.fixture
+def fake_llm():
+    """
+    Stand-in for LLM.aget_llm_responese that answers every row of the prompt
+    (see batch_stub_server.echo_response). fake_llm.calls counts the
+    requests, and Killed is raised at request crash_after + 1, like a run
+    killed while it sends requests.
+    """
+
+    class FakeLLM:
+        calls = 0
+        crash_after = None
+
+        async def __call__(self, prompt):
+            if self.crash_after is not None and self.calls >= self.crash_after:
+                raise Killed
+            self.calls += 1
+            await asyncio.sleep(0)
+            return {"success": True, "data": echo_response({"contents": [{"parts": [{"text": prompt}]}]})}
+
+    return FakeLLM()
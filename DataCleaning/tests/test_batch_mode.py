@@ -0,0 +1,74 @@
+import json
+import os
+import random
+
+import pytest
+
+from batch_backend import GeminiBatchBackend
+from batch_stub_server import echo_response, start_stub_server
+from classification import Classifier, MedicalQuestion
+from prompts import gemini_prompt
+
+
+@pytest.fixture
+def stub_server():
+    """Start a batch_stub_server with the given respond function, returns its base URL."""
+    servers = []
+
+    def start(respond=None):
+        server, base_url = start_stub_server(0, respond)
+        servers.append(server)
+        return base_url
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def run_batch_mode(tmp_path, csv_files, base_url, fake_llm):
+    save_dir = str(tmp_path / "out")
+    os.makedirs(save_dir)
+    classifier = Classifier(
+        model="gemini",
+        csv_files=csv_files,
+        save_dir=save_dir,
+        num_questions_samples=-1,
+        n_questions_per_request=6,
+        use_cache=False,
+        api_key="test",
+    )
+    classifier.engine.base_delay = 0
+    classifier.model.aget_llm_responese = fake_llm
+    backend = GeminiBatchBackend(
+        api_key="stub", base_url=base_url, system_prompt=gemini_prompt, response_schema=list[MedicalQuestion])
+    classifier.run_batch_mode(backend, poll_interval=0)
+    return save_dir
+
+
+def question_ids(save_dir, src_iden):
+    with open(os.path.join(save_dir, f"{src_iden}.json"), "r", encoding="utf-8") as f:
+        return [row["questionID"] for row in json.load(f)]
+
+
+def test_batch_mode_merges_every_row(tmp_path, monkeypatch, write_csv, fake_llm, stub_server):
+    monkeypatch.chdir(tmp_path)
+    save_dir = run_batch_mode(tmp_path, [write_csv("batch", 30)], stub_server(), fake_llm)
+
+    ids = question_ids(save_dir, "batch")
+    assert sorted(ids) == sorted(f"batch_{row}" for row in range(30))
+    # Nothing was missing from the batch results, nothing was sent online
+    assert fake_llm.calls == 0
+    assert not os.path.exists(os.path.join(save_dir, "batch", "batch_job.json"))
+
+
+def test_batch_mode_sends_missing_rows_online(tmp_path, monkeypatch, write_csv, fake_llm, stub_server):
+    monkeypatch.chdir(tmp_path)
+    rng = random.Random(0)
+    base_url = stub_server(lambda request: echo_response(request, drop_rate=0.3, rng=rng))
+    save_dir = run_batch_mode(tmp_path, [write_csv("batch", 30)], base_url, fake_llm)
+
+    ids = question_ids(save_dir, "batch")
+    assert sorted(ids) == sorted(f"batch_{row}" for row in range(30))
+    # The rows dropped from the batch results were sent online
+    assert fake_llm.calls > 0
@@ -0,0 +1,51 @@
+import json
+import os
+
+import pytest
+
+from classification import Classifier
+from conftest import Killed
+
+
+def make_classifier(csv_files, save_dir, fake_llm, **kwargs):
+    classifier = Classifier(
+        model="gemini",
+        csv_files=csv_files,
+        save_dir=save_dir,
+        num_questions_samples=-1,
+        n_questions_per_request=10,
+        use_cache=False,
+        api_key="test",
+        **kwargs,
+    )
+    classifier.engine.base_delay = 0
+    classifier.model.aget_llm_responese = fake_llm
+    return classifier
+
+
+def question_ids(save_dir, src_iden):
+    with open(os.path.join(save_dir, f"{src_iden}.json"), "r", encoding="utf-8") as f:
+        return [row["questionID"] for row in json.load(f)]
+
+
+def test_resume_after_crash_before_first_checkpoint(tmp_path, monkeypatch, write_csv, fake_llm):
+    monkeypatch.chdir(tmp_path)
+    save_dir = str(tmp_path / "out")
+    os.makedirs(save_dir)
+    csv_files = [write_csv("in2", 300), write_csv("in3", 77)]
+
+    # Killed after 30 requests: their rows are written to the result stores,
+    # but no checkpoint saved the progress
+    classifier = make_classifier(csv_files, save_dir, fake_llm, checkpoint_interval=3600)
+    monkeypatch.setattr(classifier, "save_results", lambda progress, stores: [s.close() for s in stores.values()])
+    fake_llm.crash_after = 30
+    with pytest.raises(Killed):
+        classifier.run_classification()
+    assert os.path.getsize(classifier.store_path("in2")) + os.path.getsize(classifier.store_path("in3")) > 0
+
+    fake_llm.crash_after = None
+    make_classifier(csv_files, save_dir, fake_llm).run_classification()
+
+    for src_iden, n_rows in (("in2", 300), ("in3", 77)):
+        ids = question_ids(save_dir, src_iden)
+        assert len(ids) == len(set(ids)) == n_rows
@@ -0,0 +1,182 @@
+import csv
+import sqlite3
+import time
+from contextlib import contextmanager
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+def scan_csv(csv_path, unit_size=500):
+    """
+    Number of rows of a CSV file, and the byte offset of the first row of
+    every unit_size rows, so that a unit can be read without parsing the rows
+    before it. Rows are read with the csv module, quoted fields may span
+    several lines. Blank lines are skipped, as pandas does.
+    """
+    position = 0
+
+    def lines():
+        nonlocal position
+        with open(csv_path, "rb") as f:
+            for line in f:
+                position += len(line)
+                yield line.decode("utf-8-sig" if position == len(line) else "utf-8")
+
+    reader = csv.reader(lines())
+    next(reader, None)  # header
+    offsets = []
+    n_rows = 0
+    row_start = position
+    for row in reader:
+        if row:
+            if n_rows % unit_size == 0:
+                offsets.append(row_start)
+            n_rows += 1
+        row_start = position
+    return n_rows, offsets
+
+
+class WorkQueue:
+    """
+    Work units (row ranges of the input CSV files) and their status in a
+    SQLite database, shared by every worker: threads, processes, or other
+    machines that see the database file.
+
+    A worker claims a unit for lease_seconds, renews the lease with
+    heartbeat() while it works on it, and finishes it with complete() or
+    fail(). A unit whose lease ran out (its worker died) can be claimed again.
+    A failed unit goes back to pending until it failed max_attempts times.
+
+    The database uses SQLite's default rollback journal rather than WAL, which
+    doesn't work over network file systems. Several machines can share it on
+    a file system with working POSIX locks.
+
+    Example:
+        queue = WorkQueue("progress.db")
+        queue.add_file("file", "file.csv", n_rows=10_000, unit_size=500)
+        while (unit := queue.claim("worker-1")) is not None:
+            ...
+            queue.complete(unit["id"], "worker-1", result_path)
+    """
+
+    def __init__(self, path, max_attempts=3):
+        self.path = path
+        self.max_attempts = max_attempts
+        self._db = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS units ("
+            "id INTEGER PRIMARY KEY, src_iden TEXT NOT NULL, csv_path TEXT NOT NULL, "
+            "start_row INTEGER NOT NULL, end_row INTEGER NOT NULL, status TEXT NOT NULL, "
+            "worker TEXT, lease_until REAL, attempts INTEGER NOT NULL DEFAULT 0, "
+            "result_path TEXT, error TEXT, updated REAL, start_offset INTEGER, "
+            "UNIQUE (src_iden, start_row))"
+        )
+        # Queues created before start_offset was added
+        if "start_offset" not in [row["name"] for row in self._db.execute("PRAGMA table_info(units)")]:
+            self._db.execute("ALTER TABLE units ADD COLUMN start_offset INTEGER")
+        self._db.execute("CREATE INDEX IF NOT EXISTS units_status ON units (status)")
+
+    @contextmanager
+    def _transaction(self):
+        # BEGIN IMMEDIATE takes the write lock at once, so two workers can't
+        # claim the same unit
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        self._db.execute("COMMIT")
+
+    def add_file(self, src_iden, csv_path, n_rows, unit_size=500, offsets=None):
+        """
+        Add the units of a file, the ones already there are left as they are.
+        offsets are the byte offsets of the first row of each unit (see
+        scan_csv), None to read the units by skipping rows.
+        """
+        now = time.time()
+        starts = range(0, n_rows, unit_size)
+        offsets = offsets or [None] * len(starts)
+        with self._transaction():
+            self._db.executemany(
+                "INSERT OR IGNORE INTO units (src_iden, csv_path, start_row, end_row, status, updated, start_offset) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (src_iden, csv_path, start, min(start + unit_size, n_rows), PENDING, now, offset)
+                    for start, offset in zip(starts, offsets)
+                ],
+            )
+
+    def claim(self, worker, lease_seconds=600):
+        """Claim a pending unit, or one whose lease ran out. Returns it as a dict, or None when there is none."""
+        now = time.time()
+        with self._transaction():
+            row = self._db.execute(
+                "SELECT * FROM units WHERE status = ? OR (status = ? AND lease_until < ?) "
+                "ORDER BY src_iden, start_row LIMIT 1",
+                (PENDING, RUNNING, now),
+            ).fetchone()
+            if row is None:
+                return None
+            self._db.execute(
+                "UPDATE units SET status = ?, worker = ?, lease_until = ?, attempts = attempts + 1, updated = ? "
+                "WHERE id = ?",
+                (RUNNING, worker, now + lease_seconds, now, row["id"]),
+            )
+        unit = dict(row)
+        unit.update(status=RUNNING, worker=worker, attempts=unit["attempts"] + 1)
+        return unit
+
+    def heartbeat(self, unit_id, worker, lease_seconds=600):
+        """Renew the lease, returns False if the unit is no longer claimed by worker."""
+        now = time.time()
+        with self._transaction():
+            cursor = self._db.execute(
+                "UPDATE units SET lease_until = ?, updated = ? WHERE id = ? AND worker = ? AND status = ?",
+                (now + lease_seconds, now, unit_id, worker, RUNNING),
+            )
+        return cursor.rowcount == 1
+
+    def complete(self, unit_id, worker, result_path):
+        """Mark the unit done with its results at result_path, returns False if worker lost it."""
+        with self._transaction():
+            cursor = self._db.execute(
+                "UPDATE units SET status = ?, result_path = ?, lease_until = NULL, error = NULL, updated = ? "
+                "WHERE id = ? AND worker = ? AND status = ?",
+                (DONE, result_path, time.time(), unit_id, worker, RUNNING),
+            )
+        return cursor.rowcount == 1
+
+    def fail(self, unit_id, worker, error):
+        """Release the unit, to be claimed again unless it failed max_attempts times."""
+        with self._transaction():
+            self._db.execute(
+                "UPDATE units SET status = CASE WHEN attempts >= ? THEN ? ELSE ? END, "
+                "lease_until = NULL, error = ?, updated = ? WHERE id = ? AND worker = ? AND status = ?",
+                (self.max_attempts, FAILED, PENDING, str(error), time.time(), unit_id, worker, RUNNING),
+            )
+
+    def retry_failed(self):
+        """Put the failed units back to pending."""
+        with self._transaction():
+            self._db.execute("UPDATE units SET status = ?, attempts = 0 WHERE status = ?", (PENDING, FAILED))
+
+    def units(self, src_iden=None):
+        query, params = "SELECT * FROM units", ()
+        if src_iden is not None:
+            query, params = query + " WHERE src_iden = ?", (src_iden,)
+        return [dict(row) for row in self._db.execute(query + " ORDER BY src_iden, start_row", params)]
+
+    def status(self):
+        """Number of units by file and status."""
+        counts = {}
+        for row in self._db.execute("SELECT src_iden, status, COUNT(*) AS n FROM units GROUP BY src_iden, status"):
+            counts.setdefault(row["src_iden"], {})[row["status"]] = row["n"]
+        return counts
+
+    def close(self):
+        self._db.close()
@@ -0,0 +1,227 @@
+import argparse
+import json
+import os
+import random
+import string
+import subprocess
+import sys
+import time
+import unicodedata
+
+import numpy as np
+import pandas as pd
+
+from dedup_utils import remove_accents
+
+WORDS = [
+    "Bệnh", "nhân", "nam", "nữ", "tuổi", "đau", "bụng", "ngực", "đầu", "sốt", "cao", "ho", "khó", "thở",
+    "thuốc", "điều", "trị", "viêm", "gan", "phổi", "thận", "tim", "mạch", "huyết", "áp", "tiểu", "đường",
+    "xét", "nghiệm", "máu", "nước", "chẩn", "đoán", "triệu", "chứng", "kháng", "sinh", "liều", "dùng",
+    "trẻ", "em", "người", "lớn", "phẫu", "thuật", "cấp", "mạn", "tính", "nhiễm", "trùng", "suy", "giảm",
+    "tăng", "hội", "biến", "phòng", "ngừa", "tiêm", "chủng", "vắc", "xin", "siêu", "âm", "chụp", "cắt",
+    "lớp", "nội", "soi", "dạ", "dày", "tá", "tràng", "đại", "xơ", "vữa", "động", "tĩnh",
+]
+ONSETS = ["b", "c", "ch", "d", "đ", "g", "gi", "h", "k", "kh", "l", "m", "n", "ng", "nh", "ph", "qu", "r", "s", "t",
+          "th", "tr", "v", "x"]
+VOWELS = ["a", "ă", "â", "e", "ê", "i", "o", "ô", "ơ", "u", "ư", "y", "ia", "ua", "ươ", "iê", "uô"]
+# No tone, sắc, huyền, hỏi, ngã, nặng
+TONES = ["", "\u0301", "\u0300", "\u0309", "\u0303", "\u0323"]
+CODAS = ["", "c", "ch", "m", "n", "ng", "nh", "p", "t", "i", "o", "u"]
+TOPICS = ["Cardiology", "Neurology", "Pediatrics", "Gastroenterology", "Other(No Category)"]
+OPTION_COLUMNS = ["optionA", "optionB", "optionC", "optionD"]
+
+
+def make_vocabulary(n_words=5000, seed=0):
+    """
+    WORDS followed by n_words random Vietnamese-looking syllables, and the
+    cumulative Zipf weights to sample them with, so that the corpus has a
+    realistic number of distinct and of frequent words.
+    """
+    rng = random.Random(seed)
+    syllables = set()
+    while len(syllables) < n_words:
+        vowel = rng.choice(VOWELS)
+        vowel = unicodedata.normalize("NFC", vowel[0] + rng.choice(TONES) + vowel[1:])
+        syllables.add(rng.choice(ONSETS) + vowel + rng.choice(CODAS))
+    vocabulary = WORDS + sorted(syllables - set(WORDS))
+    cum_weights = np.cumsum(1 / np.arange(1, len(vocabulary) + 1)).tolist()
+    return vocabulary, cum_weights
+
+
+def _words(rng, vocabulary, k):
+    return " ".join(rng.choices(vocabulary[0], cum_weights=vocabulary[1], k=k))
+
+
+def _base_row(rng, vocabulary, bench_id):
+    question = f"Câu {rng.randint(1, 200)}: " + _words(rng, vocabulary, rng.randint(15, 40)) + "?"
+    row = {"question": question}
+    for col in OPTION_COLUMNS:
+        row[col] = _words(rng, vocabulary, rng.randint(2, 6))
+    row.update(optionE=None, optionF=None, optionG=None, medicalTopic=rng.choice(TOPICS))
+    row.update(bench_id=bench_id, bench_source_id=-1, bench_kind="original")
+    return row
+
+
+def _shuffle_options(rng, row):
+    options = [row[col] for col in OPTION_COLUMNS]
+    rng.shuffle(options)
+    row.update(zip(OPTION_COLUMNS, options))
+
+
+def _exact_variant(rng, row):
+    """Copy of row that is equal to it after normalization."""
+    row = dict(row)
+    question = row["question"]
+    if rng.random() < 0.5:
+        question = remove_accents(question)
+    if rng.random() < 0.5:
+        question = question.upper()
+    if rng.random() < 0.5:
+        question = "  " + question.replace(" ", "  ").replace("?", " ?!") + " "
+    row["question"] = question
+    _shuffle_options(rng, row)
+    return row
+
+
+def _near_variant(rng, row):
+    """Copy of row with one typo in the question, and half of the time another question number."""
+    row = dict(row)
+    prefix, text = row["question"].split(": ", 1)
+    positions = [i for i, c in enumerate(text) if c.isalpha()]
+    i = rng.choice(positions)
+    typo = rng.choice([c for c in string.ascii_lowercase if c != remove_accents(text[i]).lower()])
+    text = text[:i] + typo + text[i + 1:]
+    if rng.random() < 0.5:
+        prefix = f"Câu {rng.randint(201, 400)}"
+    row["question"] = f"{prefix}: {text}"
+    _shuffle_options(rng, row)
+    return row
+
+
+def generate_corpus(n_rows, exact_rate=0.05, near_rate=0.05, seed=0):
+    """
+    Synthetic Vietnamese MCQ corpus of n_rows rows, in the input format of
+    deduplication.py. A share exact_rate of the rows are exact duplicates of
+    an original question (accents, case, spacing, punctuation and option
+    order changed), near_rate are near duplicates (one typo, option order
+    changed and, for half of them, another question number).
+
+    Ground truth columns: bench_id (row position), bench_source_id (bench_id
+    of the original question, -1 for originals) and bench_kind (original,
+    exact or near). Every duplicate comes after its original.
+    """
+    rng = random.Random(seed)
+    n_exact, n_near = int(n_rows * exact_rate), int(n_rows * near_rate)
+    n_original = n_rows - n_exact - n_near
+
+    vocabulary = make_vocabulary(seed=seed)
+    originals = [_base_row(rng, vocabulary, i) for i in range(n_original)]
+    rows = [(i, row) for i, row in enumerate(originals)]
+    for kind, n, make_variant in (("exact", n_exact, _exact_variant), ("near", n_near, _near_variant)):
+        for _ in range(n):
+            source = rng.randrange(n_original)
+            row = make_variant(rng, originals[source])
+            row.update(bench_source_id=source, bench_kind=kind)
+            # Sort key between the original and the end of the corpus
+            rows.append((rng.uniform(source, n_original), row))
+
+    rows.sort(key=lambda item: item[0])
+    df = pd.DataFrame([row for _, row in rows])
+    # bench_source_id of the duplicates is the position of the original
+    position = np.empty(n_rows, dtype=np.int64)
+    is_original = (df["bench_kind"] == "original").to_numpy()
+    position[df.loc[is_original, "bench_id"].to_numpy()] = np.flatnonzero(is_original)
+    df.loc[~is_original, "bench_source_id"] = position[df.loc[~is_original, "bench_source_id"].to_numpy()]
+    df["bench_id"] = np.arange(n_rows)
+    return df
+
+
+def precision_recall(removed, truth):
+    true_positives = len(removed & truth)
+    return {
+        "precision": true_positives / len(removed) if removed else 1.0,
+        "recall": true_positives / len(truth) if truth else 1.0,
+    }
+
+
+def evaluate(corpus, work_dir):
+    """
+    Precision and recall of the rows removed in dedup_v1 (against the
+    injected exact duplicates) and dedup_v2 (against all injected
+    duplicates). Assumes the default lowest_index representative, so the
+    original of every cluster is the row that is kept.
+    """
+    all_ids = set(corpus["bench_id"])
+    exact = set(corpus.loc[corpus["bench_kind"] == "exact", "bench_id"])
+    near = set(corpus.loc[corpus["bench_kind"] == "near", "bench_id"])
+    removed_v1 = all_ids - set(pd.read_csv(os.path.join(work_dir, "dedup_v1.csv"), usecols=["bench_id"])["bench_id"])
+    removed_v2 = all_ids - set(pd.read_csv(os.path.join(work_dir, "dedup_v2.csv"), usecols=["bench_id"])["bench_id"])
+    return {
+        "exact": precision_recall(removed_v1, exact),
+        "near": precision_recall(removed_v2 - removed_v1, near),
+        "all": precision_recall(removed_v2, exact | near),
+    }
+
+
+def run_size(n_rows, args, dedup_args):
+    work_dir = os.path.join(args.work_dir, str(n_rows))
+    os.makedirs(work_dir, exist_ok=True)
+    input_path = os.path.join(work_dir, "input.csv")
+    stats_path = os.path.join(work_dir, "stats.json")
+
+    start = time.perf_counter()
+    corpus = generate_corpus(n_rows, exact_rate=args.exact_rate, near_rate=args.near_rate, seed=args.seed)
+    corpus.to_csv(input_path, index=False)
+    generate_time = time.perf_counter() - start
+
+    # Every size runs in its own process so that peak RSS is not carried over
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "deduplication.py")
+    subprocess.run(
+        [sys.executable, script, "--input_path", "input.csv", "--stats_path", "stats.json", *dedup_args],
+        cwd=work_dir, check=True,
+    )
+    with open(stats_path, "r", encoding="utf-8") as f:
+        stats = json.load(f)
+
+    result = {
+        "n_rows": n_rows,
+        "n_exact_injected": int((corpus["bench_kind"] == "exact").sum()),
+        "n_near_injected": int((corpus["bench_kind"] == "near").sum()),
+        "generate_seconds": generate_time,
+        **stats,
+        "metrics": evaluate(corpus, work_dir),
+    }
+    print(
+        f"{n_rows} rows: {stats['total_seconds']:.1f}s, peak RSS {stats['peak_rss_mb']:.0f} MB, "
+        + ", ".join(f"{stage['name']} {stage['seconds']:.1f}s" for stage in stats["stages"])
+    )
+    print("  " + ", ".join(
+        f"{kind} precision {m['precision']:.3f} recall {m['recall']:.3f}" for kind, m in result["metrics"].items()
+    ))
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark deduplication.py on synthetic corpora with injected duplicates. Arguments that are "
+                    "not listed here are passed on to deduplication.py.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000],
+                        help="Number of rows of each corpus")
+    parser.add_argument("--exact_rate", type=float, default=0.05, help="Share of injected exact duplicates")
+    parser.add_argument("--near_rate", type=float, default=0.05, help="Share of injected near duplicates")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the corpus generator")
+    parser.add_argument("--work_dir", default="bench", help="Directory for the corpora and outputs")
+    parser.add_argument("--output_path", default="bench_results.json", help="JSON file to save the results to")
+    args, dedup_args = parser.parse_known_args()
+
+    results = [run_size(n_rows, args, dedup_args) for n_rows in args.sizes]
+    with open(args.output_path, "w", encoding="utf-8") as f:
+        json.dump({
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "dedup_args": dedup_args,
+            "exact_rate": args.exact_rate,
+            "near_rate": args.near_rate,
+            "seed": args.seed,
+            "results": results,
+        }, f, indent=2)
+    print(f"Saved results to {args.output_path}")
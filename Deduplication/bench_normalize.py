@@ -0,0 +1,43 @@
+import argparse
+import random
+import time
+
+import pandas as pd
+
+from dedup_utils import normalize_vietnamese, normalize_vietnamese_column
+
+WORDS = [
+    "Bệnh", "nhân", "nam", "tuổi", "đau", "bụng", "sốt", "cao", "thuốc", "điều", "trị",
+    "viêm", "gan", "phổi", "tim", "mạch", "huyết", "áp", "tiểu", "đường", "xét", "nghiệm",
+    "máu", "chẩn", "đoán", "triệu", "chứng", "kháng", "sinh", "liều", "dùng", "Đâu", "là",
+]
+
+
+def make_column(n_rows, seed=0):
+    rng = random.Random(seed)
+    return pd.Series([
+        f"Câu {rng.randint(1, 200)}: " + " ".join(rng.choices(WORDS, k=rng.randint(5, 40))) + "?"
+        for _ in range(n_rows)
+    ])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare normalize_vietnamese with normalize_vietnamese_column.")
+    parser.add_argument("--n_rows", type=int, default=1_000_000, help="Number of rows in the column")
+    parser.add_argument("--n_workers", type=int, default=1, help="Number of processes for the batch normalizer")
+    args = parser.parse_args()
+
+    column = make_column(args.n_rows)
+
+    start = time.perf_counter()
+    expected = column.apply(normalize_vietnamese)
+    apply_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    result = normalize_vietnamese_column(column, n_workers=args.n_workers)
+    column_time = time.perf_counter() - start
+
+    assert expected.tolist() == result.tolist(), "normalize_vietnamese_column output differs"
+    print(f"apply:  {apply_time:.2f}s")
+    print(f"column: {column_time:.2f}s (n_workers={args.n_workers})")
+    print(f"speedup: {apply_time / column_time:.1f}x")
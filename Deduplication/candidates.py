@@ -0,0 +1,287 @@
+from multiprocessing import Pool
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from sklearn.feature_extraction.text import CountVectorizer
+
+from tqdm.auto import tqdm
+
+# Mersenne prime used for the universal hash family (a * x + b) mod p
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+
+# State of a block scanning worker, set once by _init_block_worker
+_worker = {}
+
+
+def _dense_block_pairs(X, idx_start, block_size, epsilon1, epsilon2, top_k=None):
+    dist_matrix = 1 - X[idx_start:idx_start + block_size, :].dot(X.T).toarray()
+    dup_idx_pairs = np.argwhere(dist_matrix < epsilon1) + [idx_start, 0]
+    near_dup_idx_pairs = np.argwhere((dist_matrix < epsilon2) & (dist_matrix >= epsilon1)) + [idx_start, 0]
+    return dup_idx_pairs, near_dup_idx_pairs
+
+
+def _sparse_block_pairs(X, idx_start, block_size, epsilon1, epsilon2, top_k=None):
+    sim = X[idx_start:idx_start + block_size, :].dot(X.T).tocoo()
+
+    # Entries that are not stored have distance 1, they never pass epsilon2
+    dist = 1 - sim.data
+    keep = dist < epsilon2
+    rows, cols, dist = sim.row[keep].astype(np.int64) + idx_start, sim.col[keep].astype(np.int64), dist[keep]
+
+    is_dup = dist < epsilon1
+    dup_idx_pairs = np.stack([rows[is_dup], cols[is_dup]], axis=1)
+
+    rows, cols, dist = rows[~is_dup], cols[~is_dup], dist[~is_dup]
+    not_self = rows != cols
+    rows, cols, dist = rows[not_self], cols[not_self], dist[not_self]
+    if top_k is not None and len(rows):
+        # Rank the candidates of each row by distance, closest first
+        order = np.lexsort((cols, dist, rows))
+        rows, cols = rows[order], cols[order]
+        row_starts = np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]])
+        rank = np.arange(len(rows)) - np.repeat(row_starts, np.diff(np.r_[row_starts, len(rows)]))
+        rows, cols = rows[rank < top_k], cols[rank < top_k]
+    near_dup_idx_pairs = np.stack([rows, cols], axis=1)
+    return dup_idx_pairs, near_dup_idx_pairs
+
+
+def _merge_block_pairs(block_pairs):
+    """
+    Merge the per-block (dup_pairs, near_dup_pairs) of a scan. Exact
+    duplicates are returned once as (i, j), i < j. Near duplicates keep both
+    directions in the row-major order of the dense scan, the greedy removal
+    depends on it.
+    """
+    all_dup_idx_pairs = np.concatenate([np.reshape(dup, (-1, 2)) for dup, _ in block_pairs], axis=0).astype(np.int64)
+    all_dup_idx_pairs = all_dup_idx_pairs[all_dup_idx_pairs[:, 0] < all_dup_idx_pairs[:, 1]]
+    all_dup_idx_pairs = np.unique(all_dup_idx_pairs, axis=0)
+
+    all_near_dup_idx_pairs = np.concatenate([np.reshape(near, (-1, 2)) for _, near in block_pairs], axis=0).astype(np.int64)
+    all_near_dup_idx_pairs = all_near_dup_idx_pairs[all_near_dup_idx_pairs[:, 0] != all_near_dup_idx_pairs[:, 1]]
+    all_near_dup_idx_pairs = all_near_dup_idx_pairs[
+        np.lexsort((all_near_dup_idx_pairs[:, 1], all_near_dup_idx_pairs[:, 0]))
+    ]
+
+    return all_dup_idx_pairs, all_near_dup_idx_pairs
+
+
+def _block_starts(n_rows, block_size, row_start=0):
+    return [row_start + i * block_size for i in range((n_rows - row_start) // block_size + 1)]
+
+
+def tfidf_block_pairs(X, epsilon1, epsilon2, block_size=2000, row_start=0):
+    """
+    Compare every row of the TF-IDF matrix X against all rows, one block of
+    rows at a time, and return (dup_pairs, near_dup_pairs).
+
+    dup_pairs holds (i, j) with i < j whose cosine distance is below epsilon1,
+    near_dup_pairs holds (i, j) whose distance is in [epsilon1, epsilon2).
+    Only rows from row_start on are compared, against all rows of X.
+    """
+    return _merge_block_pairs([
+        _dense_block_pairs(X, idx_start, block_size, epsilon1, epsilon2)
+        for idx_start in tqdm(_block_starts(X.shape[0], block_size, row_start))
+    ])
+
+
+def tfidf_sparse_pairs(X, epsilon1, epsilon2, block_size=2000, top_k=None, row_start=0):
+    """
+    Same output as tfidf_block_pairs, but each block product X_block . X^T
+    stays sparse and is thresholded right away, so peak memory is bounded by
+    the number of similar pairs instead of block_size * N.
+
+    If top_k is given, each row keeps only its top_k most similar near
+    duplicates. Exact duplicates are always kept.
+    """
+    return _merge_block_pairs([
+        _sparse_block_pairs(X, idx_start, block_size, epsilon1, epsilon2, top_k)
+        for idx_start in tqdm(_block_starts(X.shape[0], block_size, row_start))
+    ])
+
+
+def _init_block_worker(shared_specs, shape, scan_kwargs):
+    buffers = {}
+    arrays = {}
+    for key, (name, length, dtype) in shared_specs.items():
+        buffers[key] = SharedMemory(name=name)
+        arrays[key] = np.ndarray((length,), dtype=dtype, buffer=buffers[key].buf)
+    # The matrix is a view on the shared buffers, nothing is copied
+    _worker["buffers"] = buffers
+    _worker["X"] = csr_matrix((arrays["data"], arrays["indices"], arrays["indptr"]), shape=shape, copy=False)
+    _worker.update(scan_kwargs)
+
+
+def _scan_block_range(block_starts):
+    scan_block = _sparse_block_pairs if _worker["scan"] == "sparse" else _dense_block_pairs
+    return [
+        scan_block(_worker["X"], idx_start, _worker["block_size"], _worker["epsilon1"], _worker["epsilon2"],
+                   _worker["top_k"])
+        for idx_start in block_starts
+    ]
+
+
+def parallel_tfidf_pairs(X, epsilon1, epsilon2, block_size=2000, top_k=None, n_workers=4, scan="sparse",
+                         blocks_per_task=4, row_start=0):
+    """
+    Run tfidf_sparse_pairs (scan="sparse") or tfidf_block_pairs
+    (scan="dense") on a process pool. The CSR arrays of X are placed in shared
+    memory once, and every task scans a disjoint range of row blocks. Results
+    are merged in block order, so the output is identical to a serial run.
+    """
+    X = csr_matrix(X)
+    block_starts = _block_starts(X.shape[0], block_size, row_start)
+    block_ranges = [block_starts[i:i + blocks_per_task] for i in range(0, len(block_starts), blocks_per_task)]
+
+    shared = {}
+    try:
+        shared_specs = {}
+        for key in ("data", "indices", "indptr"):
+            array = getattr(X, key)
+            shared[key] = SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, dtype=array.dtype, buffer=shared[key].buf)[:] = array
+            shared_specs[key] = (shared[key].name, len(array), array.dtype.str)
+
+        scan_kwargs = dict(scan=scan, block_size=block_size, epsilon1=epsilon1, epsilon2=epsilon2, top_k=top_k)
+        block_pairs = []
+        with Pool(n_workers, initializer=_init_block_worker, initargs=(shared_specs, X.shape, scan_kwargs)) as pool:
+            for range_pairs in tqdm(pool.imap(_scan_block_range, block_ranges), total=len(block_ranges)):
+                block_pairs.extend(range_pairs)
+    finally:
+        for buffer in shared.values():
+            buffer.close()
+            buffer.unlink()
+
+    return _merge_block_pairs(block_pairs)
+
+
+def minhash_signatures(texts, num_perm=128, shingle_size=1, seed=42, chunk_size=100_000):
+    """
+    Compute a (len(texts), num_perm) uint32 MinHash signature matrix over the
+    word shingles of each text. Rows without any shingle are filled with the
+    max hash value so they never collide with real documents.
+    """
+    try:
+        shingles = CountVectorizer(
+            analyzer="word",
+            lowercase=False,
+            token_pattern=r"(?u)\b\w+\b",
+            ngram_range=(shingle_size, shingle_size),
+            binary=True,
+            dtype=np.uint8,
+        ).fit_transform(texts).tocsr()
+    except ValueError:
+        # Empty vocabulary: no text has a shingle (or there are no texts)
+        return np.full((len(texts), num_perm), _MAX_HASH, dtype=np.uint32)
+
+    rng = np.random.RandomState(seed)
+    a = rng.randint(1, 1 << 31, size=num_perm).astype(np.uint64)
+    b = rng.randint(0, 1 << 31, size=num_perm).astype(np.uint64)
+
+    n_rows = shingles.shape[0]
+    indptr = shingles.indptr
+    indices = shingles.indices.astype(np.uint64)
+    signatures = np.full((n_rows, num_perm), _MAX_HASH, dtype=np.uint32)
+
+    # Process rows in chunks so that the (n_shingles, num_perm) hash matrix
+    # stays bounded in memory
+    row_start = 0
+    while row_start < n_rows:
+        row_end = int(np.searchsorted(indptr, indptr[row_start] + chunk_size, side="right")) - 1
+        row_end = min(max(row_end, row_start + 1), n_rows)
+        lo, hi = indptr[row_start], indptr[row_end]
+        if hi > lo:
+            hashes = ((indices[lo:hi, None] * a + b) % _MERSENNE_PRIME) & _MAX_HASH
+            offsets = indptr[row_start:row_end] - lo
+            non_empty = np.diff(indptr[row_start:row_end + 1]) > 0
+            mins = np.minimum.reduceat(hashes, offsets[non_empty], axis=0)
+            signatures[row_start:row_end][non_empty] = mins.astype(np.uint32)
+        row_start = row_end
+
+    return signatures
+
+
+def _bucket_pairs(members, bucket_starts, max_bucket_size):
+    """
+    Pairs (members[p], members[q]), p < q, of the rows of each bucket, where
+    members is sorted by bucket and bucket_starts holds the offset of each
+    bucket. A bucket of m rows gives m * (m - 1) / 2 pairs, so a bucket of
+    more than max_bucket_size rows only pairs its first row with the others.
+    """
+    sizes = np.diff(np.r_[bucket_starts, len(members)])
+    bucket_of = np.repeat(np.arange(len(sizes)), sizes)
+    positions = np.arange(len(members))
+    starts, sizes = bucket_starts[bucket_of], sizes[bucket_of]
+    # Number of rows after each row of its bucket that it is paired with
+    n_after = np.where(
+        sizes > max_bucket_size,
+        np.where(positions == starts, sizes - 1, 0),
+        starts + sizes - positions - 1,
+    )
+    left = np.repeat(positions, n_after)
+    right = left + 1 + np.arange(len(left)) - np.repeat(np.cumsum(n_after) - n_after, n_after)
+    return np.stack([members[left], members[right]], axis=1)
+
+
+def lsh_candidate_pairs(signatures, bands=32, max_bucket_size=1000):
+    """
+    Banded LSH over a MinHash signature matrix. Every pair of rows that share
+    all hash values of at least one band is returned once as (i, j), i < j,
+    sorted lexicographically.
+
+    Buckets of more than max_bucket_size rows (e.g. many copies of a
+    template) only pair their first row with the others, which keeps them
+    connected without emitting all their pairs.
+    """
+    n_rows, num_perm = signatures.shape
+    assert num_perm % bands == 0, f"num_perm={num_perm} must be divisible by bands={bands}"
+    rows_per_band = num_perm // bands
+    valid = signatures[:, 0] != _MAX_HASH
+    if not valid.any():
+        return np.empty((0, 2), dtype=np.int64)
+
+    all_pairs = []
+    for band in range(bands):
+        band_sig = np.ascontiguousarray(signatures[valid, band * rows_per_band:(band + 1) * rows_per_band])
+        band_keys = band_sig.view(np.dtype((np.void, band_sig.dtype.itemsize * rows_per_band))).ravel()
+        _, bucket_ids, bucket_sizes = np.unique(band_keys, return_inverse=True, return_counts=True)
+
+        # Only rows that land in a bucket with at least one other row matter
+        in_shared_bucket = bucket_sizes[bucket_ids] > 1
+        members = np.flatnonzero(valid)[in_shared_bucket]
+        member_buckets = bucket_ids[in_shared_bucket]
+        order = np.argsort(member_buckets, kind="stable")
+        members, member_buckets = members[order], member_buckets[order]
+
+        bucket_starts = np.flatnonzero(np.r_[True, member_buckets[1:] != member_buckets[:-1]])
+        if len(members):
+            all_pairs.append(_bucket_pairs(members, bucket_starts, max_bucket_size))
+
+    if not all_pairs:
+        return np.empty((0, 2), dtype=np.int64)
+    return np.unique(np.concatenate(all_pairs, axis=0), axis=0)
+
+
+def minhash_pairs(texts, num_perm=128, bands=32, shingle_size=1, min_similarity=0.0, seed=42, max_bucket_size=1000):
+    """
+    Generate candidate pairs with MinHash + LSH instead of the all-pairs
+    TF-IDF scan, and return (dup_pairs, near_dup_pairs) with the same layout
+    as tfidf_block_pairs. Pairs whose normalized texts are equal are treated
+    as exact duplicates, the rest as near duplicates to be verified.
+
+    min_similarity drops candidates whose estimated Jaccard similarity (share
+    of equal signature values) is below the given value, max_bucket_size
+    bounds the pairs of a LSH bucket (see lsh_candidate_pairs).
+    """
+    texts = np.asarray(texts, dtype=object)
+    signatures = minhash_signatures(texts, num_perm=num_perm, shingle_size=shingle_size, seed=seed)
+    pairs = lsh_candidate_pairs(signatures, bands=bands, max_bucket_size=max_bucket_size)
+
+    if min_similarity > 0 and len(pairs):
+        similarity = (signatures[pairs[:, 0]] == signatures[pairs[:, 1]]).mean(axis=1)
+        pairs = pairs[similarity >= min_similarity]
+
+    is_exact = texts[pairs[:, 0]] == texts[pairs[:, 1]]
+    return pairs[is_exact], pairs[~is_exact]
@@ -0,0 +1,79 @@
+import numpy as np
+
+REPRESENTATIVE_RULES = ["lowest_index", "most_filled", "longest_question"]
+
+
+class UnionFind:
+    """Disjoint sets over the rows 0..n-1."""
+
+    def __init__(self, n):
+        self.parent = np.arange(n)
+
+    def find(self, x):
+        root = x
+        while self.parent[root] != root:
+            root = self.parent[root]
+        # Path compression
+        while self.parent[x] != root:
+            self.parent[x], x = root, self.parent[x]
+        return root
+
+    def union(self, a, b):
+        root_a, root_b = self.find(a), self.find(b)
+        if root_a != root_b:
+            self.parent[max(root_a, root_b)] = min(root_a, root_b)
+
+    def labels(self):
+        """Root of every row, the root being the lowest row of its set."""
+        labels = self.parent.copy()
+        while True:
+            # Pointer jumping until every row points at its root
+            next_labels = labels[labels]
+            if np.array_equal(next_labels, labels):
+                return labels
+            labels = next_labels
+
+
+def cluster_labels(n, pairs):
+    """Connected components of the graph on rows 0..n-1 whose edges are pairs."""
+    union_find = UnionFind(n)
+    for i, j in pairs:
+        union_find.union(i, j)
+    return union_find.labels()
+
+
+def representative_keys(df, rule):
+    """
+    Sort keys of the rows of df for the given rule, the row with the lowest
+    keys of a cluster is kept. Ties always go to the lowest index.
+
+    - lowest_index: first row of the cluster
+    - most_filled: row with the most non-empty fields
+    - longest_question: row with the longest question text
+    """
+    if rule == "lowest_index":
+        return []
+    if rule == "most_filled":
+        filled = df.notna() & (df.astype(str).apply(lambda col: col.str.strip()) != "")
+        return [-filled.sum(axis=1).to_numpy()]
+    if rule == "longest_question":
+        return [-df["question"].fillna("").astype(str).str.len().to_numpy()]
+    raise ValueError(f"Unknown representative rule: {rule}")
+
+
+def pick_representatives(labels, keys=()):
+    """
+    Return, for every row, the row that represents its cluster: the member
+    with the lowest keys, then the lowest index.
+    """
+    labels = np.asarray(labels, dtype=np.int64)
+    if not len(labels):
+        return labels
+    rows = np.arange(len(labels))
+    order = np.lexsort((rows, *reversed([np.asarray(key) for key in keys]), labels))
+    sorted_labels = labels[order]
+    is_first = np.r_[True, sorted_labels[1:] != sorted_labels[:-1]]
+
+    representative_of_label = np.empty(labels.max() + 1, dtype=np.int64)
+    representative_of_label[sorted_labels[is_first]] = order[is_first]
+    return representative_of_label[labels]
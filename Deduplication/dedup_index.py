@@ -0,0 +1,109 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import load_npz, save_npz, vstack
+
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+VECTORS_FILE = "vectors.npz"
+ARRAYS_FILE = "index.npz"
+SIDECAR_FILE = "index.json"
+ACCEPTED_FILE = "accepted.csv"
+
+
+class DedupIndex:
+    """
+    Persisted state of previous deduplication runs, so that a new batch only
+    has to be compared against it instead of re-running on the whole corpus.
+
+    Rows are identified by their row id: the position of the row in all the
+    input batches seen so far, in order.
+
+    - vectorizer: TF-IDF vocabulary and IDF fitted on the first batch
+    - vectors: TF-IDF vectors of the questions accepted in dedup_v2
+    - normalized: normalized question and options of those questions
+    - row_ids: row id of those questions
+    - hashes: row_hash of every question accepted in dedup_v1
+    - hash_cluster_ids: cluster_id of the question of every hash
+    - n_seen: number of input rows seen so far
+    - n_dedup_v3: number of rows written to dedup_v3, to continue dedup_v3_id
+    """
+
+    def __init__(self, vectorizer, vectors, normalized, row_ids, hashes, hash_cluster_ids, n_seen, n_dedup_v3=0):
+        self.vectorizer = vectorizer
+        self.vectors = vectors
+        self.normalized = normalized
+        self.row_ids = row_ids
+        self.hashes = hashes
+        self.hash_cluster_ids = hash_cluster_ids
+        self.n_seen = n_seen
+        self.n_dedup_v3 = n_dedup_v3
+
+    @property
+    def n_rows(self):
+        return self.vectors.shape[0]
+
+    @classmethod
+    def exists(cls, index_dir):
+        return os.path.isfile(os.path.join(index_dir, SIDECAR_FILE))
+
+    @classmethod
+    def load(cls, index_dir):
+        with open(os.path.join(index_dir, SIDECAR_FILE), "r", encoding="utf-8") as f:
+            sidecar = json.load(f)
+        arrays = np.load(os.path.join(index_dir, ARRAYS_FILE))
+
+        params = sidecar["vectorizer_params"]
+        params["ngram_range"] = tuple(params["ngram_range"])
+        vectorizer = TfidfVectorizer(**params, vocabulary=sidecar["vocabulary"])
+        vectorizer.idf_ = arrays["idf"]
+
+        return cls(
+            vectorizer=vectorizer,
+            vectors=load_npz(os.path.join(index_dir, VECTORS_FILE)).tocsr(),
+            normalized=pd.read_csv(os.path.join(index_dir, ACCEPTED_FILE), keep_default_na=False, dtype=str),
+            row_ids=arrays["row_ids"],
+            hashes=arrays["hashes"],
+            hash_cluster_ids=arrays["hash_cluster_ids"],
+            n_seen=sidecar["n_seen"],
+            n_dedup_v3=sidecar["n_dedup_v3"],
+        )
+
+    def save(self, index_dir):
+        os.makedirs(index_dir, exist_ok=True)
+        params = self.vectorizer.get_params()
+        sidecar = {
+            "vectorizer_params": {
+                key: params[key] for key in ("analyzer", "lowercase", "ngram_range", "min_df", "max_df")
+            },
+            "vocabulary": {term: int(col) for term, col in self.vectorizer.vocabulary_.items()},
+            "n_rows": self.n_rows,
+            "n_seen": self.n_seen,
+            "n_dedup_v3": self.n_dedup_v3,
+        }
+
+        save_npz(os.path.join(index_dir, VECTORS_FILE), self.vectors)
+        np.savez(
+            os.path.join(index_dir, ARRAYS_FILE),
+            idf=self.vectorizer.idf_,
+            row_ids=self.row_ids,
+            hashes=self.hashes,
+            hash_cluster_ids=self.hash_cluster_ids,
+        )
+        self.normalized.to_csv(os.path.join(index_dir, ACCEPTED_FILE), index=False)
+        with open(os.path.join(index_dir, SIDECAR_FILE), "w", encoding="utf-8") as f:
+            json.dump(sidecar, f, ensure_ascii=False)
+
+    def extend(self, vectors, normalized, row_ids, hashes, hash_cluster_ids, n_seen, n_dedup_v3):
+        """Add the questions accepted in a new batch of n_seen rows."""
+        self.vectors = vstack([self.vectors, vectors]).tocsr()
+        self.normalized = pd.concat([self.normalized, normalized], ignore_index=True)
+        self.row_ids = np.concatenate([self.row_ids, row_ids])
+        # New hashes are never in the index already, those rows were exact
+        # duplicates
+        self.hashes = np.concatenate([self.hashes, hashes])
+        self.hash_cluster_ids = np.concatenate([self.hash_cluster_ids, hash_cluster_ids])
+        self.n_seen += n_seen
+        self.n_dedup_v3 += n_dedup_v3
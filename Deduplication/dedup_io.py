@@ -0,0 +1,75 @@
+import os
+
+import pandas as pd
+
+PARQUET_SUFFIXES = (".parquet", ".pq")
+
+
+def is_parquet(path):
+    return str(path).lower().endswith(PARQUET_SUFFIXES)
+
+
+def read_chunks(path, chunk_size=100_000, columns=None):
+    """
+    Yield the rows of a CSV or Parquet file as DataFrames of at most
+    chunk_size rows, so that the whole file is never loaded at once. CSV
+    values are read as strings, missing values are NaN.
+    """
+    if is_parquet(path):
+        import pyarrow.parquet as pq
+
+        parquet_file = pq.ParquetFile(path)
+        for batch in parquet_file.iter_batches(batch_size=chunk_size, columns=columns):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(path, chunksize=chunk_size, usecols=columns, dtype=str)
+
+
+class TableWriter:
+    """
+    Write DataFrames one chunk after the other to a CSV or Parquet file. With
+    append=True, CSV rows are added below the rows already in path. Parquet
+    files can't be appended to.
+    """
+
+    def __init__(self, path, append=False):
+        self.path = path
+        self.parquet = is_parquet(path)
+        if self.parquet and append:
+            raise ValueError(f"Can't append to the Parquet file {path}")
+        self.header = not (append and os.path.exists(path))
+        self.mode = "a" if append else "w"
+        self.parquet_writer = None
+
+    def write(self, df):
+        if self.parquet:
+            self._write_parquet(df)
+        else:
+            df.to_csv(self.path, mode=self.mode, header=self.header, index=False)
+            self.header = False
+            self.mode = "a"
+
+    def _write_parquet(self, df):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if self.parquet_writer is None:
+            # Columns that are empty in the first chunk are typed as null,
+            # they are written as strings instead
+            schema = pa.Schema.from_pandas(df, preserve_index=False)
+            schema = pa.schema([
+                field.with_type(pa.string()) if pa.types.is_null(field.type) else field for field in schema
+            ])
+            self.parquet_writer = pq.ParquetWriter(self.path, schema)
+        table = pa.Table.from_pandas(df, schema=self.parquet_writer.schema, preserve_index=False)
+        self.parquet_writer.write_table(table)
+
+    def close(self):
+        if self.parquet_writer is not None:
+            self.parquet_writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -1,5 +1,9 @@
+import hashlib
 import re
 import unicodedata
+from multiprocessing import Pool
+
+import pandas as pd
 
 def remove_accents(text):
     """
@@ -35,6 +39,81 @@ def normalize_vietnamese(text):
     
     return text
 
+# Non-ASCII whitespace would be lost when encoding to ASCII, map it to ' '
+_NON_ASCII_SPACES = re.compile("[" + re.escape("".join(c for c in map(chr, range(0x80, 0x3001)) if c.isspace())) + "]")
+# ASCII characters normalize_vietnamese removes, the column separator \x00 is kept
+_REMOVED_BYTES = bytes(b for b in range(0x80) if not (chr(b).isalnum() or chr(b).isspace() or b == 0))
+# Precomputed byte tables: ASCII whitespace that bytes.split() does not know
+# about is mapped to ' '
+_SPACE_BYTES = bytes.maketrans(b"\x1c\x1d\x1e\x1f", b"    ")
+
+
+def _normalize_texts(texts):
+    """
+    normalize_vietnamese for a list of strings, run on the whole list joined
+    by \x00. After NFD and the đ/Đ mapping, everything that is kept is ASCII,
+    so accents, special characters and case are handled by one encode and
+    one bytes.translate instead of a regex pass per value.
+    """
+    joined = unicodedata.normalize("NFD", "\x00".join(texts)).replace("đ", "d").replace("Đ", "D")
+    joined = _NON_ASCII_SPACES.sub(" ", joined)
+    joined = joined.encode("ascii", "ignore").translate(_SPACE_BYTES, _REMOVED_BYTES).lower()
+
+    # Collapse spaces and strip every value
+    joined = b" ".join(joined.split()).replace(b" \x00", b"\x00").replace(b"\x00 ", b"\x00")
+    return joined.decode("ascii").split("\x00")
+
+
+def normalize_vietnamese_column(values, n_workers=1, chunk_size=100_000):
+    """
+    Batch version of normalize_vietnamese for a whole column (pandas Series,
+    pyarrow array or list). Gives the same output as applying
+    normalize_vietnamese to every value, non-string values are kept as is.
+    Chunks are spread over n_workers processes when n_workers > 1.
+    """
+    index = values.index if isinstance(values, pd.Series) else None
+    if hasattr(values, "to_pylist"):
+        values = values.to_pylist()
+    elif hasattr(values, "tolist"):
+        values = values.tolist()
+    else:
+        values = list(values)
+    result = list(values)
+
+    # Strings that contain the separator itself take the slow path
+    positions = []
+    for i, value in enumerate(values):
+        if isinstance(value, str):
+            if "\x00" in value:
+                result[i] = normalize_vietnamese(value)
+            else:
+                positions.append(i)
+
+    texts = [values[i] for i in positions]
+    chunks = [texts[i:i + chunk_size] for i in range(0, len(texts), chunk_size)]
+    if n_workers > 1 and len(chunks) > 1:
+        with Pool(n_workers) as pool:
+            normalized_chunks = pool.map(_normalize_texts, chunks)
+    else:
+        normalized_chunks = [_normalize_texts(chunk) for chunk in chunks]
+
+    for i, text in zip(positions, (text for chunk in normalized_chunks for text in chunk)):
+        result[i] = text
+
+    return pd.Series(result, index=index, dtype=object)
+
+
+def row_hash(values):
+    """
+    Canonical 64-bit hash of a normalized question and its options, the
+    options are sorted so their order does not matter.
+    Example: row_hash(["q", "oa", "ob", ...])
+    """
+    question, *options = values
+    digest = hashlib.blake2b("\x1f".join([question, *sorted(options)]).encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little", signed=True)
+
+
 def rm_cau(text):
     return re.sub(r'cau \d+', '', text).strip()
 
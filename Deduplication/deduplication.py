@@ -6,124 +6,365 @@ from pathlib import Path
 
 from sklearn.feature_extraction.text import TfidfVectorizer
 
-from tqdm.auto import tqdm
+from scipy.sparse import vstack
 
-import re
-from thefuzz import fuzz, process
-
-from dedup_utils import normalize_vietnamese, rm_cau
+from dedup_utils import normalize_vietnamese_column, row_hash
+from dedup_io import TableWriter, read_chunks
+from dedup_index import DedupIndex
+from verification import verify_near_dup_pairs
+from clustering import REPRESENTATIVE_RULES, cluster_labels, pick_representatives, representative_keys
+from candidates import tfidf_block_pairs, tfidf_sparse_pairs, parallel_tfidf_pairs, minhash_pairs
+from semantic import ANN_INDEXES, semantic_pairs
+from stages import StageRecorder, file_hash
 import argparse
 
-parser = argparse.ArgumentParser(description="Process an input file path.")
-parser.add_argument("--input_path", help="Path to the input file")
-
-args = parser.parse_args()
-
-dataset = pd.read_csv(args.input_path)
-
-df = dataset.reset_index(drop=True).copy()
-
-# Normalize the text, including removing accents, special characters, and 
-# converting to lowercase
-df["q"] = df["question"].apply(normalize_vietnamese)
-df["oa"] = df["optionA"].apply(normalize_vietnamese)
-df["ob"] = df["optionB"].apply(normalize_vietnamese)
-df["oc"] = df["optionC"].apply(normalize_vietnamese)
-df["od"] = df["optionD"].apply(normalize_vietnamese)
-df["oe"] = df["optionE"].apply(normalize_vietnamese)
-df["of"] = df["optionF"].apply(normalize_vietnamese)
-df["og"] = df["optionG"].apply(normalize_vietnamese)
-
-# Convert to TF-IDF vector to find exact and near duplicates
-vectorizer = TfidfVectorizer(
-    analyzer="word",
-    lowercase=True,
-    stop_words=None,
-    # max_features=100_000,
-    ngram_range=(1, 1),
-    min_df=5,
-    max_df=0.8,
-)
-
-X = vectorizer.fit_transform(df["q"])
-features = vectorizer.get_feature_names_out()
-
-# Look for duplicates, epsilon1 as threshold for exact match, epsilon2 as 
-# threshold for near duplicates
-epsilon1 = 1e-8
-epsilon2 = 0.1
-all_dup_idx_pairs = []
-all_near_dup_idx_pairs = []
-for i in tqdm(range(X.shape[0] // 2000 + 1)):
-    idx_start = i * 2000
-    dist_matrix = 1 - X[idx_start:idx_start + 2000, :].dot(X.T).toarray()
-    dup_idx_pairs_tmp = np.argwhere(dist_matrix < epsilon1)
-    dup_idx_pairs = dup_idx_pairs_tmp + [[idx_start, 0]] * len(dup_idx_pairs_tmp)
-    all_dup_idx_pairs.append(dup_idx_pairs)
-    
-    near_dup_idx_pairs_tmp = np.argwhere((dist_matrix < epsilon2) & (dist_matrix >= epsilon1))
-    near_dup_idx_pairs = near_dup_idx_pairs_tmp + [[idx_start, 0]] * len(near_dup_idx_pairs_tmp)
-    all_near_dup_idx_pairs.append(near_dup_idx_pairs)
-
-all_dup_idx_pairs = np.concatenate(all_dup_idx_pairs, axis=0)
-all_dup_idx_pairs = all_dup_idx_pairs[all_dup_idx_pairs[:, 0] != all_dup_idx_pairs[:, 1]]
-
-all_near_dup_idx_pairs = np.concatenate(all_near_dup_idx_pairs, axis=0)
-all_near_dup_idx_pairs = all_near_dup_idx_pairs[all_near_dup_idx_pairs[:, 0] != all_near_dup_idx_pairs[:, 1]]
-
-all_dup_idx_pairs = np.unique(all_dup_idx_pairs, axis=0)
-all_dup_idx_pairs = all_dup_idx_pairs[all_dup_idx_pairs[:, 0] < all_dup_idx_pairs[:, 1]]
-
-
-# Remove questions of Exact match
-val_array = df[["q", "oa", "ob", "oc", "od", "oe", "of", "og"]].fillna('').values
-removed_idx = set()
-
-for i, j in all_dup_idx_pairs:
-    if i in removed_idx or j in removed_idx:
-        continue
-    if (val_array[i,0] == val_array[j,0]) and sorted(val_array[i,1:]) == sorted(val_array[j,1:]):
-        removed_idx.add(j)
-    
-
-FILENAME_DEDUP_V1 = "dedup_v1.csv"
-df[~df.index.isin(removed_idx)].reset_index(drop=True).to_csv(f"./{FILENAME_DEDUP_V1}", index=False)
-
-
-# Remove questions of Near match
-data = []
-for i, j in all_near_dup_idx_pairs:
-    if i in removed_idx or j in removed_idx:
-        continue
-    fuzz_ratio = fuzz.ratio(rm_cau(val_array[i,0]), rm_cau(val_array[j,0]))
-    same_answers = sorted(val_array[i,1:]) == sorted(val_array[j,1:])
-    i_in_j = val_array[i,0] in val_array[j,0]
-    j_in_i = val_array[j,0] in val_array[i,0]
-
-    data.append((i, j, fuzz_ratio, same_answers, i_in_j, j_in_i, val_array[i,0], val_array[j,0], ", ".join(sorted(val_array[i,1:])), ", ".join(sorted(val_array[j,1:]))))
-df_near_dup = pd.DataFrame(data, columns=["i", "j", "fuzz_ratio", "same_answers", "i_in_j", "j_in_i", "q_i", "q_j", "options_i", "options_j"])
-
-# Pick 90 as the threshold
-removed_idx_fuzz = set()
-for (i, j, fuzz_ratio, same_answers, i_in_j, j_in_i, q_i, q_j, options_i, options_j) in data:
-    if i in removed_idx_fuzz or j in removed_idx_fuzz:
-        continue
-    if fuzz_ratio >= 90 and same_answers:
-        removed_idx_fuzz.add(j)
-FILENAME_DEDUP_V2 = "dedup_v2.csv"
-df[
-    ~(df.index.isin(removed_idx) | df.index.isin(removed_idx_fuzz))
-    ].reset_index(drop=True).to_csv(
-        f"./{FILENAME_DEDUP_V2}", index=False)
-
-
-df_dedup_v2 = pd.read_csv(f"./{FILENAME_DEDUP_V2}")
-
-df_dedup_v2[
-    (df_dedup_v2["medicalTopic"] != "Other(No Category)")
-].reset_index(drop=True).reset_index(drop=False).rename(
-    columns={"index": "dedup_v3_id"}
-).to_csv(
-    "./dedup_v3.csv", index=False
-)
+# Normalized column -> source column
+NORMALIZED_COLUMNS = {
+    "q": "question",
+    "oa": "optionA",
+    "ob": "optionB",
+    "oc": "optionC",
+    "od": "optionD",
+    "oe": "optionE",
+    "of": "optionF",
+    "og": "optionG",
+}
+
+
+def write_outputs(args, normalized, cluster_id, kept, dedup_v3_start=0, append=False):
+    """
+    Write dedup_v1, dedup_v2 and dedup_v3 in a single pass over the input.
+    Every chunk gets its normalized columns and cluster_id back, and the rows
+    of each version are selected with the boolean masks in kept.
+    """
+    kept_v1, kept_v2, kept_v3 = kept
+    start = 0
+    with TableWriter(f"./dedup_v1.{args.output_format}", append) as writer_v1, \
+            TableWriter(f"./dedup_v2.{args.output_format}", append) as writer_v2, \
+            TableWriter(f"./dedup_v3.{args.output_format}", append) as writer_v3:
+        for chunk in read_chunks(args.input_path, args.chunk_size):
+            rows = slice(start, start + len(chunk))
+            chunk = chunk.reset_index(drop=True)
+            for col in NORMALIZED_COLUMNS:
+                chunk[col] = normalized[col].to_numpy()[rows]
+            chunk["cluster_id"] = cluster_id[rows]
+
+            writer_v1.write(chunk[kept_v1[rows]])
+            writer_v2.write(chunk[kept_v2[rows]])
+            chunk_v3 = chunk[kept_v3[rows]]
+            chunk_v3.insert(0, "dedup_v3_id", dedup_v3_start + np.arange(len(chunk_v3)))
+            writer_v3.write(chunk_v3)
+
+            dedup_v3_start += len(chunk_v3)
+            start += len(chunk)
+
+
+def main(args, recorder=None):
+    """
+    Run the deduplication of args.input_path and write the outputs to the
+    working directory. Returns the StageRecorder with the wall time, memory
+    and counts of every stage.
+
+    Every stage but the output is run through recorder.run(), so that with
+    --checkpoint_dir its outputs are saved and with --resume it is skipped
+    when its inputs did not change.
+    """
+    recorder = recorder or StageRecorder(args.checkpoint_dir, resume=args.resume)
+
+    def normalize():
+        # Only the normalized columns, the representative keys and the topic
+        # of every row are kept in memory, the input is read again chunk by
+        # chunk to write the outputs
+        normalized_chunks, key_chunks, off_topic_chunks = [], [], []
+        for chunk in read_chunks(args.input_path, args.chunk_size):
+            # Normalize the text, including removing accents, special
+            # characters, and converting to lowercase
+            normalized_chunks.append(pd.DataFrame({
+                col: normalize_vietnamese_column(chunk[src_col], n_workers=args.n_workers).to_numpy()
+                for col, src_col in NORMALIZED_COLUMNS.items()
+            }))
+            key_chunks.append(representative_keys(chunk, args.representative))
+            off_topic_chunks.append((chunk["medicalTopic"] == "Other(No Category)").to_numpy())
+        normalized = pd.concat(normalized_chunks, ignore_index=True)
+        keys = np.array([np.concatenate(key) for key in zip(*key_chunks)], dtype=np.int64).reshape(-1, len(normalized))
+        return {"normalized": normalized, "keys": keys, "is_off_topic": np.concatenate(off_topic_chunks)}
+
+    input_file = file_hash(args.input_path) if args.checkpoint_dir else None
+    outputs = recorder.run("normalize", normalize, input_file=input_file, representative=args.representative)
+    normalized, keys, is_off_topic = outputs["normalized"], outputs["keys"], outputs["is_off_topic"]
+    n_rows = len(normalized)
+
+    # In incremental mode the accepted questions of previous runs come first,
+    # pair indices below refer to [accepted questions, unique rows of df]
+    index = None
+    if args.index_dir and DedupIndex.exists(args.index_dir):
+        index = DedupIndex.load(args.index_dir)
+    n_index = index.n_rows if index is not None else 0
+    row_offset = index.n_seen if index is not None else 0
+
+    # Remove questions of Exact match: same normalized question and same set
+    # of options. Rows are grouped by hash, so the similarity search below
+    # only sees one representative row per group
+    new_val_array = normalized.fillna('').values
+
+    def exact_dedup():
+        hashes = np.array([row_hash(row) for row in new_val_array], dtype=np.int64)
+        exact_representative = pick_representatives(pd.factorize(hashes)[0], keys)
+        in_index = np.isin(hashes, index.hashes) if index is not None else np.zeros(n_rows, dtype=bool)
+        is_exact_dup = (exact_representative != np.arange(n_rows)) | in_index
+        return {
+            "hashes": hashes,
+            "exact_representative": exact_representative,
+            "in_index": in_index,
+            "is_exact_dup": is_exact_dup,
+        }
+
+    outputs = recorder.run("exact_dedup", exact_dedup, normalized=normalized, keys=keys)
+    hashes, exact_representative, in_index, is_exact_dup = (
+        outputs["hashes"], outputs["exact_representative"], outputs["in_index"], outputs["is_exact_dup"])
+    unique_positions = np.flatnonzero(~is_exact_dup)
+
+    val_array = new_val_array[unique_positions]
+    if index is not None:
+        val_array = np.concatenate([index.normalized[list(NORMALIZED_COLUMNS)].values, val_array])
+
+    # Look for duplicates, epsilon1 as threshold for exact match, epsilon2 as 
+    # threshold for near duplicates
+    epsilon1 = 1e-8
+    epsilon2 = args.epsilon2
+    use_tfidf = args.candidates in ("tfidf", "tfidf_dense")
+    vectorizer = index.vectorizer if index is not None else None
+
+    def vectorize():
+        nonlocal vectorizer
+        if index is not None:
+            # Reuse the vocabulary and IDF of the index and only scan new rows
+            X = vstack([index.vectors, vectorizer.transform(normalized["q"].iloc[unique_positions])]).tocsr()
+        else:
+            # Convert to TF-IDF vector to find exact and near duplicates. The
+            # vectorizer is fitted on all rows so that IDF does not depend on
+            # how many exact duplicates were dropped
+            vectorizer = TfidfVectorizer(
+                analyzer="word",
+                lowercase=True,
+                stop_words=None,
+                # max_features=100_000,
+                ngram_range=(1, 1),
+                min_df=args.min_df,
+                max_df=0.8,
+            )
+
+            X = vectorizer.fit_transform(normalized["q"])[unique_positions]
+        return {"X": X}
+
+    X = None
+    if use_tfidf:
+        X = recorder.run(
+            "vectorize", vectorize, questions=normalized["q"].to_numpy(), unique_positions=unique_positions,
+            min_df=args.min_df,
+        )["X"]
+
+    def candidates():
+        if use_tfidf:
+            if args.n_workers > 1:
+                _, pairs = parallel_tfidf_pairs(
+                    X, epsilon1, epsilon2,
+                    block_size=args.block_size,
+                    top_k=args.top_k,
+                    n_workers=args.n_workers,
+                    scan="sparse" if args.candidates == "tfidf" else "dense",
+                    row_start=n_index,
+                )
+            elif args.candidates == "tfidf":
+                _, pairs = tfidf_sparse_pairs(
+                    X, epsilon1, epsilon2, block_size=args.block_size, top_k=args.top_k, row_start=n_index)
+            else:
+                _, pairs = tfidf_block_pairs(
+                    X, epsilon1, epsilon2, block_size=args.block_size, row_start=n_index)
+        else:
+            # MinHash + LSH only emits candidate pairs, which are then checked
+            # by the same fuzz ratio verification below
+            _, pairs = minhash_pairs(
+                val_array[:, 0],
+                num_perm=args.num_perm,
+                bands=args.lsh_bands,
+                shingle_size=args.shingle_size,
+                min_similarity=args.lsh_min_similarity,
+                max_bucket_size=args.lsh_max_bucket_size,
+            )
+        pairs = np.reshape(pairs, (-1, 2)).astype(np.int64)
+
+        if args.semantic:
+            # Paraphrases that share few words are found through the
+            # embeddings of the questions, the pairs go through the same
+            # verification
+            semantic_idx_pairs = semantic_pairs(
+                val_array[:, 0],
+                model_name=args.embedding_model,
+                top_k=args.semantic_top_k,
+                min_similarity=args.semantic_min_similarity,
+                ann_index=args.ann_index,
+                n_workers=args.n_workers,
+            )
+            # Pairs within the index were already resolved by previous runs
+            semantic_idx_pairs = semantic_idx_pairs[semantic_idx_pairs[:, 1] >= n_index]
+            pairs = np.concatenate([pairs, semantic_idx_pairs])
+
+        # Each pair is only verified once, as (i, j) with i < j
+        return {"pairs": np.unique(np.sort(pairs, axis=1), axis=0).reshape(-1, 2)}
+
+    candidate_params = {
+        key: getattr(args, key) for key in (
+            "candidates", "epsilon2", "top_k", "num_perm", "lsh_bands", "shingle_size", "lsh_min_similarity",
+            "lsh_max_bucket_size",
+            "semantic", "embedding_model", "ann_index", "semantic_top_k", "semantic_min_similarity",
+        )
+    }
+    candidate_input = X if use_tfidf else val_array[:, 0]
+    all_near_dup_idx_pairs = recorder.run(
+        "candidates", candidates, vectors=candidate_input, questions=val_array[:, 0], **candidate_params)["pairs"]
+
+    # Remove questions of Near match: pick 90 as the fuzz ratio threshold,
+    # the options must be the same
+    def verify():
+        passed = verify_near_dup_pairs(val_array, all_near_dup_idx_pairs, threshold=90, n_workers=args.n_workers)
+        return {"verified_pairs": all_near_dup_idx_pairs[passed]}
+
+    verified_pairs = recorder.run(
+        "verify", verify, val_array=val_array, pairs=all_near_dup_idx_pairs, threshold=90)["verified_pairs"]
+
+    # Verified pairs are grouped into connected components and one
+    # representative is kept per component, so the result does not depend on
+    # the order of the pairs
+    def cluster():
+        labels = cluster_labels(len(val_array), verified_pairs)
+        unique_keys = [key[unique_positions] for key in keys]
+        if index is not None:
+            # Questions accepted by previous runs always represent their cluster
+            is_new = np.r_[np.zeros(n_index, dtype=np.int64), np.ones(len(unique_positions), dtype=np.int64)]
+            unique_keys = [is_new] + [np.r_[np.zeros(n_index, dtype=key.dtype), key] for key in unique_keys]
+        near_representative = pick_representatives(labels, unique_keys)
+
+        # cluster_id is the row id of the representative of the cluster
+        scan_row_ids = row_offset + unique_positions
+        if index is not None:
+            scan_row_ids = np.r_[index.row_ids, scan_row_ids]
+        cluster_id = np.empty(n_rows, dtype=np.int64)
+        cluster_id[unique_positions] = scan_row_ids[near_representative[n_index:]]
+        is_exact_dup_in_batch = is_exact_dup & ~in_index
+        cluster_id[is_exact_dup_in_batch] = cluster_id[exact_representative[is_exact_dup_in_batch]]
+        if in_index.any():
+            hash_cluster_id = dict(zip(index.hashes.tolist(), index.hash_cluster_ids.tolist()))
+            cluster_id[in_index] = [hash_cluster_id[h] for h in hashes[in_index].tolist()]
+
+        # Rows of the input kept in dedup_v2
+        kept_v2 = ~is_exact_dup
+        kept_v2[unique_positions] = near_representative[n_index:] == np.arange(n_index, len(val_array))
+        return {"cluster_id": cluster_id, "kept_v2": kept_v2}
+
+    outputs = recorder.run(
+        "cluster", cluster, verified_pairs=verified_pairs, keys=keys, exact_representative=exact_representative,
+        is_exact_dup=is_exact_dup,
+    )
+    cluster_id, kept_v2 = outputs["cluster_id"], outputs["kept_v2"]
+    kept_v1 = ~is_exact_dup
+
+    kept_v3 = recorder.run(
+        "topic_filter", lambda: {"kept_v3": kept_v2 & ~is_off_topic}, kept_v2=kept_v2, is_off_topic=is_off_topic,
+    )["kept_v3"]
+
+    with recorder.stage("output") as counts:
+        write_outputs(
+            args, normalized, cluster_id, (kept_v1, kept_v2, kept_v3),
+            dedup_v3_start=index.n_dedup_v3 if index is not None else 0,
+            append=index is not None,
+        )
+
+        # Save the accepted questions so that the next batch is only compared
+        # against them
+        if args.index_dir:
+            accepted = pd.DataFrame(new_val_array[kept_v2], columns=list(NORMALIZED_COLUMNS))
+            accepted_vectors = X[n_index:][kept_v2[unique_positions]]
+            accepted_row_ids = row_offset + np.flatnonzero(kept_v2)
+            if index is None:
+                index = DedupIndex(
+                    vectorizer, accepted_vectors, accepted, accepted_row_ids,
+                    hashes[kept_v1], cluster_id[kept_v1], n_rows, int(kept_v3.sum()),
+                )
+            else:
+                index.extend(
+                    accepted_vectors, accepted, accepted_row_ids,
+                    hashes[kept_v1], cluster_id[kept_v1], n_rows, int(kept_v3.sum()),
+                )
+            index.save(args.index_dir)
+        counts["dedup_v1"] = int(kept_v1.sum())
+        counts["dedup_v2"] = int(kept_v2.sum())
+        counts["dedup_v3"] = int(kept_v3.sum())
+
+    if args.stats_path:
+        recorder.save(args.stats_path)
+    return recorder
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Process an input file path.")
+    parser.add_argument("--input_path", help="Path to the input CSV or Parquet file")
+    parser.add_argument("--chunk_size", type=int, default=100_000, help="Rows read from the input at a time")
+    parser.add_argument("--output_format", choices=["csv", "parquet"], default="csv",
+                        help="Format of the dedup_v1, dedup_v2 and dedup_v3 outputs")
+    parser.add_argument("--candidates", choices=["tfidf", "tfidf_dense", "minhash"], default="tfidf",
+                        help="Candidate generation: sparse TF-IDF scan, dense TF-IDF scan or MinHash + LSH")
+    parser.add_argument("--epsilon2", type=float, default=0.1,
+                        help="TF-IDF cosine distance below which two questions are near duplicate candidates")
+    parser.add_argument("--min_df", type=int, default=5, help="min_df of the TF-IDF vectorizer")
+    parser.add_argument("--top_k", type=int, default=None,
+                        help="Keep only the top k near duplicates per row in the sparse TF-IDF scan")
+    parser.add_argument("--block_size", type=int, default=2000, help="Rows per block in the TF-IDF scan")
+    parser.add_argument("--n_workers", type=int, default=1,
+                        help="Number of processes for text normalization, the TF-IDF scan and fuzzy verification")
+    parser.add_argument("--num_perm", type=int, default=128, help="Number of MinHash permutations")
+    parser.add_argument("--lsh_bands", type=int, default=32, help="Number of LSH bands, must divide --num_perm")
+    parser.add_argument("--shingle_size", type=int, default=1, help="Number of words per MinHash shingle")
+    parser.add_argument("--lsh_min_similarity", type=float, default=0.5,
+                        help="Drop LSH candidates whose estimated Jaccard similarity is below this value")
+    parser.add_argument("--lsh_max_bucket_size", type=int, default=1000,
+                        help="LSH buckets with more rows only pair their first row with the others")
+    parser.add_argument("--semantic", action="store_true",
+                        help="Also look for near duplicates among the nearest neighbours of the question embeddings")
+    parser.add_argument("--embedding_model", default=None,
+                        help="Name or path of a local sentence-transformers model, hashed character n-grams are "
+                             "used when not set")
+    parser.add_argument("--ann_index", choices=ANN_INDEXES, default="ivf",
+                        help="Approximate nearest neighbour index for --semantic, hnsw requires hnswlib")
+    parser.add_argument("--semantic_top_k", type=int, default=10, help="Neighbours looked up per question")
+    parser.add_argument("--semantic_min_similarity", type=float, default=0.8,
+                        help="Drop neighbours whose cosine similarity is below this value")
+
+    parser.add_argument("--representative", choices=REPRESENTATIVE_RULES, default="lowest_index",
+                        help="Which question of a duplicate cluster is kept")
+    parser.add_argument("--index_dir", default=None,
+                        help="Directory of the persisted index of accepted questions. New rows are only compared "
+                             "against the index and each other, and outputs are appended")
+    parser.add_argument("--checkpoint_dir", default=None,
+                        help="Save the outputs of every stage to this directory")
+    parser.add_argument("--resume", action="store_true",
+                        help="Load the outputs of the stages whose inputs did not change from --checkpoint_dir "
+                             "instead of running them again")
+    parser.add_argument("--stats_path", default=None,
+                        help="Save the wall time, peak memory and counts of every stage to this JSON file")
+
+    args = parser.parse_args(argv)
+    if args.index_dir and args.candidates == "minhash":
+        parser.error("--index_dir requires the TF-IDF candidates")
+    if args.resume and not args.checkpoint_dir:
+        parser.error("--resume requires --checkpoint_dir")
+    if args.checkpoint_dir and args.index_dir:
+        parser.error("--checkpoint_dir can't be used with --index_dir, which updates the index and appends to the "
+                     "outputs")
+    if args.index_dir and args.output_format == "parquet":
+        parser.error("--index_dir appends to the outputs, which requires --output_format csv")
+    return args
+
 
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,169 @@
+import numpy as np
+
+from sklearn.cluster import MiniBatchKMeans
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.preprocessing import normalize
+from sklearn.random_projection import SparseRandomProjection
+
+from tqdm.auto import tqdm
+
+ANN_INDEXES = ["ivf", "hnsw"]
+
+
+def hashed_embeddings(texts, dim=256, ngram_range=(2, 4), n_features=2 ** 20, seed=42, chunk_size=100_000):
+    """
+    Embed texts without a model: hashed character n-gram counts, L2
+    normalized, then projected to dim dimensions with a sparse random
+    projection, which roughly preserves their cosine similarity. Returns L2
+    normalized float32 vectors.
+    """
+    hasher = HashingVectorizer(
+        analyzer="char_wb",
+        ngram_range=ngram_range,
+        n_features=n_features,
+        alternate_sign=False,
+        norm="l2",
+    )
+    texts = list(texts)
+    projection = SparseRandomProjection(n_components=dim, dense_output=True, random_state=seed)
+    # Only the number of features is used to draw the projection matrix
+    projection.fit(hasher.transform(texts[:1]))
+
+    vectors = np.concatenate([
+        projection.transform(hasher.transform(texts[start:start + chunk_size]))
+        for start in range(0, len(texts), chunk_size)
+    ])
+    return normalize(vectors).astype(np.float32)
+
+
+def encode_questions(texts, model_name=None, batch_size=256, dim=256, seed=42):
+    """
+    Embed the normalized questions with a local sentence embedding model run
+    on CPU. When no model is given, or it can't be loaded, the hashed
+    character n-gram embeddings are used instead. Returns L2 normalized
+    float32 vectors.
+    """
+    if model_name is not None:
+        try:
+            from sentence_transformers import SentenceTransformer
+
+            model = SentenceTransformer(model_name, device="cpu")
+        except (ImportError, OSError) as e:
+            print(f"Can't load the embedding model {model_name} ({e}), using hashed character n-grams")
+        else:
+            vectors = model.encode(
+                list(texts), batch_size=batch_size, normalize_embeddings=True, show_progress_bar=True)
+            return np.asarray(vectors, dtype=np.float32)
+    return hashed_embeddings(texts, dim=dim, seed=seed)
+
+
+def _top_k_per_row(rows, cols, sims, k):
+    """Keep the k entries with the highest similarity of every row."""
+    order = np.lexsort((-sims, rows))
+    rows, cols, sims = rows[order], cols[order], sims[order]
+    rank = np.arange(len(rows)) - np.searchsorted(rows, rows)
+    keep = rank < k
+    return rows[keep], cols[keep], sims[keep]
+
+
+def ivf_neighbours(vectors, k=10, n_lists=None, n_probe=8, seed=42, chunk_size=20_000):
+    """
+    Approximate top k neighbours (by inner product) of every row with an
+    inverted file index: rows are split into n_lists k-means lists (sqrt of
+    the number of rows by default) and each row is only compared to the
+    members of the n_probe lists closest to it.
+
+    Returns (rows, cols, sims), self matches excluded.
+    """
+    n_rows = len(vectors)
+    n_lists = min(n_lists or max(1, int(np.sqrt(n_rows))), n_rows)
+    n_probe = min(n_probe, n_lists)
+    kmeans = MiniBatchKMeans(n_clusters=n_lists, random_state=seed, n_init=3, batch_size=4096).fit(vectors)
+    centroids = normalize(kmeans.cluster_centers_).astype(np.float32)
+
+    list_order = np.argsort(kmeans.labels_, kind="stable")
+    list_starts = np.searchsorted(kmeans.labels_[list_order], np.arange(n_lists + 1))
+
+    all_rows, all_cols, all_sims = [], [], []
+    for start in tqdm(range(0, n_rows, chunk_size), desc="IVF search"):
+        queries = np.arange(start, min(start + chunk_size, n_rows))
+        probed = np.argpartition(-(vectors[queries] @ centroids.T), n_probe - 1, axis=1)[:, :n_probe]
+
+        # Every list is compared at once with all the queries that probe it
+        query_of, list_of = np.repeat(queries, n_probe), probed.ravel()
+        order = np.argsort(list_of, kind="stable")
+        query_of, list_of = query_of[order], list_of[order]
+        bounds = np.flatnonzero(np.r_[True, list_of[1:] != list_of[:-1], True])
+
+        chunk_rows, chunk_cols, chunk_sims = [], [], []
+        for lo, hi in zip(bounds[:-1], bounds[1:]):
+            members = list_order[list_starts[list_of[lo]]:list_starts[list_of[lo] + 1]]
+            if not len(members):
+                continue
+            probing = query_of[lo:hi]
+            sims = vectors[probing] @ vectors[members].T
+            top = min(k + 1, len(members))
+            best = np.argpartition(-sims, top - 1, axis=1)[:, :top]
+            chunk_rows.append(np.repeat(probing, top))
+            chunk_cols.append(members[best].ravel())
+            chunk_sims.append(np.take_along_axis(sims, best, axis=1).ravel())
+
+        rows, cols, sims = np.concatenate(chunk_rows), np.concatenate(chunk_cols), np.concatenate(chunk_sims)
+        not_self = rows != cols
+        rows, cols, sims = _top_k_per_row(rows[not_self], cols[not_self], sims[not_self], k)
+        all_rows.append(rows)
+        all_cols.append(cols)
+        all_sims.append(sims)
+
+    return np.concatenate(all_rows), np.concatenate(all_cols), np.concatenate(all_sims)
+
+
+def hnsw_neighbours(vectors, k=10, ef_construction=200, M=16, ef=64, n_workers=1, seed=42, chunk_size=20_000):
+    """
+    Approximate top k neighbours (by inner product) of every row with an HNSW
+    graph, built with hnswlib. Returns (rows, cols, sims), self matches
+    excluded.
+    """
+    import hnswlib
+
+    n_rows, dim = vectors.shape
+    index = hnswlib.Index(space="ip", dim=dim)
+    index.init_index(max_elements=n_rows, ef_construction=ef_construction, M=M, random_seed=seed)
+    index.set_num_threads(n_workers)
+    index.add_items(vectors, np.arange(n_rows))
+    index.set_ef(max(ef, k + 1))
+
+    top = min(k + 1, n_rows)
+    all_rows, all_cols, all_sims = [], [], []
+    for start in tqdm(range(0, n_rows, chunk_size), desc="HNSW search"):
+        queries = np.arange(start, min(start + chunk_size, n_rows))
+        labels, distances = index.knn_query(vectors[queries], k=top)
+        # hnswlib's inner product distance is 1 - inner product
+        rows, cols, sims = np.repeat(queries, top), labels.ravel().astype(np.int64), 1 - distances.ravel()
+        not_self = rows != cols
+        rows, cols, sims = _top_k_per_row(rows[not_self], cols[not_self], sims[not_self], k)
+        all_rows.append(rows)
+        all_cols.append(cols)
+        all_sims.append(sims)
+
+    return np.concatenate(all_rows), np.concatenate(all_cols), np.concatenate(all_sims)
+
+
+def semantic_pairs(texts, model_name=None, top_k=10, min_similarity=0.8, ann_index="ivf", n_workers=1, seed=42):
+    """
+    Candidate near duplicate pairs from the embeddings of texts: the top_k
+    approximate nearest neighbours of every row whose cosine similarity is
+    at least min_similarity. Every pair is returned once as (i, j), i < j,
+    sorted lexicographically.
+    """
+    if len(texts) < 2:
+        return np.empty((0, 2), dtype=np.int64)
+    vectors = encode_questions(texts, model_name=model_name, seed=seed)
+    if ann_index == "hnsw":
+        rows, cols, sims = hnsw_neighbours(vectors, k=top_k, n_workers=n_workers, seed=seed)
+    else:
+        rows, cols, sims = ivf_neighbours(vectors, k=top_k, seed=seed)
+
+    keep = sims >= min_similarity
+    pairs = np.stack([rows[keep], cols[keep]], axis=1).astype(np.int64)
+    return np.unique(np.sort(pairs, axis=1), axis=0).reshape(-1, 2)
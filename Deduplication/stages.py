@@ -0,0 +1,189 @@
+import hashlib
+import json
+import os
+import resource
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import issparse, load_npz, save_npz
+
+MANIFEST_FILE = "manifest.json"
+
+
+def peak_rss_mb():
+    """
+    Peak resident set size in MB of this process, or of its largest finished
+    child process (e.g. a Pool worker) if that one is larger.
+    """
+    self_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children_kb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(self_kb, children_kb) / 1024
+
+
+def file_hash(path, block_size=1 << 20):
+    """Content hash of a file."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def content_hash(value):
+    """
+    Content hash of a stage input: a numpy array, a sparse matrix, a
+    DataFrame or anything JSON serializable.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    if isinstance(value, pd.DataFrame):
+        # Missing values hash the same whether they are NaN or None, as they
+        # come back from Parquet
+        value = value.astype(object).where(value.notna(), None)
+        digest.update(json.dumps(list(map(str, value.columns))).encode())
+        digest.update(pd.util.hash_pandas_object(value, index=False).to_numpy().tobytes())
+    elif issparse(value):
+        value = value.tocsr()
+        digest.update(str((value.shape, value.dtype)).encode())
+        for array in (value.data, value.indices, value.indptr):
+            digest.update(np.ascontiguousarray(array).tobytes())
+    elif isinstance(value, np.ndarray):
+        digest.update(str((value.shape, value.dtype)).encode())
+        if value.dtype == object:
+            digest.update(pd.util.hash_array(value.ravel()).tobytes())
+        else:
+            digest.update(np.ascontiguousarray(value).tobytes())
+    else:
+        digest.update(json.dumps(value, sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+
+def _count(value):
+    if isinstance(value, np.ndarray) and value.dtype == bool:
+        return int(value.sum())
+    return int(value.shape[0])
+
+
+class StageRecorder:
+    """
+    Wall time, peak RSS and counts of the named stages of a run, in the order
+    they ran.
+
+    Stages run through run() can also be checkpointed: with a checkpoint_dir
+    their outputs are saved there (.npy for arrays, .npz for sparse matrices,
+    .parquet for DataFrames) along with a key, the content hash of everything
+    the stage depends on. With resume=True, a stage whose key did not change
+    since the checkpoint was saved is loaded instead of being run again.
+
+    Example:
+        with recorder.stage("output") as counts:
+            counts["rows"] = len(df)
+
+        outputs = recorder.run("verify", verify, pairs=pairs, threshold=90)
+    """
+
+    def __init__(self, checkpoint_dir=None, resume=False):
+        self.stages = []
+        self.start = time.perf_counter()
+        self.checkpoint_dir = checkpoint_dir
+        self.resume = resume
+        self.manifest = {}
+        # Content hashes of the outputs of previous stages, by object id, so
+        # that they are not computed again when they are used as inputs
+        self._hashes = {}
+        if checkpoint_dir:
+            os.makedirs(checkpoint_dir, exist_ok=True)
+            manifest_path = os.path.join(checkpoint_dir, MANIFEST_FILE)
+            if resume and os.path.isfile(manifest_path):
+                with open(manifest_path, "r", encoding="utf-8") as f:
+                    self.manifest = json.load(f)
+
+    @contextmanager
+    def stage(self, name):
+        counts = {}
+        start = time.perf_counter()
+        yield counts
+        self.stages.append({
+            "name": name,
+            "seconds": time.perf_counter() - start,
+            # RSS only ever grows, this is the peak up to the end of the stage
+            "peak_rss_mb": peak_rss_mb(),
+            "counts": counts,
+        })
+
+    def _hash(self, value):
+        cached = self._hashes.get(id(value))
+        if cached is not None and cached[0] is value:
+            return cached[1]
+        return content_hash(value)
+
+    def stage_key(self, name, inputs):
+        digest = hashlib.blake2b(name.encode(), digest_size=16)
+        for input_name in sorted(inputs):
+            digest.update(f"{input_name}={self._hash(inputs[input_name])};".encode())
+        return digest.hexdigest()
+
+    def run(self, name, func, **inputs):
+        """
+        Run the stage name: func() returns a dict of named outputs, inputs are
+        everything its result depends on. Returns the outputs, loaded from the
+        checkpoint when resuming and the key of the stage did not change.
+        """
+        key = self.stage_key(name, inputs) if self.checkpoint_dir else None
+        with self.stage(name) as counts:
+            entry = self.manifest.get(name)
+            if self.resume and entry is not None and entry["key"] == key:
+                outputs = {output: self._load(file) for output, file in entry["outputs"].items()}
+                counts["resumed"] = True
+            else:
+                outputs = func()
+                if self.checkpoint_dir:
+                    self._save(name, key, outputs)
+            counts.update({output: _count(value) for output, value in outputs.items()})
+
+        if self.checkpoint_dir:
+            for value in outputs.values():
+                self._hashes[id(value)] = (value, content_hash(value))
+        return outputs
+
+    def _save(self, name, key, outputs):
+        files = {}
+        for output, value in outputs.items():
+            if isinstance(value, pd.DataFrame):
+                file = f"{name}.{output}.parquet"
+                value.to_parquet(os.path.join(self.checkpoint_dir, file), index=False)
+            elif issparse(value):
+                file = f"{name}.{output}.npz"
+                save_npz(os.path.join(self.checkpoint_dir, file), value.tocsr())
+            else:
+                file = f"{name}.{output}.npy"
+                np.save(os.path.join(self.checkpoint_dir, file), value, allow_pickle=False)
+            files[output] = file
+
+        # The manifest is written last, a stage interrupted while saving is
+        # run again
+        self.manifest[name] = {"key": key, "outputs": files}
+        manifest_path = os.path.join(self.checkpoint_dir, MANIFEST_FILE)
+        with open(manifest_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(manifest_path + ".tmp", manifest_path)
+
+    def _load(self, file):
+        path = os.path.join(self.checkpoint_dir, file)
+        if file.endswith(".parquet"):
+            return pd.read_parquet(path)
+        if file.endswith(".npz"):
+            return load_npz(path).tocsr()
+        return np.load(path, allow_pickle=False)
+
+    def to_dict(self):
+        return {
+            "total_seconds": time.perf_counter() - self.start,
+            "peak_rss_mb": peak_rss_mb(),
+            "stages": self.stages,
+        }
+
+    def save(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, indent=2)
@@ -0,0 +1,57 @@
+from multiprocessing import Pool
+
+import numpy as np
+from rapidfuzz import fuzz
+from rapidfuzz.process import cpdist
+
+from dedup_utils import rm_cau
+
+
+def _ratio_at_least(args):
+    queries, choices, threshold = args
+    # thefuzz.fuzz.ratio rounds the rapidfuzz score to an int, anything that
+    # can still round up to threshold is computed, the rest is cut off
+    scores = cpdist(queries, choices, scorer=fuzz.ratio, score_cutoff=threshold - 1, dtype=np.float64)
+    return np.round(scores) >= threshold
+
+
+def verify_near_dup_pairs(val_array, pairs, threshold=90, n_workers=1, chunk_size=50_000):
+    """
+    For every near duplicate candidate (i, j) in pairs, return whether
+    fuzz.ratio(rm_cau(q_i), rm_cau(q_j)) >= threshold and both questions have
+    the same set of options, val_array rows being [q, oa, ..., og].
+
+    The option sets are compared first through integer ids, so the fuzz
+    ratio is only computed for pairs that can still pass. Ratios are computed
+    in chunks with rapidfuzz, on n_workers processes when n_workers > 1.
+    """
+    pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+    passed = np.zeros(len(pairs), dtype=bool)
+    if not len(pairs):
+        return passed
+
+    # Id of the sorted option tuple of every row used by a pair
+    rows = np.unique(pairs)
+    option_ids = {}
+    row_option_id = np.empty(len(val_array), dtype=np.int64)
+    for row in rows:
+        row_option_id[row] = option_ids.setdefault(tuple(sorted(val_array[row, 1:])), len(option_ids))
+    same_answers = row_option_id[pairs[:, 0]] == row_option_id[pairs[:, 1]]
+
+    # rm_cau is computed once per row instead of once per pair
+    candidates = np.flatnonzero(same_answers)
+    cleaned = {row: rm_cau(val_array[row, 0]) for row in np.unique(pairs[candidates])}
+    tasks = []
+    for start in range(0, len(candidates), chunk_size):
+        chunk = pairs[candidates[start:start + chunk_size]]
+        tasks.append(([cleaned[i] for i in chunk[:, 0]], [cleaned[j] for j in chunk[:, 1]], threshold))
+
+    if n_workers > 1 and len(tasks) > 1:
+        with Pool(n_workers) as pool:
+            results = pool.map(_ratio_at_least, tasks)
+    else:
+        results = [_ratio_at_least(task) for task in tasks]
+
+    if results:
+        passed[candidates] = np.concatenate(results)
+    return passed
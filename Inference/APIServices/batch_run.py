@@ -1,3 +1,4 @@
+import argparse
 import os
 import time
 from typing import List, Dict
@@ -29,6 +30,7 @@ def get_service(
     aws_access_key_id: str = None,
     awsRoleArn: str = None,
     awsRegion: str = None,
+    run_id: str = None,
 ):
     """
     Args:
@@ -41,6 +43,8 @@ def get_service(
         aws_access_key_id: (AWS only) key id to use AWS service
         awsRoleArn: (AWS only) contact root user for more info (relating to IAM)
         awsRegion: (AWS only) currently we are using Tokyo (ap-northeast-1)
+        run_id: (Gemini, Azure (deepseek), DeepSeek) ID of an interrupted run to resume: only the questions without
+            a result are sent again
     Note:
         Azure: "model_name" is also "azure_deployment" name on Azure AI Foundry
         AWS: "api_key" is also "AWS_SECRET_ACCESS_KEY"
@@ -109,6 +113,7 @@ def get_service(
             system_prompt=system_prompt,
             response_format=response_format,
             azure_endpoint=azure_endpoint,
+            run_id=run_id,
         )
     elif serviceName == "aws":
         assert (
@@ -131,6 +136,7 @@ def get_service(
             model_name=model_name,
             system_prompt=system_prompt,
             response_format=response_format,
+            run_id=run_id,
         )
     elif serviceName == "deepseek":
         return DeepseekInference(
@@ -139,6 +145,7 @@ def get_service(
             system_prompt=system_prompt,
             response_format=response_format,
             k=k,
+            run_id=run_id,
         )
     else:
         raise Exception("Unrecognize service")
@@ -159,6 +166,13 @@ def format_option(datum: dict, isDefaultID: bool = False):
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--run_id", default=None, help="uuid of an interrupted run to resume")
+    parser.add_argument("--replay_dead_letter", action="store_true",
+                        help="Send the questions given up by run_id again, instead of running the data")
+    args = parser.parse_args()
+    assert args.run_id or not args.replay_dead_letter, "--replay_dead_letter needs --run_id"
+
     # data = BatchInference.readJSONL("raw_data/data-processed-shuffled0.jsonl")
     # data = BatchInference.readJSONL('raw_data/data-processed-shuffled1.jsonl')
     data = BatchInference.readJSONL('raw_data/data-processed-shuffled2.jsonl')
@@ -173,9 +187,13 @@ if __name__ == "__main__":
         model_name="deepseek-reasoner",
         system_prompt=deepseekPrompt,
         response_format={"type": "json_object"},
+        run_id=args.run_id,
     )
     start_time = time.time()  
-    service.run_batch(data_formatted=data_formatted)
+    if args.replay_dead_letter:
+        service.replay_dead_letter()
+    else:
+        service.run_batch(data_formatted=data_formatted)
     end_time = time.time()  
     elapsed_time = end_time - start_time  
 
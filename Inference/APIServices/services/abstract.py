@@ -1,22 +1,50 @@
+import asyncio
+import contextvars
 import json
+import random
 from csv import DictReader
 from pathlib import Path
-from typing import List, Literal, Optional, Dict
+from typing import Callable, List, Literal, Optional, Dict
 from abc import ABC, abstractmethod
 import uuid
 from datetime import datetime
 import time
 import os
+from .rate_limiter import get_rate_limiter
+from .response_cache import cache_key, get_response_cache
+from .run_store import get_run_store
+
+_event_loop = None
+# Usage of the call() running in the current task, see report_usage()
+_call_usage = contextvars.ContextVar("call_usage", default=None)
+
+
+def run_async(coroutine):
+    """
+    Run coroutine to completion from sync code. Every run of the process uses
+    the same event loop, so that the pooled async clients (whose connections
+    belong to the loop that opened them) stay usable from one run to the next.
+    """
+    global _event_loop
+    if _event_loop is None or _event_loop.is_closed():
+        _event_loop = asyncio.new_event_loop()
+    return _event_loop.run_until_complete(coroutine)
 
 class BatchInference(ABC):
     
-    def __init__(self, api_key: str, model_name: str, system_prompt: str, service: str, response_format,k=1):
+    def __init__(self, api_key: str, model_name: str, system_prompt: str, service: str, response_format,k=1, run_id: Optional[str] = None):
+        """
+        Args:
+            run_id: ID of a run to resume (its uuid): questions that already have a result in the run store (see
+                run_store.py) are not sent again. A new run is started when None.
+        """
         self._api_key: str = api_key
         self.service = service
         self.model_name: str = model_name
         self.system_prompt: str = system_prompt
         self.response_format = response_format
-        self.uuid: str = str(uuid.uuid4())
+        self.uuid: str = run_id or str(uuid.uuid4())
+        self.run_id: str = self.uuid
         self.k: int = k
         self.input_dir: Path = Path("batch_in") / self.service
         self.output_dir: Path = Path("batch_out") / self.service
@@ -25,10 +53,55 @@ class BatchInference(ABC):
 
         self.formatted_data: List = None
         self.job_status: str = None
+        # Responses of get_llm_responese are cached (see response_cache.py),
+        # set use_cache to False or LLM_CACHE_BYPASS=1 to always call the API
+        self.use_cache: bool = not os.getenv("LLM_CACHE_BYPASS")
+        # Single calls (see call() and run_prompts()): requests in flight at
+        # once, attempts per prompt, seconds before a call is abandoned, and
+        # delay before the first retry (doubled at each retry). run_batches()
+        # splits a batch in halves after split_after failures
+        self.max_concurrency: int = 8
+        self.max_retries: int = 5
+        self.split_after: int = 2
+        self.request_timeout: float = 600
+        self.retry_delay: float = 2
+        # RPM/TPM limits of LLM_RATE_LIMITS (see rate_limiter.py) for
+        # rate_limit_provider/model_name. Every call takes the estimated tokens
+        # of its prompt plus expected_output_tokens, corrected with the usage
+        # given to report_usage()
+        self.rate_limit_provider: str = service
+        self.expected_output_tokens: int = 1000
+        # The limiter and the run store are only opened by the single call
+        # paths that use them, see the properties below
+        self._rate_limiter = None
+        self._rate_limiter_loaded: bool = False
+        self._run_store = None
 
         self.input_dir.mkdir(parents=True, exist_ok=True)
         self.output_dir.mkdir(parents=True, exist_ok=True)
-        print(f"Object initialized with uuid: {self.uuid}")
+        print(f"Object initialized with uuid: {self.uuid}" + (" (resumed)" if run_id else " (pass it as run_id to resume)"))
+
+    @property
+    def rate_limiter(self):
+        """Limiter of rate_limit_provider/model_name, created on first use. None for no limit."""
+        if not self._rate_limiter_loaded:
+            self._rate_limiter = get_rate_limiter(self.rate_limit_provider, self.model_name)
+            self._rate_limiter_loaded = True
+        return self._rate_limiter
+
+    @rate_limiter.setter
+    def rate_limiter(self, limiter):
+        self._rate_limiter = limiter
+        self._rate_limiter_loaded = True
+
+    @property
+    def run_store(self):
+        """Run store where the results of single call services are saved as they come, opened on first use."""
+        if self._run_store is None:
+            store = get_run_store()
+            store.open_run(self.run_id, self.service, self.model_name, k=self.k, system_prompt=self.system_prompt)
+            self._run_store = store
+        return self._run_store
 
     @abstractmethod
     def prepareData(self, data: List, **kwargs) -> None:
@@ -75,6 +148,200 @@ class BatchInference(ABC):
         time.sleep(1)
         self.download_batch_file()
 
+    async def call(self, prompt: str) -> str:
+        """
+        Response text of one request for prompt, raises on failure. Services
+        with a single call API implement it, run_prompts() and
+        get_llm_responese() add concurrency, retries, timeouts and caching.
+        """
+        raise NotImplementedError(f"{type(self).__name__} has no single call API")
+
+    def estimate_tokens(self, prompt: str) -> int:
+        """Tokens of a call for prompt, before its usage is known (about 3 bytes per token)."""
+        text = (self.system_prompt or "") + prompt
+        return len(text.encode("utf-8")) // 3 + self.expected_output_tokens
+
+    def report_usage(self, total_tokens: Optional[int]) -> None:
+        """Called by call() with the tokens the provider counted for the request, to correct the rate limiter."""
+        usage = _call_usage.get()
+        if usage is not None and total_tokens is not None:
+            usage["total_tokens"] = total_tokens
+
+    async def limited_call(self, prompt: str) -> str:
+        """call() within the rate limits, abandoned after request_timeout seconds."""
+        if self.rate_limiter is None:
+            return await asyncio.wait_for(self.call(prompt), self.request_timeout)
+        estimate = self.estimate_tokens(prompt)
+        await self.rate_limiter.acquire(estimate)
+        usage = {}
+        token = _call_usage.set(usage)
+        try:
+            return await asyncio.wait_for(self.call(prompt), self.request_timeout)
+        finally:
+            _call_usage.reset(token)
+            await self.rate_limiter.record_usage(estimate, usage.get("total_tokens", estimate))
+
+    def get_llm_responese(self, prompt: str):
+        """One call for prompt, from the cache when possible."""
+        cached = self.get_cached_response(prompt)
+        if cached is not None:
+            return cached
+        try:
+            data = run_async(self.limited_call(prompt))
+        except Exception as e:
+            print("error in get_llm_responese", e)
+            with open("error.log", "a") as f:
+                f.write(f"{str(e)}\n")
+            return {"success": False}
+        self.cache_response(prompt, data)
+        return {"success": True, "data": data}
+
+    async def attempt_prompt(self, prompt: str, parse: Callable, attempts: int, semaphore: asyncio.Semaphore,
+                             label: str = "", sample: int = 0) -> Dict:
+        """
+        Up to attempts calls for prompt, with exponential backoff, until
+        parse(text) accepts the response. Only parsed responses are cached,
+        under sample (see response_cache_key).
+        Returns {"success": True, "data": data} or {"success": False, "error": str}.
+        """
+        error = None
+        for attempt in range(attempts):
+            if attempt > 0:
+                await asyncio.sleep(self.retry_delay * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+            cached = self.get_cached_response(prompt, sample)
+            try:
+                if cached is not None:
+                    text = cached["data"]
+                else:
+                    async with semaphore:
+                        text = await self.limited_call(prompt)
+                data = parse(text)
+            except Exception as e:
+                error = e
+                if cached is not None:
+                    self.invalidate_cached_response(prompt, sample)
+                print(f"{label}: attempt {attempt + 1}/{attempts} failed: {e!r}")
+                continue
+            if cached is None:
+                self.cache_response(prompt, text, sample)
+            return {"success": True, "data": data}
+        return {"success": False, "error": repr(error)}
+
+    async def run_prompts_async(self, prompts: List[str], parse: Callable = None, on_result: Callable = None) -> List[Dict]:
+        """
+        Send every prompt through call(), with at most max_concurrency calls in
+        flight, within the rate limits. parse(i, text) turns the response to
+        prompts[i] into its data and raises when the response is unusable. A
+        failed, timed out or rejected call is retried up to max_retries times,
+        with exponential backoff.
+
+        Returns one result per prompt, in the order of prompts:
+        {"success": True, "data": data} or {"success": False, "error": str}.
+        on_result(i, result) is called as soon as prompts[i] is done.
+        """
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        n_done = 0
+
+        async def run(i, prompt):
+            nonlocal n_done
+            result = await self.attempt_prompt(
+                prompt, lambda text: parse(i, text) if parse is not None else text,
+                self.max_retries, semaphore, label=f"Prompt {i}",
+            )
+            n_done += 1
+            print(f"Processed {n_done}/{len(prompts)} prompts")
+            if on_result is not None:
+                on_result(i, result)
+            return result
+
+        return list(await asyncio.gather(*(run(i, prompt) for i, prompt in enumerate(prompts))))
+
+    def run_prompts(self, prompts: List[str], parse: Callable = None, on_result: Callable = None) -> List[Dict]:
+        """run_prompts_async() from sync code."""
+        return run_async(self.run_prompts_async(prompts, parse, on_result))
+
+    async def run_batches_async(self, batches: List[List], make_prompt: Callable, parse: Callable,
+                                on_result: Callable = None, on_failure: Callable = None,
+                                sample: Callable = None) -> None:
+        """
+        Send batches of questions (lists of items) like run_prompts_async(),
+        make_prompt(batch) being the prompt of a batch and parse(batch, text)
+        the data of its response.
+
+        A batch of several questions that fails split_after times is split in
+        halves that are sent on their own, recursively, so that a question the
+        model can't answer doesn't take its neighbours down with it. A single
+        question is given up after max_retries failures. on_result(batch, data)
+        is called for every batch answered (halves included), and
+        on_failure(batch, error) for every question given up. sample(batch) is
+        the pass@k sample of a batch, when batches of several samples share
+        the run (see response_cache_key).
+        """
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        n_done = 0
+
+        async def run(batch, label):
+            attempts = self.max_retries if len(batch) == 1 else min(self.split_after, self.max_retries)
+            result = await self.attempt_prompt(
+                make_prompt(batch), lambda text: parse(batch, text), attempts, semaphore, label=label,
+                sample=sample(batch) if sample is not None else 0,
+            )
+            if result["success"]:
+                if on_result is not None:
+                    on_result(batch, result["data"])
+            elif len(batch) > 1:
+                middle = len(batch) // 2
+                print(f"{label}: splitting {len(batch)} questions in halves")
+                await asyncio.gather(run(batch[:middle], f"{label}.0"), run(batch[middle:], f"{label}.1"))
+            elif on_failure is not None:
+                on_failure(batch, result["error"])
+
+        async def run_top(i, batch):
+            nonlocal n_done
+            await run(batch, f"Batch {i}")
+            n_done += 1
+            print(f"Processed {n_done}/{len(batches)} batches")
+
+        await asyncio.gather(*(run_top(i, batch) for i, batch in enumerate(batches)))
+
+    def run_batches(self, batches: List[List], make_prompt: Callable, parse: Callable,
+                    on_result: Callable = None, on_failure: Callable = None, sample: Callable = None) -> None:
+        """run_batches_async() from sync code."""
+        run_async(self.run_batches_async(batches, make_prompt, parse, on_result, on_failure, sample))
+
+    def response_cache_key(self, prompt: str, sample: int = 0) -> str:
+        """
+        sample tells apart the answers to the same prompt in pass@k (the
+        epoch), so that each epoch is a new draw rather than the cached answer.
+        With k > 1 the run ID is part of the key as well: a new run draws new
+        samples, only a resumed run gets its own answers from the cache.
+        """
+        if self.k > 1:
+            content = [prompt, self.run_id, sample]
+        elif sample:
+            content = [prompt, sample]
+        else:
+            content = prompt
+        return cache_key(self.model_name, self.system_prompt, self.response_format, content)
+
+    def get_cached_response(self, prompt: str, sample: int = 0) -> Optional[Dict]:
+        """get_llm_responese result from the cache, or None."""
+        if not self.use_cache:
+            return None
+        data = get_response_cache().get(self.response_cache_key(prompt, sample))
+        if data is None:
+            return None
+        return {"success": True, "data": data, "cached": True}
+
+    def cache_response(self, prompt: str, data, sample: int = 0) -> None:
+        if self.use_cache and isinstance(data, str):
+            get_response_cache().put(self.response_cache_key(prompt, sample), data)
+
+    def invalidate_cached_response(self, prompt: str, sample: int = 0) -> None:
+        """Forget the cached response of prompt, when it was rejected, so that a retry calls the API."""
+        if self.use_cache:
+            get_response_cache().delete(self.response_cache_key(prompt, sample))
+
     @classmethod
     def writeJSONL(cls, data: List, filename: Path|str) -> None:
         """Write data to a JSONL file."""
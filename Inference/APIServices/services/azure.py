@@ -1,5 +1,5 @@
+import asyncio
 import json
-import time
 from pathlib import Path
 from typing import List, Dict
 from openai import AzureOpenAI
@@ -11,13 +11,14 @@ from .abstract import BatchInference
 
 class AzureInference(BatchInference):
 
-    def __init__(self, api_key: str, model_name: str, system_prompt: str, response_format, azure_endpoint: str):
+    def __init__(self, api_key: str, model_name: str, system_prompt: str, response_format, azure_endpoint: str, run_id: str = None):
         """
         Args:
             response_format: Response format to use. Either None or {"type": "json_object"} or json_schema (recommend using Pydantic).
+            run_id: (non batch mode) ID of a run to resume, see BatchInference.
         """
         assert azure_endpoint is not None, f"azure_endpoint must have value. azure_endpoint={azure_endpoint}"
-        super().__init__(api_key, model_name, system_prompt, "azure", response_format)
+        super().__init__(api_key, model_name, system_prompt, "azure", response_format, run_id=run_id)
         self.__azure_endpoint: str = azure_endpoint
         self.azure_deployment = self.model_name
         self.isBatchMode = "gpt" in self.model_name
@@ -128,78 +129,53 @@ class AzureInference(BatchInference):
             BatchInference.writeJSONL(response, self.output_dir / f"batch_result_job_{self.uuid}.json")
             print(f"Creating batch job for file {self.file_id} on Azure. Created job_id: {self.job_id}")
         else:
-            output = []
-            MAX_SUCCESS_FAIL = 3
-            MAX_RETRIES = 5
-            RETRY_DELAY = 2
-            data_size = len(self.formatted_data)
+            # Questions answered by an earlier attempt of the run are not sent again
+            done = self.run_store.done(self.run_id)
+            pending = [datum for datum in self.formatted_data if datum['custom_id'] not in done]
+            if done:
+                print(f"Resuming run {self.run_id}: {len(self.formatted_data) - len(pending)} answered, {len(pending)} to go")
             batches = [
-                self.formatted_data[i: i + self.batch_size]
-                for i in range(0, data_size, self.batch_size)
+                pending[i: i + self.batch_size]
+                for i in range(0, len(pending), self.batch_size)
             ]
-            for i, batch in enumerate(batches):
-                print(f"{i}", end='-')
-                n_successive_fail=0
-                time.sleep(0.1)
-                batch_id = [datum['custom_id'] for datum in batch]
-                questions = "\n\n".join([datum['body']['messages'][1]['content'] for datum in batch])
-                for attempt in range(MAX_RETRIES):
-                    response = self.get_llm_responese(prompt=questions)
-                    
-                    if response.get("success"):
-                        try:
-                            raw_data = response.get("data", "")
-                            if len(raw_data) > 0:
-                                try:
-                                    json_list = raw_data.split("</think>")[1].strip().split()
-                                    assert len(json_list) == len(batch_id), f"must match len: len(json_list) ({len(json_list)}) != len(batch_id) ({len(batch_id)})"
-                                    output.extend(self.batch_to_datum(i, 200, batch_id, json_list))
-                                    n_successive_fail=0
-                                    break
-                                except json.JSONDecodeError as e:
-                                    raise ValueError(f"Error parsing JSON string: {e}")
-                            else:
-                                json_list = raw_data
-                            
-                            if not isinstance(json_list, list):
-                                    raise ValueError(f"Expected a list of JSON objects, got: {type(json_list)}")
-                        
-                        except Exception as e:
-                            n_successive_fail += 1
-                            print("Error processing data:", e)
-                            if n_successive_fail>=MAX_SUCCESS_FAIL:
-                                print("Face continuous failure. Continue next batch")
-                                output.extend(self.batch_to_datum(i, 400, batch_id, ['']*len(batch_id)))
-                                break
-                    else:
-                        print(f"Attempt {attempt + 1} failed. Retrying...")
-                        time.sleep(RETRY_DELAY)
-                else:
-                    print("Failed to get a successful response after maximum retries.")
-                    output.extend(self.batch_to_datum(i, 400, batch_id, ['']*len(batch_id)))
-                    n_successive_fail+=1
-                    if n_successive_fail>=MAX_SUCCESS_FAIL:
-                        print("may be rate limited")
-            print()
+            batch_ids = [[datum['custom_id'] for datum in batch] for batch in batches]
+            prompts = [
+                "\n\n".join([datum['body']['messages'][1]['content'] for datum in batch])
+                for batch in batches
+            ]
+
+            def parse(i, raw_data):
+                json_list = raw_data.split("</think>")[1].strip().split()
+                assert len(json_list) == len(batch_ids[i]), f"must match len: len(json_list) ({len(json_list)}) != len(batch_id) ({len(batch_ids[i])})"
+                return json_list
+
+            def on_result(i, result):
+                if result["success"]:
+                    outputs = self.batch_to_datum(i, 200, batch_ids[i], result["data"])
+                    self.run_store.put(self.run_id, 0, [(datum['custom_id'], datum) for datum in outputs])
+
+            failed = {}
+            for i, (batch_id, result) in enumerate(zip(batch_ids, self.run_prompts(prompts, parse, on_result))):
+                if not result["success"]:
+                    failed.update((datum['custom_id'], datum) for datum in self.batch_to_datum(i, 400, batch_id, ['']*len(batch_id)))
+            answered = dict(self.run_store.results(self.run_id))
+            output = [answered.get(datum['custom_id']) or failed[datum['custom_id']] for datum in self.formatted_data]
             self.output_data = output
 
-    def get_llm_responese(self, prompt: str):
+    async def call(self, prompt: str) -> str:
         assert not self.isBatchMode, f"Only use for NON batch (single call). self.isBatchMode={self.isBatchMode}"
-        try:
-            response = self.__client.complete(
-                messages=[
-                    SystemMessage(content=self.system_prompt),
-                    UserMessage(content=prompt)
-                ],
-                max_tokens=16384,
-                model="DeepSeek-R1"
-            )
-            return {"success": True, "data": response.choices[0].message.content}
-        except Exception as e:
-            print("error in get_llm_responese", e)
-            with open("error.log", "a") as f:
-                f.write(f"{str(e)}\n")
-            return {"success": False}
+        # ChatCompletionsClient is sync, its calls run in threads of the event loop
+        response = await asyncio.to_thread(
+            self.__client.complete,
+            messages=[
+                SystemMessage(content=self.system_prompt),
+                UserMessage(content=prompt)
+            ],
+            max_tokens=16384,
+            model="DeepSeek-R1"
+        )
+        self.report_usage(response.usage.total_tokens if response.usage is not None else None)
+        return response.choices[0].message.content
     
     def get_batch_job_status(self) -> None:
         if self.isBatchMode:
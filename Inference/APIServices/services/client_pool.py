@@ -0,0 +1,220 @@
+"""
+Long-lived API clients shared by every caller of a process, one per provider
+and API key, so that HTTP connections are kept alive between requests instead
+of being set up again for every call. Several keys of a provider are used in
+turn (round robin).
+
+This module has no relative imports, so it can also be imported from outside
+the services package (e.g. DataCleaning/classification.py).
+
+Example:
+    client = get_gemini_client(os.getenv("GEMINI_API_KEY"))  # "key1,key2" for several keys
+    with POOL.request("gemini"):
+        response = client.models.generate_content(...)
+    POOL.log_stats()
+"""
+import itertools
+import logging
+import statistics
+import threading
+import time
+from contextlib import contextmanager
+
+import httpx
+
+
+def split_keys(api_keys):
+    """API keys given as a list or a comma separated string."""
+    if isinstance(api_keys, str):
+        api_keys = api_keys.split(",")
+    return [key.strip() for key in api_keys if key and key.strip()]
+
+
+class PoolStats:
+    """Per provider counts of requests, new TCP connections and request latencies."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = {}
+        self.failures = {}
+        self.http_requests = {}
+        self.new_connections = {}
+        self.latencies = {}
+
+    def record_request(self, provider, latency, success):
+        with self._lock:
+            self.requests[provider] = self.requests.get(provider, 0) + 1
+            self.failures[provider] = self.failures.get(provider, 0) + (not success)
+            self.latencies.setdefault(provider, []).append(latency)
+
+    def record_http_request(self, provider, new_connection):
+        with self._lock:
+            self.http_requests[provider] = self.http_requests.get(provider, 0) + 1
+            self.new_connections[provider] = self.new_connections.get(provider, 0) + new_connection
+
+    def summary(self):
+        with self._lock:
+            summary = {}
+            for provider in sorted(set(self.requests) | set(self.http_requests)):
+                latencies = sorted(self.latencies.get(provider, []))
+                http_requests = self.http_requests.get(provider, 0)
+                summary[provider] = {
+                    "requests": self.requests.get(provider, 0),
+                    "failures": self.failures.get(provider, 0),
+                    "http_requests": http_requests,
+                    "new_connections": self.new_connections.get(provider, 0),
+                    # Share of HTTP requests sent on an already open connection
+                    "connection_reuse_rate": (
+                        1 - self.new_connections.get(provider, 0) / http_requests if http_requests else None
+                    ),
+                    "latency_mean": statistics.fmean(latencies) if latencies else None,
+                    "latency_p50": latencies[len(latencies) // 2] if latencies else None,
+                    "latency_p95": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] if latencies else None,
+                }
+            return summary
+
+
+def _is_new_connection(event_name):
+    return event_name.endswith("connect_tcp.complete")
+
+
+class InstrumentedTransport(httpx.HTTPTransport):
+    """httpx transport that reports whether each request opened a new connection."""
+
+    def __init__(self, provider, stats, **kwargs):
+        super().__init__(**kwargs)
+        self.provider = provider
+        self.stats = stats
+
+    def handle_request(self, request):
+        state = {"new_connection": False}
+        previous_trace = request.extensions.get("trace")
+
+        def trace(event_name, info):
+            if _is_new_connection(event_name):
+                state["new_connection"] = True
+            if previous_trace is not None:
+                previous_trace(event_name, info)
+
+        request.extensions["trace"] = trace
+        try:
+            return super().handle_request(request)
+        finally:
+            self.stats.record_http_request(self.provider, state["new_connection"])
+
+
+class InstrumentedAsyncTransport(httpx.AsyncHTTPTransport):
+    """Async version of InstrumentedTransport."""
+
+    def __init__(self, provider, stats, **kwargs):
+        super().__init__(**kwargs)
+        self.provider = provider
+        self.stats = stats
+
+    async def handle_async_request(self, request):
+        state = {"new_connection": False}
+        previous_trace = request.extensions.get("trace")
+
+        async def trace(event_name, info):
+            if _is_new_connection(event_name):
+                state["new_connection"] = True
+            if previous_trace is not None:
+                await previous_trace(event_name, info)
+
+        request.extensions["trace"] = trace
+        try:
+            return await super().handle_async_request(request)
+        finally:
+            self.stats.record_http_request(self.provider, state["new_connection"])
+
+
+class ClientPool:
+    """
+    Clients by (provider, API key), created once by factory(api_key) on first
+    use. get() returns the clients of the given keys in turn.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._cycles = {}
+        self.stats = PoolStats()
+
+    def get(self, provider, api_keys, factory):
+        keys = tuple(split_keys(api_keys))
+        assert keys, f"No API key for {provider}"
+        with self._lock:
+            cycle = self._cycles.get((provider, keys))
+            if cycle is None:
+                cycle = self._cycles[(provider, keys)] = itertools.cycle(keys)
+            key = next(cycle)
+            client = self._clients.get((provider, key))
+            if client is None:
+                client = self._clients[(provider, key)] = factory(key)
+        return client
+
+    @contextmanager
+    def request(self, provider):
+        """Time one API call and record whether it succeeded."""
+        start = time.perf_counter()
+        success = False
+        try:
+            yield
+            success = True
+        finally:
+            self.stats.record_request(provider, time.perf_counter() - start, success)
+
+    def log_stats(self):
+        for provider, stats in self.stats.summary().items():
+            logging.info(f"Client pool [{provider}]: {stats}")
+
+
+POOL = ClientPool()
+
+
+def get_gemini_client(api_keys, pool=POOL):
+    """Shared google-genai client, for the next of the given keys."""
+
+    def factory(api_key):
+        from google import genai
+        from google.genai import types
+
+        return genai.Client(
+            api_key=api_key,
+            http_options=types.HttpOptions(
+                client_args={"transport": InstrumentedTransport("gemini", pool.stats)},
+                async_client_args={"transport": InstrumentedAsyncTransport("gemini", pool.stats)},
+            ),
+        )
+
+    return pool.get("gemini", api_keys, factory)
+
+
+def get_openai_client(api_keys, base_url=None, provider="openai", pool=POOL):
+    """Shared OpenAI (or OpenAI compatible, e.g. Deepseek) client, for the next of the given keys."""
+
+    def factory(api_key):
+        from openai import OpenAI
+
+        return OpenAI(
+            api_key=api_key,
+            base_url=base_url,
+            http_client=httpx.Client(transport=InstrumentedTransport(provider, pool.stats)),
+        )
+
+    return pool.get(provider, api_keys, factory)
+
+
+def get_async_openai_client(api_keys, base_url=None, provider="openai", pool=POOL):
+    """AsyncOpenAI counterpart of get_openai_client, its requests are counted under the same provider."""
+
+    def factory(api_key):
+        from openai import AsyncOpenAI
+
+        return AsyncOpenAI(
+            api_key=api_key,
+            base_url=base_url,
+            http_client=httpx.AsyncClient(transport=InstrumentedAsyncTransport(provider, pool.stats)),
+        )
+
+    return pool.get(f"{provider}-async", api_keys, factory)
@@ -1,3 +1,4 @@
+import itertools
 import json
 import time
 from pathlib import Path
@@ -5,13 +6,11 @@ from typing import List, Dict
 from google import genai
 from google.genai import types
 from .abstract import BatchInference
-from openai import OpenAI
+from .client_pool import POOL, get_async_openai_client
+from .response_cache import get_response_cache
 import os
 import requests
-from concurrent.futures import ThreadPoolExecutor, as_completed
 import logging
-from concurrent.futures import ProcessPoolExecutor
-from time import sleep
 from functools import lru_cache
 
 logging.basicConfig(
@@ -23,68 +22,43 @@ logging.basicConfig(
 
 class DeepseekInference(BatchInference):
     def __init__(
-        self, api_key: str, model_name: str, system_prompt: str, response_format,k=1
+        self, api_key: str, model_name: str, system_prompt: str, response_format,k=1, run_id: str = None
     ):
         """
         Args:
             response_format: Response format to use. Either {"type": "json_object"} or None.
+            run_id: ID of a run to resume, see BatchInference. Its epochs are resumed as well.
         """
-        super().__init__(api_key, model_name, system_prompt, service=model_name, response_format=response_format,k=k)
-        self.__client = None
+        super().__init__(api_key, model_name, system_prompt, service=model_name, response_format=response_format,k=k, run_id=run_id)
         self.batch_size = 20
+        self.max_concurrency = 20
+        # service is the model name here, the limits are those of "deepseek"
+        self.rate_limit_provider = "deepseek"
+        if model_name == "deepseek-reasoner":
+            self.expected_output_tokens = 4000
         self._api_key = api_key
-        self.init_client(model_name)
         self.model = model_name
 
-    def init_client(self, model_name) -> None:
-        self._client = OpenAI(
-            api_key=self._api_key, base_url="https://api.deepseek.com"
+    def pooled_async_client(self):
+        """
+        Shared async client of the next API key, used by call(): api_key may
+        hold several comma separated keys, used in turn by the requests.
+        """
+        return get_async_openai_client(
+            self._api_key, base_url="https://api.deepseek.com", provider="deepseek"
         )
 
-    def exec_task(self, data) -> None:
-
-        batch_questions = data["batch_questions"]
-
-        MAX_SUCCESS_FAIL = 3
-        MAX_RETRIES = 3
+    def parse_answers(self, raw_data: str) -> Dict:
+        """JSON object of a response, with its "answers" list."""
+        raw_data = raw_data.replace("```json", "").replace("```", "").strip()
         try:
-            n_successive_fail = 0
-            questions = "\n\n".join(
-                [q["content"] for q in batch_questions]
-            )
-            for attempt in range(MAX_RETRIES):
-
-                response = self.get_llm_responese(prompt=questions)
-
-                if response.get("success"):
-                    try:
-                        raw_data = response.get("data", "[]")
-                        if isinstance(raw_data, str):
-                            try:
-                                raw_data = (
-                                    raw_data.replace("```json", "")
-                                    .replace("```", "")
-                                    .strip()
-                                )
-                                json_list = json.loads(raw_data)
-                                n_successive_fail = 0
-                            except json.JSONDecodeError as e:
-                                raise ValueError(f"Error parsing JSON string: {e}")
-                        else:
-                            json_list = raw_data
-                        return {"success": True, "data": json_list}
-
-                    except Exception as e:
-                        n_successive_fail += 1
-                        time.sleep(0.1)
-                        logging.error(
-                            f"Continuous failure . Error: {str(e)}"
-                        )
-                        if n_successive_fail >= MAX_SUCCESS_FAIL:
-                            return {"success": False, "error": str(e)}
-        except Exception as e:
-            logging.error(f"Failed to get data': {str(e)}")
-            return {"success": False, "error": str(e)}
+            json_list = json.loads(raw_data)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Error parsing JSON string: {e}")
+        answers = json_list.get("answers") if isinstance(json_list, dict) else None
+        if not isinstance(answers, list) or not all(isinstance(a, dict) and "answer" in a for a in answers):
+            raise ValueError(f"No answers list in the response: {raw_data[:200]}")
+        return json_list
 
     def prepareData(self, data: List[str | Dict]) -> None:
         if type(data) == dict:
@@ -98,144 +72,177 @@ class DeepseekInference(BatchInference):
     def batch_to_datum(self, id, status_code, batch_id, batch_out):
        pass
     def run_batch(self, data_formatted:list):
+        """
+        Answer the k epochs of pass@k at once: their batches are interleaved in
+        one queue, sharing max_concurrency, the rate limiter and the client
+        pool, and each epoch is written to its own _epoch_{i}.jsonl file.
+        """
         print("Begin processing batches...")
-        # MAX_WORKERS = 5
         self.save_data(data=data_formatted)
-        output_paths=[os.path.join("batch_out",self.service,f"{self.uuid}_epoch_{i}.jsonl") for i in range(self.k)]
-        for p in output_paths:
-            self.create_batch_job(p) 
-            
-        # with ProcessPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        #         futures = {executor.submit(self.create_batch_job, p): p for p in output_paths}
-        #         for future in as_completed(futures):
-        #             path = futures[future]
-        #             try:
-        #                 result = future.result()  # This blocks until task completes
-        #                 logging.info(f"Completed {path}: {result}")
-        #             except Exception as e:
-        #                 logging.error(f"Task {path} crashed: {e}")
+        output_paths=[self.epoch_output_path(i) for i in range(self.k)]
+        try:
+            self.answer_questions({epoch: self.pending_questions(epoch) for epoch in range(self.k)})
+        except KeyboardInterrupt:
+            print(f"\nCancelling... resume with run_id={self.run_id}")
+            raise
+        finally:
+            for epoch, p in enumerate(output_paths):
+                self.export_results(p, epoch)
+        POOL.log_stats()
+        if self.rate_limiter is not None:
+            logging.info(f"Rate limiter [{self.rate_limiter.name}]: {self.rate_limiter.stats()}")
+        if self.use_cache:
+            logging.info(f"Response cache: {get_response_cache().stats()}")
         print("Finished processing all batches.")
 
-    def create_batch_job(self,output_path:str="") -> None:
-        """Create Your Batch Job"""
-        data_size = len(self.formatted_data)
-        if not os.path.exists(output_path):
-            with open(output_path, "w") as f:
-                pass
-        batches = []
-        for i in range(0, data_size, self.batch_size):
-            batches.append(
-                {
-                    "batch_questions": self.formatted_data[i : i + self.batch_size],
-                }
-            )
-        results = []
-        MAX_THREADS = 20
-        REQUEST_DELAY = 1
-        max_counter = 10
-        save_counter = 10
-        number_processed = 0
+    def epoch_output_path(self, epoch: int) -> str:
+        return os.path.join("batch_out", self.service, f"{self.uuid}_epoch_{epoch}.jsonl")
+
+    def pending_questions(self, epoch: int) -> List[Dict]:
+        """Questions of formatted_data without an answer for epoch: those answered by an earlier attempt of the run are not sent again."""
+        done = self.run_store.done(self.run_id, epoch)
+        pending = [q for q in self.formatted_data if str(q["id"]) not in done]
+        if done:
+            logging.info(f"Resuming run {self.run_id}, epoch {epoch}: {len(self.formatted_data) - len(pending)} answered, {len(pending)} to go")
+        return pending
+
+    def create_batch_job(self, output_path: str = "", epoch: int = 0) -> None:
+        """Create Your Batch Job: answer the questions of one epoch, written to output_path."""
         try:
-            with ThreadPoolExecutor(max_workers=MAX_THREADS) as executor:
-                futures = {executor.submit(self.exec_task, batch): batch for batch in batches}
-                
-                for future in as_completed(futures):
-                    batch = futures[future]
-                    
-                    try:
-                        result = future.result()
-                        q_ids = [q["id"] for q in batch["batch_questions"]]
-                        results.extend(
-                            {"qid": q, "answer": r["answer"]} 
-                            for q, r in zip(q_ids, result["data"]["answers"])
-                        )
-                        
-                        number_processed += 1
-                        print(f"Processed {number_processed}/{len(batches)} batches")
-                        
-                        save_counter -= 1
-                        if save_counter <= 0:
-                            with open(output_path, "a") as f:
-                                f.writelines(json.dumps(r) + "\n" for r in results)
-                            results.clear()
-                            save_counter = max_counter
-                            
-                    except KeyboardInterrupt:
-                        print("\nCancelling...")
-                        for f in futures: f.cancel()
-                        break
-                        
-                    except Exception as e:
-                        logging.error(f"Error: {e}")
-                        sleep(1)
-                        futures[executor.submit(self.exec_task, batch)] = batch
-                        
+            self.answer_questions({epoch: self.pending_questions(epoch)})
+        except KeyboardInterrupt:
+            print(f"\nCancelling... resume with run_id={self.run_id}")
+            raise
         finally:
-            print("save path", output_path)
-            if results:  # Save any remaining results
-                with open(output_path, "a") as f:
-                    f.writelines(json.dumps(r) + "\n" for r in results)
-            
-   
-
-    # @lru_cache(maxsize=1000)
-    def get_llm_responese(self, prompt: str):
-        # https://ai.google.dev/gemini-api/docs/structured-output
+            self.export_results(output_path, epoch)
+
+    def answer_questions(self, questions: Dict[int, List[Dict]]) -> None:
+        """
+        Answer the questions of each epoch ({epoch: questions}) in batches of
+        batch_size, saving the answers in the run store. The batches of all
+        epochs go through one queue, the n-th batch of each epoch one after
+        the other. Batches that keep failing are split (see run_batches), and
+        the questions that still fail are appended to the dead letter file,
+        which is then pruned of the questions that now have an answer.
+        """
+        by_epoch = [
+            [
+                [(epoch, q) for q in epoch_questions[i : i + self.batch_size]]
+                for i in range(0, len(epoch_questions), self.batch_size)
+            ]
+            for epoch, epoch_questions in questions.items()
+        ]
+        batches = [batch for batches in itertools.zip_longest(*by_epoch) for batch in batches if batch is not None]
+
+        def parse(batch, raw_data):
+            json_list = self.parse_answers(raw_data)
+            if len(json_list["answers"]) != len(batch):
+                raise ValueError(f"{len(json_list['answers'])} answers to {len(batch)} questions")
+            return json_list
+
+        def on_result(batch, json_list):
+            epoch = batch[0][0]
+            self.run_store.put(self.run_id, epoch, [
+                (q["id"], {"qid": q["id"], "answer": r["answer"]})
+                for (_, q), r in zip(batch, json_list["answers"])
+            ])
+
+        def on_failure(batch, error):
+            epoch, q = batch[0]
+            logging.error(f"Question {q['id']} of epoch {epoch} failed, see {self.dead_letter_path}: {error}")
+            with open(self.dead_letter_path, "a") as f:
+                f.write(json.dumps({"epoch": epoch, "question": q, "error": error, "time": time.time()}, ensure_ascii=False) + "\n")
+
         try:
-            if "gemini" in self.model_name:
-                response = self.__client.models.generate_content(
-                    model="gemini-2.0-flash",
-                    contents=prompt,
-                    config=types.GenerateContentConfig(
-                        system_instruction=self.system_prompt,
-                        response_mime_type="application/json",
-                        response_schema=self.response_format,
-                    ),
-                )
-                return {"success": True, "data": response.text}
-            elif self.model == "llama":
-                response = self.client.chat(
-                    model="llama3.2",
-                    messages=[{"role": "user", "content": prompt}],
-                )
-                return {"success": True, "data": response["message"]["content"]}
-            elif self.model == "deepseek-chat":
-                response = self._client.chat.completions.create(
-                    model="deepseek-chat",
-                    messages=[
-                        {
-                            "role": "system",
-                            "content": self.system_prompt,
-                        },
-                        {"role": "user", "content": prompt},
-                    ],
-                    stream=False,
-                )
-                return {"success": True, "data": response.choices[0].message.content}
-            elif self.model=="deepseek-reasoner":
-                response = self._client.chat.completions.create(
-                    model="deepseek-reasoner",
-                    messages=[
-                        {
-                            "role": "system",
-                            "content": self.system_prompt,
-                        },
-                        {"role": "user", "content": prompt},
-                    ],
-                    max_tokens=6400,
-                    stream=False,
-                )
-                logging.info(f"Deepseek Reasoner response: {response.choices[0].message.content}")
-                return {"success": True, "data": response.choices[0].message.content}
-            
-            else:
-
-                raise Exception("Invalid Model")
-        except Exception as e:
-            print("error in get_llm_responese", e)
-            with open("error.log", "a") as f:
-                f.write(f"{str(e)}\n")
-            return {"success": False}
+            self.run_batches(
+                batches,
+                lambda batch: "\n\n".join(q["content"] for _, q in batch),
+                parse,
+                on_result,
+                on_failure,
+                sample=lambda batch: batch[0][0],
+            )
+        finally:
+            self.prune_dead_letter()
+
+    @property
+    def dead_letter_path(self) -> str:
+        """JSONL file of the questions given up by the run, with their epoch and last error."""
+        return os.path.join("batch_out", self.service, f"{self.run_id}_dead_letter.jsonl")
+
+    def prune_dead_letter(self) -> None:
+        """
+        Rewrite the dead letter file without the questions that have an answer
+        in the run store (e.g. answered by a resume of the run), keeping the
+        last entry of each question that still failed. Removed when empty.
+        """
+        if not os.path.exists(self.dead_letter_path):
+            return
+        lines = BatchInference.readJSONL(self.dead_letter_path)
+        entries = {(entry["epoch"], str(entry["question"]["id"])): entry for entry in lines}
+        done = {epoch: self.run_store.done(self.run_id, epoch) for epoch in {epoch for epoch, _ in entries}}
+        remaining = [entry for (epoch, qid), entry in entries.items() if qid not in done[epoch]]
+        if len(remaining) == len(lines):
+            return
+        logging.info(f"Dead letter of run {self.run_id}: {len(entries) - len(remaining)} answered since, {len(remaining)} left")
+        if remaining:
+            BatchInference.writeJSONL(remaining, self.dead_letter_path)
+        else:
+            os.remove(self.dead_letter_path)
+
+    def replay_dead_letter(self) -> None:
+        """
+        Send the questions of the dead letter file again, e.g. after fixing the
+        prompt or once the API is back. Those that fail again are written back
+        to it, and the epoch files of the run are written again with the new answers.
+        """
+        if not os.path.exists(self.dead_letter_path):
+            print(f"No dead letter file for run {self.run_id}")
+            return
+        by_epoch = {}
+        for entry in BatchInference.readJSONL(self.dead_letter_path):
+            by_epoch.setdefault(entry["epoch"], {})[str(entry["question"]["id"])] = entry["question"]
+        # The failures of the replay are appended to a new file
+        os.remove(self.dead_letter_path)
+        pending = {}
+        for epoch, questions in sorted(by_epoch.items()):
+            done = self.run_store.done(self.run_id, epoch)
+            pending[epoch] = [q for qid, q in questions.items() if qid not in done]
+            logging.info(f"Replaying {len(pending[epoch])} questions of epoch {epoch}")
+        self.answer_questions(pending)
+        for epoch in pending:
+            self.export_results(self.epoch_output_path(epoch), epoch)
+
+    def export_results(self, output_path: str, epoch: int = 0) -> None:
+        """Write every answer of the epoch saved in the run store to output_path, one JSON line per question."""
+        print("save path", output_path)
+        with open(output_path, "w") as f:
+            f.writelines(json.dumps(r) + "\n" for _, r in self.run_store.results(self.run_id, epoch))
+
+    async def call(self, prompt: str) -> str:
+        if self.model == "deepseek-chat":
+            kwargs = {}
+        elif self.model == "deepseek-reasoner":
+            kwargs = {"max_tokens": 6400}
+        else:
+            raise Exception("Invalid Model")
+        with POOL.request("deepseek"):
+            response = await self.pooled_async_client().chat.completions.create(
+                model=self.model,
+                messages=[
+                    {
+                        "role": "system",
+                        "content": self.system_prompt,
+                    },
+                    {"role": "user", "content": prompt},
+                ],
+                stream=False,
+                **kwargs,
+            )
+        self.report_usage(response.usage.total_tokens if response.usage is not None else None)
+        if self.model == "deepseek-reasoner":
+            logging.info(f"Deepseek Reasoner response: {response.choices[0].message.content}")
+        return response.choices[0].message.content
 
     def get_batch_job_status(self) -> None:
         """Check Batch Status"""
@@ -1,27 +1,22 @@
 import json
-import time
 from pathlib import Path
 from typing import List, Dict
-from google import genai
 from google.genai import types
 from .abstract import BatchInference
+from .client_pool import POOL, get_gemini_client
+from .response_cache import get_response_cache
 
 class GeminiInference(BatchInference):
     # https://ai.google.dev/gemini-api/docs
-    def __init__(self, api_key: str, model_name: str, system_prompt: str, response_format):
+    def __init__(self, api_key: str, model_name: str, system_prompt: str, response_format, run_id: str = None):
         """
         Args:
             response_format: Response format to use. Either {"type": "json_object"} or None.
+            run_id: ID of a run to resume, see BatchInference.
         """
-        super().__init__(api_key, model_name, system_prompt, "gemini", response_format)
-        self.__client = None
+        super().__init__(api_key, model_name, system_prompt, "gemini", response_format, run_id=run_id)
         self.batch_size = 20
 
-        self.init_client(model_name)
-
-    def init_client(self, model_name) -> None:
-        self.__client = genai.Client(api_key=self._api_key)
-
     def prepareData(self, data: List[str|Dict]) -> None:
         """Prepare data following the format of the model.
         Args:
@@ -81,88 +76,65 @@ class GeminiInference(BatchInference):
     def create_batch_job(self) -> None:
         """Create Your Batch Job
         """
-        output = []
-        MAX_SUCCESS_FAIL = 3
-        MAX_RETRIES = 5
-        RETRY_DELAY = 2
-        data_size = len(self.formatted_data)
+        # Questions answered by an earlier attempt of the run are not sent again
+        done = self.run_store.done(self.run_id)
+        pending = [datum for datum in self.formatted_data if datum['custom_id'] not in done]
+        if done:
+            print(f"Resuming run {self.run_id}: {len(self.formatted_data) - len(pending)} answered, {len(pending)} to go")
         batches = [
-            self.formatted_data[i: i + self.batch_size]
-            for i in range(0, data_size, self.batch_size)
+            pending[i: i + self.batch_size]
+            for i in range(0, len(pending), self.batch_size)
+        ]
+        batch_ids = [[datum['custom_id'] for datum in batch] for batch in batches]
+        prompts = [
+            "\n\n".join([datum['body']['messages'][1]['content'] for datum in batch])
+            for batch in batches
         ]
-        for i, batch in enumerate(batches):
-            print(f"{i}", end='-')
-            n_successive_fail=0
-            time.sleep(0.1)
-            batch_id = [datum['custom_id'] for datum in batch]
-            questions = "\n\n".join([datum['body']['messages'][1]['content'] for datum in batch])
-            for attempt in range(MAX_RETRIES):
-                response = self.get_llm_responese(prompt=questions)
 
-                if response.get("success"):
-                    try:
-                        raw_data = response.get("data", "[]")
-                        if isinstance(raw_data, str):
-                            try:
-                                json_list = json.loads(raw_data)
-                                assert len(json_list) == len(batch_id), f"must match len: len(json_list) ({len(json_list)}) != len(batch_id) ({len(batch_id)})"
-                                output.extend(self.batch_to_datum(i, 200, batch_id, json_list))
-                                n_successive_fail=0
-                                break
-                            except json.JSONDecodeError as e:
-                                raise ValueError(f"Error parsing JSON string: {e}")
-                        else:
-                            json_list = raw_data
-                        
-                        if not isinstance(json_list, list):
-                                raise ValueError(f"Expected a list of JSON objects, got: {type(json_list)}")
-                    
-                    except Exception as e:
-                        n_successive_fail += 1
-                        print("Error processing data:", e)
-                        if n_successive_fail>=MAX_SUCCESS_FAIL:
-                            print("Face continuous failure. Continue next batch")
-                            output.extend(self.batch_to_datum(i, 400, batch_id, ['']*len(batch_id)))
-                            break
-                else:
-                    print(f"Attempt {attempt + 1} failed. Retrying...")
-                    time.sleep(RETRY_DELAY)
-            else:
-                print("Failed to get a successful response after maximum retries.")
-                output.extend(self.batch_to_datum(i, 400, batch_id, ['']*len(batch_id)))
-                n_successive_fail+=1
-                if n_successive_fail>=MAX_SUCCESS_FAIL:
-                    print("may be rate limited")
-        print()
+        def parse(i, raw_data):
+            json_list = json.loads(raw_data)
+            if not isinstance(json_list, list):
+                raise ValueError(f"Expected a list of JSON objects, got: {type(json_list)}")
+            assert len(json_list) == len(batch_ids[i]), f"must match len: len(json_list) ({len(json_list)}) != len(batch_id) ({len(batch_ids[i])})"
+            return json_list
+
+        def on_result(i, result):
+            if result["success"]:
+                outputs = self.batch_to_datum(i, 200, batch_ids[i], result["data"])
+                self.run_store.put(self.run_id, 0, [(datum['custom_id'], datum) for datum in outputs])
+
+        failed = {}
+        for i, (batch_id, result) in enumerate(zip(batch_ids, self.run_prompts(prompts, parse, on_result))):
+            if not result["success"]:
+                failed.update((datum['custom_id'], datum) for datum in self.batch_to_datum(i, 400, batch_id, ['']*len(batch_id)))
+        answered = dict(self.run_store.results(self.run_id))
+        output = [answered.get(datum['custom_id']) or failed[datum['custom_id']] for datum in self.formatted_data]
+        print(POOL.stats.summary())
+        if self.rate_limiter is not None:
+            print(f"Rate limiter [{self.rate_limiter.name}]:", self.rate_limiter.stats())
+        if self.use_cache:
+            print("Response cache:", get_response_cache().stats())
         self.output_data = output
 
-    def get_llm_responese(self, prompt: str):
+    async def call(self, prompt: str) -> str:
         # https://ai.google.dev/gemini-api/docs/structured-output
-        try:
-            if "gemini" in self.model_name:
-                response = self.__client.models.generate_content(
-                    model='gemini-2.0-flash',
-                    contents=prompt,
-                    config=types.GenerateContentConfig(
-                        system_instruction=self.system_prompt,
-                        response_mime_type='application/json',
-                        response_schema=self.response_format,
-                    ),
-                )                
-                return {"success": True, "data": response.text}
-            elif self.model == "llama":
-                response = self.client.chat(
-                    model="llama3.2",
-                    messages=[{"role": "user", "content": prompt}],
-                )
-                return {"success": True, "data": response["message"]["content"]}
-            else:
-                raise Exception("Invalid Model")
-        except Exception as e:
-            print("error in get_llm_responese", e)
-            with open("error.log", "a") as f:
-                f.write(f"{str(e)}\n")
-            return {"success": False}
+        if "gemini" not in self.model_name:
+            raise Exception("Invalid Model")
+        # Shared client of the next key, api_key may hold several comma
+        # separated keys that are used in turn
+        with POOL.request("gemini"):
+            response = await get_gemini_client(self._api_key).aio.models.generate_content(
+                model='gemini-2.0-flash',
+                contents=prompt,
+                config=types.GenerateContentConfig(
+                    system_instruction=self.system_prompt,
+                    response_mime_type='application/json',
+                    response_schema=self.response_format,
+                ),
+            )
+        usage = response.usage_metadata
+        self.report_usage(usage.total_token_count if usage is not None else None)
+        return response.text
 
     def get_batch_job_status(self) -> None:
         """Check Batch Status
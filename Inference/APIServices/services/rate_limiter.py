@@ -0,0 +1,188 @@
+"""
+Requests-per-minute and tokens-per-minute limits of an API, as token buckets
+stored in SQLite so that every thread and process using the same quota (e.g.
+several batch_run.py sharing a key) draws from the same buckets.
+
+A call takes one request and its estimated tokens before it is sent. Once the
+response gives the actual usage, the difference is taken (or given back), so
+the token bucket follows what the provider counts rather than the estimate.
+A bucket holds at most one minute of quota: an idle limiter allows a burst of
+that size, then calls are spread at the limit.
+
+Limits are set by provider or provider/model in LLM_RATE_LIMITS, as
+<name>=<rpm>:<tpm>, comma separated, with an empty value for no limit:
+
+    LLM_RATE_LIMITS="gemini/gemini-2.0-flash=2000:4000000,deepseek=600:"
+
+Like client_pool.py it has no relative imports, so it can also be imported
+from outside the services package.
+
+Example:
+    limiter = get_rate_limiter("gemini", "gemini-2.0-flash")  # None when unlimited
+    await limiter.acquire(estimated_tokens)
+    response = await call_the_api(...)
+    await limiter.record_usage(estimated_tokens, response.usage.total_tokens)
+
+The SQLite transactions run in threads, so that a bucket locked by another
+process doesn't stall the event loop.
+"""
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_LIMITS_PATH = "llm_rate_limits.sqlite"
+# Gemini 2.0 Flash on the paid tier 1, https://ai.google.dev/gemini-api/docs/rate-limits
+DEFAULT_RATE_LIMITS = {
+    "gemini/gemini-2.0-flash": (2000, 4_000_000),
+}
+
+
+def parse_rate_limits(spec):
+    """{name: (rpm, tpm)} of a LLM_RATE_LIMITS value, None for no limit."""
+    limits = {}
+    for item in filter(None, (item.strip() for item in spec.split(","))):
+        name, _, values = item.partition("=")
+        rpm, _, tpm = values.partition(":")
+        limits[name.strip()] = (float(rpm) if rpm.strip() else None, float(tpm) if tpm.strip() else None)
+    return limits
+
+
+class BucketStore:
+    """
+    Token buckets by name in a SQLite database, safe to share between threads
+    and processes. Buckets start full.
+    """
+
+    def __init__(self, path=DEFAULT_LIMITS_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)"
+        )
+
+    def _update(self, name, capacity, refill_rate, change):
+        # BEGIN IMMEDIATE takes the write lock at once, so the read and the
+        # update of a bucket can't interleave with another process
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                row = self._db.execute("SELECT tokens, updated FROM buckets WHERE name = ?", (name,)).fetchone()
+                tokens = capacity if row is None else min(capacity, row[0] + max(0.0, now - row[1]) * refill_rate)
+                tokens = change(tokens)
+                self._db.execute(
+                    "INSERT OR REPLACE INTO buckets (name, tokens, updated) VALUES (?, ?, ?)", (name, tokens, now)
+                )
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+        return tokens
+
+    def take(self, name, amount, capacity, refill_rate):
+        """
+        Take amount from the bucket if it has it. Returns 0, or the seconds
+        to wait until it has it (nothing is taken then).
+        """
+        amount = min(amount, capacity)
+        wait = 0.0
+
+        def change(tokens):
+            nonlocal wait
+            if tokens >= amount:
+                return tokens - amount
+            wait = (amount - tokens) / refill_rate
+            return tokens
+
+        self._update(name, capacity, refill_rate, change)
+        return wait
+
+    def adjust(self, name, amount, capacity, refill_rate):
+        """Take amount (give it back when negative) without waiting, the bucket can go below 0."""
+        return self._update(name, capacity, refill_rate, lambda tokens: min(capacity, tokens - amount))
+
+
+class RateLimiter:
+    """
+    RPM and TPM limits of one quota (e.g. a provider/model), either can be
+    None for no limit. Buckets of the same name in the same store are shared.
+    """
+
+    def __init__(self, name, rpm=None, tpm=None, store=None):
+        self.name = name
+        self.rpm = rpm
+        self.tpm = tpm
+        self.store = store or BucketStore()
+        self.waits = 0
+        self.wait_time = 0.0
+        self.estimated_tokens = 0
+        self.used_tokens = 0
+
+    def _buckets(self, tokens):
+        if self.rpm:
+            yield f"{self.name}:rpm", 1, self.rpm
+        if self.tpm:
+            yield f"{self.name}:tpm", tokens, self.tpm
+
+    async def acquire(self, tokens=0):
+        """Wait until the quota allows one more request of the given estimated tokens."""
+        for bucket, amount, per_minute in self._buckets(tokens):
+            while True:
+                wait = await asyncio.to_thread(self.store.take, bucket, amount, per_minute, per_minute / 60)
+                if wait <= 0:
+                    break
+                self.waits += 1
+                self.wait_time += wait
+                await asyncio.sleep(wait)
+        self.estimated_tokens += tokens
+
+    async def record_usage(self, estimated_tokens, used_tokens):
+        """Correct the token bucket with the actual usage of a request that was acquired with estimated_tokens."""
+        self.used_tokens += used_tokens
+        if self.tpm and used_tokens != estimated_tokens:
+            await asyncio.to_thread(
+                self.store.adjust, f"{self.name}:tpm", used_tokens - estimated_tokens, self.tpm, self.tpm / 60
+            )
+
+    def stats(self):
+        return {
+            "rpm": self.rpm,
+            "tpm": self.tpm,
+            "waits": self.waits,
+            "wait_time": self.wait_time,
+            "estimated_tokens": self.estimated_tokens,
+            "used_tokens": self.used_tokens,
+        }
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(provider, model=None, path=None):
+    """
+    The limiter of provider/model in this process, with the limits of
+    LLM_RATE_LIMITS (or DEFAULT_RATE_LIMITS) for provider/model, else for
+    provider. Its buckets are stored at path (LLM_RATE_LIMITS_PATH, or
+    llm_rate_limits.sqlite). None when there is no limit.
+    """
+    limits = dict(DEFAULT_RATE_LIMITS)
+    limits.update(parse_rate_limits(os.getenv("LLM_RATE_LIMITS", "")))
+    # The buckets are named after the matching entry: limits set for a
+    # provider are shared by all its models
+    name = f"{provider}/{model}" if model else provider
+    if name not in limits:
+        name = provider
+    rpm, tpm = limits.get(name, (None, None))
+    if not rpm and not tpm:
+        return None
+    path = path or os.getenv("LLM_RATE_LIMITS_PATH", DEFAULT_LIMITS_PATH)
+    with _limiters_lock:
+        limiter = _limiters.get((path, name))
+        if limiter is None:
+            limiter = _limiters[(path, name)] = RateLimiter(name, rpm, tpm, BucketStore(path))
+        return limiter
@@ -0,0 +1,172 @@
+"""
+Persistent cache of LLM responses in SQLite, keyed by the hash of everything
+that determines a response: model, system prompt, response schema and user
+content. Identical requests, e.g. when a run is started again after a failure
+or after changing some of the prompts, are answered from the cache instead of
+being paid for again.
+
+Like client_pool.py it has no relative imports, so it can also be imported
+from outside the services package (e.g. DataCleaning/classification.py).
+
+Example:
+    cache = get_response_cache()  # LLM_CACHE_PATH, LLM_CACHE_MAX_MB
+    key = cache_key(model, system_prompt, schema, prompt)
+    data = cache.get(key)
+    if data is None:
+        data = call_the_api(...)
+        cache.put(key, data)
+    print(cache.stats())
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import typing
+
+DEFAULT_CACHE_PATH = "llm_cache.sqlite"
+DEFAULT_MAX_MB = 1024
+
+
+def schema_fingerprint(schema):
+    """JSON serializable description of a response schema (pydantic model, list[Model], dict or None)."""
+    if schema is None:
+        return None
+    if hasattr(schema, "model_json_schema"):
+        return schema.model_json_schema()
+    args = typing.get_args(schema)
+    if args:
+        return {"origin": repr(typing.get_origin(schema)), "args": [schema_fingerprint(arg) for arg in args]}
+    return schema
+
+
+def cache_key(model, system_prompt, schema, content):
+    request = [model, system_prompt, schema_fingerprint(schema), content]
+    return hashlib.sha256(json.dumps(request, sort_keys=True, default=repr).encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    Responses (strings) by key in a SQLite database, safe to share between
+    threads and processes. When the responses take more than max_bytes, the
+    least recently used ones are evicted down to 90% of it.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_bytes=DEFAULT_MAX_MB << 20):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, "
+            "created REAL NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        # Total size of the responses, kept up to date by triggers so that a
+        # put doesn't sum the whole table, whichever process wrote
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            self._db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            self._db.execute(
+                "INSERT OR IGNORE INTO meta (name, value) SELECT 'total_size', COALESCE(SUM(size), 0) FROM responses"
+            )
+            self._db.execute(
+                "CREATE TRIGGER IF NOT EXISTS responses_insert AFTER INSERT ON responses BEGIN "
+                "UPDATE meta SET value = value + NEW.size WHERE name = 'total_size'; END"
+            )
+            self._db.execute(
+                "CREATE TRIGGER IF NOT EXISTS responses_delete AFTER DELETE ON responses BEGIN "
+                "UPDATE meta SET value = value - OLD.size WHERE name = 'total_size'; END"
+            )
+            self._db.execute(
+                "CREATE TRIGGER IF NOT EXISTS responses_update AFTER UPDATE OF size ON responses BEGIN "
+                "UPDATE meta SET value = value + NEW.size - OLD.size WHERE name = 'total_size'; END"
+            )
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        self._db.execute("COMMIT")
+        self.hits = 0
+        self.misses = 0
+        self.puts = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """The cached response of key, or None."""
+        with self._lock:
+            row = self._db.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._db.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+            return row[0]
+
+    def put(self, key, response):
+        now = time.time()
+        with self._lock:
+            # An upsert rather than INSERT OR REPLACE, whose implicit delete
+            # doesn't fire the delete trigger
+            self._db.execute(
+                "INSERT INTO responses (key, response, size, created, last_used) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET response = excluded.response, size = excluded.size, "
+                "created = excluded.created, last_used = excluded.last_used",
+                (key, response, len(response.encode("utf-8")), now, now),
+            )
+            self.puts += 1
+            self._evict()
+
+    def delete(self, key):
+        """Forget the response of key, e.g. because the caller rejected it."""
+        with self._lock:
+            self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+
+    def _evict(self):
+        total = self._db.execute("SELECT value FROM meta WHERE name = 'total_size'").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        target = total - int(self.max_bytes * 0.9)
+        freed = 0
+        evicted = []
+        for key, size in self._db.execute("SELECT key, size FROM responses ORDER BY last_used"):
+            evicted.append((key,))
+            freed += size
+            if freed >= target:
+                break
+        self._db.executemany("DELETE FROM responses WHERE key = ?", evicted)
+        self.evictions += len(evicted)
+
+    def stats(self):
+        with self._lock:
+            entries, size = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else None,
+            "puts": self.puts,
+            "evictions": self.evictions,
+            "entries": entries,
+            "size_mb": size / (1 << 20),
+        }
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_response_cache(path=None, max_mb=None):
+    """
+    The cache of this process at path (LLM_CACHE_PATH, or llm_cache.sqlite),
+    of at most max_mb MB (LLM_CACHE_MAX_MB, or 1024).
+    """
+    path = path or os.getenv("LLM_CACHE_PATH", DEFAULT_CACHE_PATH)
+    max_mb = max_mb or int(os.getenv("LLM_CACHE_MAX_MB", DEFAULT_MAX_MB))
+    with _caches_lock:
+        cache = _caches.get(path)
+        if cache is None:
+            cache = _caches[path] = ResponseCache(path, max_bytes=max_mb << 20)
+        return cache
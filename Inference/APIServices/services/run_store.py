@@ -0,0 +1,138 @@
+"""
+Results of inference runs in SQLite, keyed by run ID, question ID and epoch
+(the attempt of pass@k), written as soon as a batch is answered. A run
+started again with the same run ID (e.g. after a crash or Ctrl-C) only sends
+the questions that have no result yet.
+
+Each run has a manifest (service, model, k, system prompt hash) so that a run
+ID can't be resumed with a different model or prompt by mistake.
+
+Like client_pool.py it has no relative imports, so it can also be imported
+from outside the services package.
+
+Example:
+    store = get_run_store()  # LLM_RUNS_PATH
+    store.open_run(run_id, service="gemini", model="gemini-2.0-flash", system_prompt=prompt)
+    done = store.done(run_id, epoch=0)
+    store.put(run_id, 0, [(qid, result) for ...])
+    results = store.results(run_id, 0)
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_RUNS_PATH = os.path.join("batch_out", "runs.sqlite")
+
+
+class RunStore:
+    """Run manifests and their results in a SQLite database, safe to share between threads and processes."""
+
+    def __init__(self, path=DEFAULT_RUNS_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS runs ("
+            "run_id TEXT PRIMARY KEY, service TEXT NOT NULL, model TEXT NOT NULL, k INTEGER NOT NULL, "
+            "prompt_hash TEXT, created REAL NOT NULL, updated REAL NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "run_id TEXT NOT NULL, qid TEXT NOT NULL, epoch INTEGER NOT NULL, result TEXT NOT NULL, "
+            "created REAL NOT NULL, PRIMARY KEY (run_id, qid, epoch))"
+        )
+
+    def open_run(self, run_id, service, model, k=1, system_prompt=None):
+        """
+        Create the manifest of run_id, or check that the existing one matches.
+        Returns the manifest as a dict.
+        """
+        prompt_hash = hashlib.sha256((system_prompt or "").encode("utf-8")).hexdigest()
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR IGNORE INTO runs (run_id, service, model, k, prompt_hash, created, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (run_id, service, model, k, prompt_hash, now, now),
+            )
+            row = self._db.execute(
+                "SELECT run_id, service, model, k, prompt_hash, created, updated FROM runs WHERE run_id = ?", (run_id,)
+            ).fetchone()
+        manifest = dict(zip(["run_id", "service", "model", "k", "prompt_hash", "created", "updated"], row))
+        if (manifest["service"], manifest["model"], manifest["prompt_hash"]) != (service, model, prompt_hash):
+            raise ValueError(
+                f"Run {run_id} was started with service={manifest['service']}, model={manifest['model']} and "
+                f"another system prompt, use a new run ID"
+            )
+        if k > manifest["k"]:
+            with self._lock:
+                self._db.execute("UPDATE runs SET k = ? WHERE run_id = ?", (k, run_id))
+            manifest["k"] = k
+        return manifest
+
+    def done(self, run_id, epoch=0):
+        """IDs of the questions of the epoch that have a result."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT qid FROM results WHERE run_id = ? AND epoch = ?", (run_id, epoch)
+            ).fetchall()
+        return {row[0] for row in rows}
+
+    def put(self, run_id, epoch, results):
+        """Save results, a list of (question ID, JSON serializable result), in one transaction."""
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO results (run_id, qid, epoch, result, created) VALUES (?, ?, ?, ?, ?)",
+                    [(run_id, str(qid), epoch, json.dumps(result, ensure_ascii=False), now) for qid, result in results],
+                )
+                self._db.execute("UPDATE runs SET updated = ? WHERE run_id = ?", (now, run_id))
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+    def results(self, run_id, epoch=0):
+        """(question ID, result) of the epoch, in the order they were saved."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT qid, result FROM results WHERE run_id = ? AND epoch = ? ORDER BY rowid", (run_id, epoch)
+            ).fetchall()
+        return [(qid, json.loads(result)) for qid, result in rows]
+
+    def runs(self):
+        """Manifests of every run, with their number of results by epoch."""
+        with self._lock:
+            manifests = {
+                row[0]: dict(zip(["run_id", "service", "model", "k", "prompt_hash", "created", "updated"], row))
+                for row in self._db.execute(
+                    "SELECT run_id, service, model, k, prompt_hash, created, updated FROM runs ORDER BY created"
+                )
+            }
+            for run_id, epoch, n in self._db.execute(
+                "SELECT run_id, epoch, COUNT(*) FROM results GROUP BY run_id, epoch"
+            ):
+                if run_id in manifests:
+                    manifests[run_id].setdefault("results", {})[epoch] = n
+        return list(manifests.values())
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_run_store(path=None):
+    """The run store of this process at path (LLM_RUNS_PATH, or batch_out/runs.sqlite)."""
+    path = path or os.getenv("LLM_RUNS_PATH", DEFAULT_RUNS_PATH)
+    with _stores_lock:
+        store = _stores.get(path)
+        if store is None:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            store = _stores[path] = RunStore(path)
+        return store